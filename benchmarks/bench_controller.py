@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Per-phase timings of the controller against the offline stub etcd cluster and fake EC2/Route53 (see harness.py):
+
+    ec2 inventory    EtcdManager.get_autoscaling_members() with expired inventory
+    load_members     EtcdCluster.load_members() with cached inventory
+    register_me      registration of a new instance, including confirmation from the leader
+    hk full pass     HouseKeeper pass on the leader after membership change: lock, removal of stale
+                     members (a third of the cluster size) and update of Route53 records
+    hk idle pass     HouseKeeper pass on the leader when nothing has changed (health checks of all members)
+
+    python benchmarks/bench_controller.py [--sizes 3,5,10,50,100] [--latency 1] [--aws-latency 50]
+                                          [--failure-rate 0.01] [--save results.json] [--baseline results.json]
+                                          [--control-plane asyncio]
+
+With --baseline the script exits with code 1 when any phase is slower than baseline by more than --tolerance.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from etcd import AsyncEtcdCluster, AsyncHouseKeeper, EtcdCluster, EtcdManager, EtcdMember, HouseKeeper  # noqa: E402
+from harness import REGION, FakeEC2, FakeInstance, FakeRoute53, StubEtcd, install_fake_aws  # noqa: E402
+
+PHASES = ('ec2 inventory', 'load_members', 'register_me', 'hk full pass', 'hk idle pass')
+
+
+class PassDone(Exception):
+    pass
+
+
+def make_manager(instance):
+    manager = EtcdManager()
+    manager.region = REGION
+    manager.instance_id = instance.id
+    manager.me = EtcdMember(instance, REGION)
+    return manager
+
+
+def housekeeper_pass(house_keeper):
+    def stop():
+        raise PassDone
+    house_keeper.scheduler.wait = stop
+    try:
+        house_keeper.run()
+    except PassDone:
+        pass
+
+
+def run_phases(stub, instances, cluster_class, house_keeper_class):
+    """Returns dict phase -> duration in seconds of a single run"""
+    stub.reset()
+    results = {}
+
+    manager = make_manager(instances[-1])
+    start = time.time()
+    manager.get_autoscaling_members()
+    results['ec2 inventory'] = time.time() - start
+
+    start = time.time()
+    cluster_class(manager).load_members()
+    results['load_members'] = time.time() - start
+
+    newcomer = FakeInstance(stub.stale + stub.size)
+    instances.append(newcomer)  # instances are shared with FakeEC2
+    try:
+        manager = make_manager(newcomer)
+        manager.CONFIRMATION_TIMEOUT = 10
+        cluster = cluster_class(manager)
+        cluster.load_members()
+        start = time.time()
+        manager.register_me(cluster)
+        results['register_me'] = time.time() - start
+    finally:
+        instances.pop()
+
+    leader = make_manager(instances[0])
+    leader.etcd_pid = 1  # HouseKeeper works only when etcd is running
+    house_keeper = house_keeper_class(leader, 'example.com.')
+    start = time.time()
+    housekeeper_pass(house_keeper)
+    results['hk full pass'] = time.time() - start
+
+    start = time.time()
+    housekeeper_pass(house_keeper)
+    results['hk idle pass'] = time.time() - start
+    return results
+
+
+def measure(size, args):
+    stub = StubEtcd(size, stale=size // 3, latency=args.latency / 1000.0, failure_rate=args.failure_rate).start()
+    instances = stub.instances()
+    aws_latency = args.aws_latency / 1000.0
+    install_fake_aws(FakeEC2(instances, aws_latency), FakeRoute53('example.com.', aws_latency))
+    classes = (AsyncEtcdCluster, AsyncHouseKeeper) if args.control_plane == 'asyncio' else (EtcdCluster, HouseKeeper)
+    try:
+        runs = []
+        for _ in range(args.repeat):
+            try:
+                runs.append(run_phases(stub, instances, *classes))
+            except Exception as e:
+                logging.error('run of %s members failed: %r', size, e)
+        return {phase: min(r[phase] for r in runs if phase in r) if any(phase in r for r in runs) else None
+                for phase in PHASES}
+    finally:
+        stub.stop()
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, phases in results.items():
+        for phase, value in phases.items():
+            old = baseline.get(size, {}).get(phase)
+            if value is not None and old and value > old * (1 + tolerance):
+                regressions.append('{} members, {}: {:.1f}ms -> {:.1f}ms'.format(size, phase, old * 1e3, value * 1e3))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='3,5,10,50,100', help='comma separated cluster sizes')
+    parser.add_argument('--latency', type=float, default=1, help='latency of the etcd API in ms')
+    parser.add_argument('--aws-latency', type=float, default=50, help='latency of EC2 and Route53 calls in ms')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of etcd requests which fail')
+    parser.add_argument('--control-plane', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument('--repeat', type=int, default=3, help='take the best of REPEAT runs')
+    parser.add_argument('--save', help='write results as json into given file')
+    parser.add_argument('--baseline', help='compare with results saved previously with --save')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown compared with baseline')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)-6s %(message)s', level=logging.CRITICAL)
+    EtcdCluster.REGIONS = [REGION]
+    EtcdManager.DATA_DIR = os.path.join(tempfile.mkdtemp(), 'data')
+
+    results = {}
+    print('{:>7} | '.format('members') + ' '.join('{:>13}'.format(p) for p in PHASES))
+    for size in map(int, args.sizes.split(',')):
+        results[str(size)] = phases = measure(size, args)
+        print('{:>7} | '.format(size) + ' '.join('{:>11.1f}ms'.format(phases[p] * 1e3) if phases[p] is not None
+                                                 else '{:>13}'.format('failed') for p in PHASES))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print('REGRESSION ' + r)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Memory usage and attribute access micro benchmarks of EtcdMember compared with
+the previous representation (plain object with __dict__ and properties computing
+addresses from the region mode on every access).
+
+    python benchmarks/bench_member.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from etcd import EtcdCluster, EtcdMember, tags_to_dict, urlparse  # noqa: E402
+from bench_peer_index import Instance  # noqa: E402
+
+
+class LegacyMember:
+
+    def __init__(self, instance, region=None):
+        self.id = self.name = self._addr = self._dns = None
+        self.region = region
+        self.client_port = EtcdMember.DEFAULT_CLIENT_PORT
+        self.peer_port = EtcdMember.DEFAULT_PEER_PORT
+        self.metrics_port = EtcdMember.DEFAULT_METRICS_PORT
+        self.client_urls = []
+        self.peer_urls = []
+        self.instance_id = instance.id
+        self.private_ip_address = instance.private_ip_address
+        self.public_ip_address = instance.public_ip_address
+        self.private_dns_name = instance.private_dns_name
+        self.public_dns_name = instance.public_dns_name
+        tags = tags_to_dict(instance.tags)
+        self.cloudformation_stack = tags[EtcdMember.CF_TAG]
+        self.autoscaling_group = tags[EtcdMember.AG_TAG]
+
+    def addr_matches(self, peer_urls):
+        t = '{0}:' + str(self.peer_port)
+        for url in peer_urls:
+            url = urlparse(url)
+            if url and url.netloc and url.netloc in (t.format(self.private_ip_address),
+                                                     t.format(self.public_ip_address),
+                                                     t.format(self.private_dns_name),
+                                                     t.format(self.public_dns_name)):
+                return True
+        return False
+
+    @property
+    def addr(self):
+        return EtcdCluster.is_multiregion() and self.public_ip_address or self.private_ip_address
+
+    @property
+    def dns(self):
+        return EtcdCluster.is_multiregion() and self.public_dns_name or self.private_dns_name
+
+    @property
+    def peer_addr(self):
+        return '{}:{}'.format(self.dns or self._dns or self._addr, self.peer_port)
+
+
+def measure_memory(cls, instances):
+    tracemalloc.start()
+    members = [cls(i) for i in instances]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / len(members)
+
+
+def measure(stmt, number=100000, **namespace):
+    return min(timeit.repeat(stmt, globals=namespace, number=number, repeat=3)) / number
+
+
+def main():
+    EtcdCluster.REGIONS = ['eu-west-1']
+    instances = [Instance(n) for n in range(1000)]
+    peer_urls = ['http://{}:2380'.format(instances[0].private_dns_name)]
+
+    print('{:<26} {:>12} {:>12} {:>8}'.format('', 'legacy', 'slots', 'ratio'))
+    legacy = LegacyMember(instances[0])
+    legacy, member = sys.getsizeof(legacy) + sys.getsizeof(legacy.__dict__), sys.getsizeof(EtcdMember(instances[0]))
+    print('{:<26} {:>11.0f}B {:>11.0f}B {:>7.2f}x'.format('object size', legacy, member, legacy / member))
+    legacy, member = measure_memory(LegacyMember, instances), measure_memory(EtcdMember, instances)
+    print('{:<26} {:>11.0f}B {:>11.0f}B {:>7.2f}x'.format('allocated per member', legacy, member, legacy / member))
+
+    for title, stmt in (('create from EC2 instance', 'cls(instance)'),
+                        ('addr', 'm.addr'),
+                        ('dns', 'm.dns'),
+                        ('peer_addr', 'm.peer_addr'),
+                        ('private_ip_address', 'm.private_ip_address'),
+                        ('addr_matches', 'm.addr_matches(peer_urls)')):
+        results = []
+        for cls in (LegacyMember, EtcdMember):
+            results.append(measure(stmt, cls=cls, instance=instances[0], m=cls(instances[0]), peer_urls=peer_urls))
+        print('{:<26} {:>10.1f}ns {:>10.1f}ns {:>7.2f}x'.format(title, results[0] * 1e9, results[1] * 1e9,
+                                                                results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compares matching of EC2 instances with etcd members via PeerIndex against the nested loops
+with `addr_matches` used before, for clusters from 3 to hundreds of members with stale entries.
+
+    python benchmarks/bench_peer_index.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from etcd import EtcdCluster, EtcdMember, PeerIndex  # noqa: E402
+
+
+class Instance:
+
+    def __init__(self, n, region='eu-west-1'):
+        ip = '10.{}.{}.{}'.format(n // 65536, n // 256 % 256, n % 256)
+        self.id = 'i-{:08x}'.format(n)
+        self.private_ip_address = ip
+        self.private_dns_name = 'ip-{}.{}.compute.internal'.format(ip.replace('.', '-'), region)
+        self.public_ip_address = self.public_dns_name = None
+        self.tags = [{'Key': EtcdMember.CF_TAG, 'Value': 'etcd-cluster'},
+                     {'Key': EtcdMember.AG_TAG, 'Value': 'etcd-cluster-asg'}]
+
+
+def etcd_member(instance):
+    return {'id': 'f{:015x}'.format(int(instance.id[2:], 16)), 'name': instance.id, 'clientURLs': [],
+            'peerURLs': ['http://{}:{}'.format(instance.private_dns_name, EtcdMember.DEFAULT_PEER_PORT)]}
+
+
+def legacy_merge(ec2_members, etcd_members):
+    peers = {m.peer_addr: m for m in ec2_members}
+    for m in etcd_members:
+        for peer in peers.values():
+            if peer.addr_matches(m['peerURLs']):
+                peer.set_info_from_etcd(m)
+                break
+        else:
+            m = EtcdMember(m)
+            peers[m.peer_addr] = m
+    return sorted(peers.values(), key=lambda e: e.instance_id or e.name)
+
+
+def legacy_route53(ec2_members, etcd_members):
+    return [m for m in ec2_members if any(m.addr_matches(e['peerURLs']) for e in etcd_members)]
+
+
+def indexed_route53(ec2_members, etcd_members):
+    index = PeerIndex(ec2_members)
+    matched = {m for e in etcd_members for m in index.find_all(e['peerURLs'])}
+    return [m for m in ec2_members if m in matched]
+
+
+def measure(func, *args):
+    timer = timeit.Timer(lambda: func(*args))
+    number = timer.autorange()[0] if hasattr(timer, 'autorange') else 10
+    return min(timer.repeat(3, number)) / number
+
+
+def main():
+    EtcdCluster.REGIONS = ['eu-west-1']
+    print('{:>7} {:>6} | {:>14} {:>14} {:>8} | {:>14} {:>14} {:>8}'.format(
+        'members', 'stale', 'merge legacy', 'merge index', 'speedup', 'dns legacy', 'dns index', 'speedup'))
+    for size in (3, 5, 10, 50, 100, 300, 500):
+        stale = size // 2  # etcd members left from the previously terminated instances
+        instances = [Instance(n) for n in range(size + stale)]
+        ec2_members = [EtcdMember(i) for i in instances[stale:]]
+        etcd_members = [etcd_member(i) for i in instances]
+
+        merge_legacy = measure(legacy_merge, ec2_members, etcd_members)
+        merge_index = measure(EtcdCluster.merge_member_lists, ec2_members, etcd_members)
+        dns_legacy = measure(legacy_route53, ec2_members, etcd_members)
+        dns_index = measure(indexed_route53, ec2_members, etcd_members)
+        print('{:>7} {:>6} | {:>12.1f}us {:>12.1f}us {:>7.1f}x | {:>12.1f}us {:>12.1f}us {:>7.1f}x'.format(
+            size, stale, merge_legacy * 1e6, merge_index * 1e6, merge_legacy / merge_index,
+            dns_legacy * 1e6, dns_index * 1e6, dns_legacy / dns_index))
+
+
+if __name__ == '__main__':
+    main()
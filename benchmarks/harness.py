@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Offline stand-ins for everything etcd.py talks to, used by the controller benchmarks:
+
+- `StubEtcd`: a single HTTP server emulating the etcd v2 API of every member of the cluster. Members are
+  distinguished by the loopback address they are reached on (127.0.0.0/8 is routed to the local host),
+  latency and failures can be injected cluster-wide or per member.
+- `FakeEC2`, `FakeRoute53`: in-memory replacements of the boto3 EC2 resource and Route53 client,
+  installed into `boto3.resource` and `boto3.client` with `install_fake_aws`.
+"""
+
+import json
+import random
+import threading
+import time
+
+import boto3
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from etcd import AWS_CLIENTS, EtcdMember
+
+STACK = 'etcd-cluster-1'
+REGION = 'eu-west-1'
+
+
+def member_addr(n):
+    """loopback address of the n-th (starting from 0) member of the cluster"""
+    n += 1
+    return '127.{}.{}.{}'.format(n // 65536, n // 256 % 256, n % 256)
+
+
+class FakeInstance:
+
+    def __init__(self, n, region=REGION, stack=STACK):
+        self.id = 'i-{:08x}'.format(n)
+        self.private_ip_address = member_addr(n)
+        self.private_dns_name = 'ip-{}.{}.compute.internal'.format(self.private_ip_address.replace('.', '-'), region)
+        self.public_ip_address = self.public_dns_name = None
+        self.state = {'Name': 'running'}
+        self.tags = [{'Key': EtcdMember.CF_TAG, 'Value': stack},
+                     {'Key': EtcdMember.AG_TAG, 'Value': stack + '-asg'}]
+
+
+class FakeCollection:
+
+    def __init__(self, ec2, items):
+        self.ec2 = ec2
+        self.items = items
+
+    def filter(self, Filters):
+        time.sleep(self.ec2.latency)
+        self.ec2.calls += 1
+        ret = self.items
+        for f in Filters:
+            if f['Name'] == 'instance-id':
+                ret = [i for i in ret if i.id in f['Values']]
+            elif f['Name'].startswith('tag:'):
+                key = f['Name'][4:]
+                ret = [i for i in ret if any(t['Key'] == key and t['Value'] in f['Values'] for t in i.tags)]
+        return ret
+
+
+class FakeEvents:
+
+    def register(self, event, handler):
+        pass
+
+
+class FakeMeta:
+
+    def __init__(self, client=None):
+        self.events = FakeEvents()
+        self.client = client
+
+
+class FakeEC2:
+
+    def __init__(self, instances, latency=0):
+        self.latency = latency
+        self.calls = 0
+        self.instances = FakeCollection(self, instances)
+        self.security_groups = FakeCollection(self, [])
+        self.meta = FakeMeta(self)
+
+
+class FakeRoute53:
+
+    def __init__(self, hosted_zone, latency=0):
+        self.hosted_zone = hosted_zone
+        self.latency = latency
+        self.calls = 0
+        self.records = {}
+        self.meta = FakeMeta()
+
+    def list_hosted_zones_by_name(self, DNSName):
+        time.sleep(self.latency)
+        self.calls += 1
+        return {'HostedZones': [{'Name': self.hosted_zone, 'Id': 'Z1'}]}
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        time.sleep(self.latency)
+        self.calls += 1
+        for change in ChangeBatch['Changes']:
+            record = change['ResourceRecordSet']
+            self.records[(record['Name'], record['Type'])] = record['ResourceRecords']
+
+
+def install_fake_aws(ec2, route53):
+    """Makes AWS_CLIENTS return given fakes instead of real boto3 clients and resources"""
+    boto3.resource = lambda service, region_name=None: ec2
+    boto3.client = lambda service, region_name=None: route53
+    AWS_CLIENTS.invalidate()
+
+
+class StubEtcdHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real etcd
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, content=None):
+        body = json.dumps(content).encode('utf-8') if content is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        stub = self.server.stub
+        host = self.headers.get('Host', '').split(':')[0]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+
+        delay = stub.latency + stub.member_latency.get(host, 0)
+        if delay:
+            time.sleep(delay)
+        if host in stub.down or stub.failure_rate and random.random() < stub.failure_rate:
+            self.close_connection = True  # client will see the connection aborted without response
+            return
+
+        path = urlparse(self.path).path
+        with stub.lock:
+            stub.requests += 1
+            code, content = stub.dispatch(method, host, path, body)
+        self.reply(code, content)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StubEtcd:
+    """Emulates etcd v2 cluster of `size` members running on `member_addr(n)` for n in [stale, stale + size).
+    The first `stale` members are still registered in the cluster but their instances are already terminated"""
+
+    def __init__(self, size, stale=0, latency=0, failure_rate=0):
+        self.size = size
+        self.stale = stale
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.member_latency = {}  # addr -> additional latency of this member
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('', 0), StubEtcdHandler)
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.reset()
+
+    def reset(self):
+        """Brings the cluster back to its initial state"""
+        with self.lock:
+            self.keys = {}  # key -> (value, expiration time)
+            self.members = OrderedDict((self.member_id(n), self.member_info(n, self.port))
+                                       for n in range(self.size + self.stale))
+            self.hosts = {member_addr(n): self.member_id(n) for n in range(self.size + self.stale)}
+            self.down = {member_addr(n) for n in range(self.stale)}  # addresses of members which are not answering
+            self.leader = self.member_id(self.stale)
+
+    def instances(self):
+        """EC2 instances of running members"""
+        return [FakeInstance(n) for n in range(self.stale, self.stale + self.size)]
+
+    @staticmethod
+    def member_id(n):
+        return '{:016x}'.format(0x8e9e05c52164694d + n)
+
+    @staticmethod
+    def member_info(n, port):
+        instance = FakeInstance(n)
+        return {'id': StubEtcd.member_id(n), 'name': instance.id,
+                'peerURLs': ['http://{}:{}'.format(instance.private_dns_name, EtcdMember.DEFAULT_PEER_PORT)],
+                'clientURLs': ['http://{}:{}'.format(instance.private_ip_address, port)]}
+
+    def start(self):
+        EtcdMember.DEFAULT_CLIENT_PORT = self.port
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def dispatch(self, method, host, path, body):
+        if host not in self.hosts:  # etcd is not running there
+            return 404, None
+        if path == '/health':
+            return 200, {'health': 'true'}
+        if path == '/version':
+            return 200, {'etcdserver': '2.3.7', 'etcdcluster': '2.3.0'}
+        if path == '/v2/stats/self':
+            return 200, {'leaderInfo': {'leader': self.leader}}
+        if path == '/v2/stats/leader':
+            if self.hosts[host] == self.leader:
+                return 200, {'leader': self.leader, 'followers': {i: {'counts': {'fail': 0, 'success': 1}}
+                                                                  for i in self.members if i != self.leader}}
+            return 403, {'message': 'not current leader'}
+        if path == '/v2/members':
+            if method == 'GET':
+                return 200, {'members': list(self.members.values())}
+            if method == 'POST':
+                member = {'id': '{:016x}'.format(random.getrandbits(64)), 'name': '', 'clientURLs': [],
+                          'peerURLs': json.loads(body)['peerURLs']}
+                self.members[member['id']] = member
+                return 201, member
+        if path.startswith('/v2/members/') and method == 'DELETE':
+            member = self.members.pop(path.split('/')[-1], None)
+            if not member:
+                return 404, None
+            self.hosts = {h: i for h, i in self.hosts.items() if i != member['id']}  # removed member stops
+            return 204, None
+        if path.startswith('/v2/keys/'):
+            return self.dispatch_keys(method, path[9:], parse_qs(body))
+        return 404, None
+
+    def dispatch_keys(self, method, key, params):
+        now = time.time()
+        if key in self.keys and self.keys[key][1] and self.keys[key][1] < now:
+            del self.keys[key]
+        if method == 'GET':
+            return (200, {'node': {'key': '/' + key, 'value': self.keys[key][0]}}) if key in self.keys \
+                else (404, {'errorCode': 100})
+        if method == 'PUT':
+            if params.get('prevExist') == ['False'] and key in self.keys:
+                return 412, {'errorCode': 105}
+            ttl = params.get('ttl')
+            self.keys[key] = (params.get('value', [''])[0], now + int(ttl[0]) if ttl else None)
+            return 201, {'node': {'key': '/' + key, 'value': self.keys[key][0]}}
+        if method == 'DELETE':
+            return (200, {'action': 'delete'}) if self.keys.pop(key, None) else (404, {'errorCode': 100})
+        return 405, None
@@ -3,24 +3,32 @@
 
 from __future__ import print_function
 
-import boto3
+import base64
+import copy
+import errno
+import functools
 import json
 import logging
+import math
 import os
+import random
 import re
 import requests
 import shutil
 import signal
+import socket
 import subprocess
 import sys
 import time
+import zlib
 
-from threading import Thread
-
-if sys.hexversion >= 0x03000000:
-    from urllib.parse import urlparse
-else:
-    from urlparse import urlparse
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from requests.adapters import HTTPAdapter
+from threading import Event, Lock, Thread, local
+from urllib.parse import urlparse
 
 
 class EtcdClusterException(Exception):
@@ -31,15 +39,501 @@ def tags_to_dict(tags):
     return {t['Key']: t['Value'] for t in tags}
 
 
+# result of the member health check, latency is measured in seconds
+MemberHealth = namedtuple('MemberHealth', 'id name url reachable healthy latency')
+
+
+class ClusterStatus(namedtuple('ClusterStatus', 'is_leader members health upgrade_locked')):
+    """Point-in-time view of the cluster taken by HouseKeeper at the beginning of every pass, `health` is
+    the list of `MemberHealth` and is only gathered when some decision depends on it"""
+
+    __slots__ = ()
+
+    @property
+    def healthy(self):
+        return bool(self.health) and all(r.healthy for r in self.health)
+
+
+# attributes of our own EC2 instance restored from the identity cache, mimics boto3 Instance
+CachedInstance = namedtuple('CachedInstance', 'id private_ip_address public_ip_address private_dns_name '
+                                              'public_dns_name tags')
+
+
+class Metrics:
+    """Minimal thread-safe registry of counters, gauges and histograms, rendered in the Prometheus text format"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = OrderedDict()  # name -> (type, help, {labels: value})
+
+    def describe(self, name, mtype, help):
+        self._metrics[name] = (mtype, help, {})
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._metrics[name][2]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._metrics[name][2][key] = value
+
+    def clear(self, name):
+        """Drops all series of the metric, e.g. of members which are not part of the cluster anymore"""
+        with self._lock:
+            self._metrics[name][2].clear()
+
+    def remove(self, name, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._metrics[name][2].pop(key, None)
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._metrics[name][2]
+            if key not in values:
+                values[key] = [[0] * len(self.BUCKETS), 0, 0]  # buckets, sum, count
+            histogram = values[key]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    @staticmethod
+    def _format(name, labels, value, extra=()):
+        labels = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels + extra)
+        return '{}{}{} {}'.format(name, '{' if labels else '', labels + ('}' if labels else ''), repr(float(value)))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (mtype, help, values) in self._metrics.items():
+                lines += ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, mtype)]
+                for labels, value in sorted(values.items()):
+                    if mtype != 'histogram':
+                        lines.append(self._format(name, labels, value))
+                        continue
+                    for bound, count in zip(self.BUCKETS, value[0]):
+                        lines.append(self._format(name + '_bucket', labels, count, (('le', repr(float(bound))),)))
+                    lines.append(self._format(name + '_bucket', labels, value[2], (('le', '+Inf'),)))
+                    lines.append(self._format(name + '_sum', labels, value[1]))
+                    lines.append(self._format(name + '_count', labels, value[2]))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+METRICS.describe('etcd_manager_http_request_duration_seconds', 'histogram', 'Duration of HTTP requests to etcd')
+METRICS.describe('etcd_manager_http_requests_total', 'counter', 'HTTP requests to etcd by response code')
+METRICS.describe('etcd_manager_http_sessions_total', 'counter', 'Keep-alive sessions opened per pooled endpoint')
+METRICS.describe('etcd_manager_http_sessions_active', 'gauge', 'Keep-alive sessions currently open')
+METRICS.describe('etcd_manager_http_endpoint_errors_total', 'counter', 'Failed HTTP requests per pooled endpoint')
+METRICS.describe('etcd_manager_imds_request_duration_seconds', 'histogram',
+                 'Duration of requests to EC2 instance metadata service')
+METRICS.describe('etcd_manager_imds_requests_total', 'counter',
+                 'Requests to EC2 instance metadata service by response code')
+METRICS.describe('etcd_manager_aws_call_duration_seconds', 'histogram', 'Duration of AWS API calls')
+METRICS.describe('etcd_manager_aws_call_errors_total', 'counter', 'Failed AWS API calls')
+METRICS.describe('etcd_manager_load_members_duration_seconds', 'histogram', 'Duration of EtcdCluster.load_members')
+METRICS.describe('etcd_manager_housekeeper_tick_duration_seconds', 'histogram', 'Duration of HouseKeeper iterations')
+METRICS.describe('etcd_manager_lock_acquisitions_total', 'counter', 'Attempts to take etcd locks by outcome')
+METRICS.describe('etcd_manager_members_removed_total', 'counter', 'Members removed from the cluster by HouseKeeper')
+METRICS.describe('etcd_manager_upgrade_in_progress', 'gauge', 'Whether this member is being upgraded')
+METRICS.describe('etcd_manager_upgrades_total', 'counter', 'Upgrades of this member by outcome')
+METRICS.describe('etcd_manager_upgrade_phase', 'gauge', 'Current phase of the upgrade of this member')
+METRICS.describe('etcd_manager_etcd_starts_total', 'counter', 'Started etcd processes')
+METRICS.describe('etcd_manager_etcd_exits_total', 'counter', 'Terminated etcd processes by exit code')
+METRICS.describe('etcd_manager_liveness_probe_failures_total', 'counter', 'Liveness probes etcd has not answered')
+METRICS.describe('etcd_manager_watchdog_signals_total', 'counter', 'Signals sent by watchdog to hung etcd')
+METRICS.describe('etcd_manager_peer_rtt_seconds', 'gauge', 'Round-trip time to the slowest peer measured before start')
+METRICS.describe('etcd_manager_etcd_setting', 'gauge', 'Tuning flags etcd was started with')
+METRICS.describe('etcd_manager_db_size_bytes', 'gauge', 'Size of the backend database of the member')
+METRICS.describe('etcd_manager_db_size_in_use_bytes', 'gauge', 'Size of the backend database in use (etcd >= 3.4)')
+METRICS.describe('etcd_manager_compactions_total', 'counter', 'Compactions of the history of revisions')
+METRICS.describe('etcd_manager_defragmentations_total', 'counter', 'Defragmentations of members by outcome')
+METRICS.describe('etcd_manager_alarms_disarmed_total', 'counter', 'NOSPACE alarms disarmed after defragmentation')
+METRICS.describe('etcd_manager_backups_total', 'counter', 'Backups taken by this member by outcome')
+METRICS.describe('etcd_manager_backup_duration_seconds', 'gauge', 'Duration of the last backup')
+METRICS.describe('etcd_manager_backup_size_bytes', 'gauge', 'Compressed size of the last successful backup')
+METRICS.describe('etcd_manager_backup_last_success_timestamp_seconds', 'gauge', 'When the last backup has succeeded')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            return self.send_error(404)
+        content = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: ' + format, *args)
+
+
+def start_metrics_server(port):
+    server = HTTPServer(('', port), MetricsHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info('Serving metrics on port %s', port)
+    return server
+
+
+class HttpSessionPool:
+    """Keeps one keep-alive `requests.Session` per endpoint (scheme://host:port), shared between threads.
+    The number of endpoints is bounded, least recently used sessions are closed when the limit is reached"""
+
+    MAX_ENDPOINTS = 64
+    POOL_MAXSIZE = 4  # number of connections kept open to every endpoint
+
+    def __init__(self, max_endpoints=None, pool_maxsize=None):
+        self.max_endpoints = max_endpoints or self.MAX_ENDPOINTS
+        self.pool_maxsize = pool_maxsize or self.POOL_MAXSIZE
+        self._lock = Lock()
+        self._sessions = OrderedDict()
+
+    @staticmethod
+    def get_endpoint(url):
+        url = urlparse(url)
+        return '{}://{}'.format(url.scheme, url.netloc)
+
+    def get_session(self, url):
+        endpoint = self.get_endpoint(url)
+        with self._lock:
+            session = self._sessions.pop(endpoint, None)
+            if session is None:
+                while len(self._sessions) >= self.max_endpoints:
+                    self.evict(*self._sessions.popitem(last=False))
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                METRICS.inc('etcd_manager_http_sessions_total', endpoint=endpoint)
+            self._sessions[endpoint] = session  # move to the end, i.e. mark as recently used
+            METRICS.set('etcd_manager_http_sessions_active', len(self._sessions))
+        return session
+
+    @staticmethod
+    def get_api(url):
+        parts = urlparse(url).path.split('/')
+        if 'members' in parts:  # strip member id
+            parts = parts[:parts.index('members') + 1]
+        return '/'.join(parts) or '/'
+
+    def request(self, method, url, metric='etcd_manager_http', **kwargs):
+        """Requests are measured by `metric`_request_duration_seconds and `metric`_requests_total"""
+        api = self.get_api(url)
+        start = time.time()
+        try:
+            response = getattr(self.get_session(url), method)(url, **kwargs)
+            code = response.status_code
+            return response
+        except Exception:
+            code = 'error'
+            endpoint = self.get_endpoint(url)
+            with self._lock:
+                if endpoint in self._sessions:  # series of evicted endpoints are removed
+                    METRICS.inc('etcd_manager_http_endpoint_errors_total', endpoint=endpoint)
+            raise
+        finally:
+            METRICS.observe(metric + '_request_duration_seconds', time.time() - start, method=method, api=api)
+            METRICS.inc(metric + '_requests_total', method=method, api=api, code=code)
+
+    @staticmethod
+    def evict(endpoint, session):
+        """Closes the session and drops per-endpoint series, so that only endpoints in the pool are exported.
+        Otherwise every instance the cluster has ever had would stay in metrics"""
+        session.close()
+        METRICS.remove('etcd_manager_http_sessions_total', endpoint=endpoint)
+        METRICS.remove('etcd_manager_http_endpoint_errors_total', endpoint=endpoint)
+
+    def close(self):
+        with self._lock:
+            while self._sessions:
+                self.evict(*self._sessions.popitem())
+            METRICS.set('etcd_manager_http_sessions_active', 0)
+
+
+HTTP_POOL = HttpSessionPool()
+
+
+class AwsClients:
+    """Per-region cache of boto3 clients and resources shared by EtcdManager and HouseKeeper threads.
+    Clients are thread-safe and therefore shared, resources are not, so they are cached per thread"""
+
+    EXPIRED_CREDENTIALS_CODES = ('ExpiredToken', 'ExpiredTokenException', 'RequestExpired', 'InvalidClientTokenId')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._clients = {}
+        self._local = local()
+        self._generation = 0
+
+    @staticmethod
+    def before_call(model, context, **kwargs):
+        context['etcd_manager_call'] = (time.time(), model.service_model.service_name, model.name)
+
+    @staticmethod
+    def observe_call(context, failed):
+        call = context.pop('etcd_manager_call', None)
+        if call is not None:
+            labels = {'service': call[1], 'operation': call[2]}
+            METRICS.observe('etcd_manager_aws_call_duration_seconds', time.time() - call[0], **labels)
+            if failed:
+                METRICS.inc('etcd_manager_aws_call_errors_total', **labels)
+
+    @classmethod
+    def after_call(cls, context, http_response=None, **kwargs):
+        """Responses with errors (throttling, 4xx and 5xx) are parsed and end up here as well"""
+        cls.observe_call(context, http_response is None or http_response.status_code >= 300)
+
+    @classmethod
+    def after_call_error(cls, context, **kwargs):
+        """Transport errors (connection errors, timeouts), botocore doesn't pass the model here"""
+        cls.observe_call(context, True)
+
+    @staticmethod
+    def boto3():
+        import boto3  # takes a lot of time, therefore imported only when AWS is accessed for the first time
+        return boto3
+
+    def instrument(self, client):
+        client.meta.events.register('before-call', self.before_call)
+        client.meta.events.register('after-call', self.after_call)
+        client.meta.events.register('after-call-error', self.after_call_error)
+        return client
+
+    def client(self, service, region):
+        key = (service, region)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self.instrument(self.boto3().client(service, region_name=region))
+            return self._clients[key]
+
+    def resource(self, service, region):
+        key = (service, region)
+        with self._lock:
+            if getattr(self._local, 'generation', None) != self._generation:
+                self._local.resources = {}
+                self._local.generation = self._generation
+            if key not in self._local.resources:
+                self._local.resources[key] = resource = self.boto3().resource(service, region_name=region)
+                self.instrument(resource.meta.client)
+            return self._local.resources[key]
+
+    def invalidate(self):
+        with self._lock:
+            self._clients.clear()
+            self._generation += 1
+            boto3 = sys.modules.get('boto3')
+            if boto3:
+                boto3.DEFAULT_SESSION = None  # next client will walk through the credential chain again
+
+    def check_error(self, e):
+        code = (getattr(e, 'response', None) or {}).get('Error', {}).get('Code')
+        if code in self.EXPIRED_CREDENTIALS_CODES:
+            logging.warning('AWS credentials are not valid anymore (%s), recreating clients', code)
+            self.invalidate()
+
+
+AWS_CLIENTS = AwsClients()
+
+
+class InstanceMetadata:
+    """Client of the EC2 instance metadata service. Uses IMDSv2 session token (reused until it is about to expire)
+    and falls back to IMDSv1 when token can't be obtained. The service is local and either answers immediately
+    or not at all, therefore timeouts are strict and failed requests are retried a few times"""
+
+    URL = 'http://169.254.169.254/latest/'
+    TIMEOUT = (0.5, 1)  # connect and read timeouts
+    RETRIES = 3
+    TOKEN_TTL = 21600
+    METRIC = 'etcd_manager_imds'  # kept apart from the metrics of requests to etcd
+
+    def __init__(self):
+        self._lock = Lock()
+        self._token = None
+        self._token_expires = 0
+
+    def get_token(self):
+        with self._lock:
+            if self._token_expires <= time.time():
+                self._token = None
+                try:
+                    headers = {'X-aws-ec2-metadata-token-ttl-seconds': str(self.TOKEN_TTL)}
+                    response = HTTP_POOL.request('put', self.URL + 'api/token', metric=self.METRIC, headers=headers,
+                                                 timeout=self.TIMEOUT)
+                    if response.status_code == 200:
+                        self._token = response.text
+                except requests.RequestException as e:
+                    logging.debug('Failed to get IMDSv2 token: %r', e)
+                # without token IMDSv1 is used, try to get the token again only after a minute
+                self._token_expires = time.time() + (self.TOKEN_TTL - 60 if self._token else 60)
+            return self._token
+
+    def invalidate_token(self):
+        with self._lock:
+            self._token_expires = 0
+
+    def get(self, path):
+        url = self.URL + path
+        error = None
+        for attempt in range(self.RETRIES):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            token = self.get_token()
+            try:
+                response = HTTP_POOL.request('get', url, metric=self.METRIC, timeout=self.TIMEOUT,
+                                             headers={'X-aws-ec2-metadata-token': token} if token else {})
+                if response.status_code == 200:
+                    return response
+                if response.status_code == 401:  # token has expired or was revoked
+                    self.invalidate_token()
+                error = 'code={} content={}'.format(response.status_code, response.content)
+            except requests.RequestException as e:
+                error = repr(e)
+        raise EtcdClusterException('GET {0}: {1}'.format(url, error))
+
+
+IMDS = InstanceMetadata()
+
+
+class Scheduler:
+    """Decides how long the main loop should sleep before the next iteration: failures are retried fast
+    with jittered exponential backoff, while the loop is idle the interval grows up to `max_interval`.
+    `wake_up()` interrupts the sleep immediately, for example when something has happened in the cluster"""
+
+    IDLE_ITERATIONS = 10  # number of idle iterations after which the interval is doubled
+
+    def __init__(self, interval, min_interval=1, max_interval=None, jitter=0.2):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval or interval
+        self.jitter = jitter
+        self.failures = 0
+        self.idle = 0
+        self._event = Event()
+
+    def success(self, idle=False):
+        self.failures = 0
+        self.idle = self.idle + 1 if idle else 0
+
+    def failure(self):
+        self.failures += 1
+        self.idle = 0
+
+    def next_delay(self):
+        if self.failures:
+            delay = min(self.min_interval * 2 ** min(self.failures - 1, 16), self.interval)
+        else:
+            delay = min(self.interval * 2 ** (self.idle // self.IDLE_ITERATIONS), self.max_interval)
+        return delay * random.uniform(1 - self.jitter, 1)
+
+    def wake_up(self):
+        self._event.set()
+
+    def wait(self):
+        delay = self.next_delay()
+        logging.debug('Sleeping %.1f seconds...', delay)
+        self._event.wait(delay)
+        self._event.clear()
+        return delay
+
+
+class AsyncTasks:
+    """Runs blocking steps of a reconcile pass as asyncio tasks on a thread pool, so that independent steps overlap.
+    All steps of a pass share one deadline, steps which are still running when the pass is over (it has exceeded
+    the deadline, failed or didn't need their results) are cancelled. Blocking calls can't be interrupted, they
+    continue in the pool (bounded by their own timeouts) but their results are dropped"""
+
+    MAX_WORKERS = 16
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.loop = None
+        self.executor = None
+        self.deadline = None
+        self.tasks = []
+
+    def run(self, coroutine_function, *args):
+        """Runs the pass to completion in the event loop owned by the calling thread"""
+        import asyncio  # used only in the asyncio mode, so it doesn't slow down the start
+        if not self.loop:
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        asyncio.set_event_loop(self.loop)
+        self.deadline = self.loop.time() + self.timeout
+        try:
+            return self.loop.run_until_complete(coroutine_function(*args))
+        finally:
+            pending = [task for task in self.tasks if not task.done()]
+            self.tasks = []
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.wait(pending))
+
+    def call(self, func, *args):
+        """Starts `func(*args)` in the thread pool and returns the task, which fails when the deadline is exceeded"""
+        import asyncio
+        future = self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+        task = asyncio.ensure_future(asyncio.wait_for(future, max(self.deadline - self.loop.time(), 0)))
+        self.tasks.append(task)
+        return task
+
+    @staticmethod
+    def gather(*tasks):
+        import asyncio
+        return asyncio.gather(*tasks)
+
+
 class EtcdMember:
 
     API_TIMEOUT = 3.1
     API_VERSION = '/v2/'
+    CLIENT_API = 'v2'  # 'v3' switches control traffic to the grpc-gateway of etcd >= 3.3 and leases for locks
+    ENABLE_V2 = True  # serve v2 API to application clients on etcd >= 3.4, independent of CLIENT_API
     DEFAULT_CLIENT_PORT = 2379
     DEFAULT_PEER_PORT = 2380
     DEFAULT_METRICS_PORT = 2381
     AG_TAG = 'aws:autoscaling:groupName'
     CF_TAG = 'aws:cloudformation:stack-name'
+    IP_ADDRESS_RE = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+    REGION_RE = re.compile(r'\.([a-z]{2}(-[a-z]+)+-\d+)\.compute\.(internal|amazonaws\.com)$')
+
+    # Full fleet of members is rebuilt on every loop, therefore members don't have __dict__ and values derived from
+    # the addresses (addr, dns and advertise_addr) are computed only when the member is populated from EC2 or etcd
+    __slots__ = ('id', 'name', 'instance_id', 'private_ip_address', 'public_ip_address', 'private_dns_name',
+                 'public_dns_name', '_addr', '_dns', 'autoscaling_group', 'cloudformation_stack', 'region',
+                 'client_port', 'peer_port', 'metrics_port', 'client_urls', 'peer_urls',
+                 'addr', 'dns', 'advertise_addr', '_v3_prefix')
+
+    # (hostname, port) of every url seen in peerURLs, members of the running cluster announce the same urls on every
+    # loop, so they are parsed only once. Access is not locked: the worst case is parsing a url twice
+    _parsed_urls = {}
+    MAX_PARSED_URLS = 4096
 
     def __init__(self, arg, region=None):
         self.id = None  # id of cluster member, could be obtained only from running cluster
@@ -62,10 +556,25 @@ class EtcdMember:
         self.client_urls = []  # these values could be assigned only from the running etcd
         self.peer_urls = []  # cluster by performing http://addr:client_port/v2/members api call
 
+        self._v3_prefix = None  # resolved on the first call of v3 API
+        self.addr = None
         if isinstance(arg, dict):
             self.set_info_from_etcd(arg)
         else:
             self.set_info_from_ec2_instance(arg)
+        if self.addr is None:  # addresses are not known
+            self.update_addresses()
+
+    def update_addresses(self):
+        """Has to be called after changing any of the *_ip_address or *_dns_name attributes"""
+        multiregion = EtcdCluster.is_multiregion()
+        self.addr = multiregion and self.public_ip_address or self.private_ip_address
+        self.dns = multiregion and self.public_dns_name or self.private_dns_name
+        self.advertise_addr = multiregion and self.public_dns_name or self.private_ip_address
+
+    @property
+    def peer_addr(self):
+        return '{}:{}'.format(self.dns or self._dns or self._addr, self.peer_port)
 
     def set_info_from_ec2_instance(self, instance):
         # by convention member.name == instance.id
@@ -81,27 +590,55 @@ class EtcdMember:
         self.public_ip_address = instance.public_ip_address
         self.private_dns_name = instance.private_dns_name
         self.public_dns_name = instance.public_dns_name
+        self.update_addresses()
 
         tags = tags_to_dict(instance.tags)
         self.cloudformation_stack = tags[self.CF_TAG]
         self.autoscaling_group = tags[self.AG_TAG]
 
-    @staticmethod
-    def get_addr_from_urls(urls):
+    @classmethod
+    def parse_url(cls, url):
+        ret = cls._parsed_urls.get(url)
+        if ret is None:
+            parsed = urlparse(url)
+            try:
+                ret = (parsed.hostname, parsed.port) if parsed and parsed.netloc else ()
+            except ValueError:  # invalid port
+                ret = ()
+            if len(cls._parsed_urls) >= cls.MAX_PARSED_URLS:
+                cls._parsed_urls.clear()
+            cls._parsed_urls[url] = ret
+        return ret
+
+    @classmethod
+    def get_addr_from_urls(cls, urls):
         for url in urls:
-            url = urlparse(url)
-            if url and url.netloc:
-                return url.hostname
+            url = cls.parse_url(url)
+            if url:
+                return url[0]
         return None
 
+    @classmethod
+    def get_region_from_urls(cls, urls):
+        """Region of the EC2 hostname in urls, None for ip addresses"""
+        for url in urls:
+            host = (cls.parse_url(url) or ('',))[0] or ''
+            if host.endswith('.ec2.internal') or host.endswith('.compute-1.amazonaws.com'):
+                return 'us-east-1'
+            match = cls.REGION_RE.search(host)
+            if match:
+                return match.group(1)
+        return None
+
+    @classmethod
+    def get_peer_hosts(cls, urls):
+        """(hostname, port) of every valid url"""
+        return [url for url in map(cls.parse_url, urls) if url]
+
     def addr_matches(self, peer_urls):
-        t = '{0}:' + str(self.peer_port)
-        for url in peer_urls:
-            url = urlparse(url)
-            if url and url.netloc and url.netloc in (t.format(self.private_ip_address),
-                                                     t.format(self.public_ip_address),
-                                                     t.format(self.private_dns_name),
-                                                     t.format(self.public_dns_name)):
+        for host, port in self.get_peer_hosts(peer_urls):
+            if port == self.peer_port and host and host in (self.private_ip_address, self.public_ip_address,
+                                                            self.private_dns_name, self.public_dns_name):
                 return True
         return False
 
@@ -114,7 +651,7 @@ class EtcdMember:
         # when you add new member it doesn't have name, but we can match it by peer_addr
         if not addr:
             return
-        elif re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', addr):
+        elif self.IP_ADDRESS_RE.match(addr):
             if (self.private_ip_address or self.public_ip_address) and \
                     addr not in (self.private_ip_address, self.public_ip_address):
                 return
@@ -124,6 +661,7 @@ class EtcdMember:
                     addr not in (self.private_dns_name, self.public_dns_name):
                 return
             self._dns = addr
+        self.update_addresses()
 
         self.id = info['id']
         self.name = info['name']
@@ -140,35 +678,19 @@ class EtcdMember:
             url += self.API_VERSION + endpoint
         return url
 
-    @property
-    def addr(self):
-        return EtcdCluster.is_multiregion() and self.public_ip_address or self.private_ip_address
-
-    @property
-    def dns(self):
-        return EtcdCluster.is_multiregion() and self.public_dns_name or self.private_dns_name
-
-    @property
-    def advertise_addr(self):
-        return EtcdCluster.is_multiregion() and self.public_dns_name or self.private_ip_address
-
-    @property
-    def peer_addr(self):
-        return '{}:{}'.format(self.dns or self._dns or self._addr, self.peer_port)
-
     @property
     def peer_url(self):
         return self.peer_urls and self.peer_urls[0] or self.generate_url(self.advertise_addr, self.peer_port)
 
     def api_get(self, endpoint):
         url = self.get_client_url(endpoint)
-        response = requests.get(url, timeout=self.API_TIMEOUT)
+        response = HTTP_POOL.request('get', url, timeout=self.API_TIMEOUT)
         logging.debug('Got response from GET %s: code=%s content=%s', url, response.status_code, response.content)
         return (response.json() if response.status_code == 200 else None)
 
     def api_put(self, endpoint, data):
         url = self.get_client_url(endpoint)
-        response = requests.put(url, data=data)
+        response = HTTP_POOL.request('put', url, data=data)
         logging.debug('Got response from PUT %s %s: code=%s content=%s', url, data, response.status_code,
                       response.content)
         return (response.json() if response.status_code == 201 else None)
@@ -177,61 +699,222 @@ class EtcdMember:
         url = self.get_client_url(endpoint)
         headers = {'Content-type': 'application/json'}
         data = json.dumps(data)
-        response = requests.post(url, data=data, headers=headers)
+        response = HTTP_POOL.request('post', url, data=data, headers=headers)
         logging.debug('Got response from POST %s %s: code=%s content=%s', url, data, response.status_code,
                       response.content)
         return (response.json() if response.status_code == 201 else None)
 
     def api_delete(self, endpoint, data=None):
         url = self.get_client_url(endpoint)
-        response = requests.delete(url, data=data)
+        response = HTTP_POOL.request('delete', url, data=data)
         logging.debug('Got response from DELETE %s: code=%s content=%s', url, response.status_code, response.content)
         return response.status_code == 204
 
     def get_cluster_version(self):
-        response = requests.get(self.get_client_url() + '/version')
+        response = HTTP_POOL.request('get', self.get_client_url() + '/version')
         return response.json()['etcdcluster'] if response.status_code == 200 else None
 
+    def get_v3_prefix(self):
+        """grpc-gateway of etcd 3.3 is served under /v3beta, since 3.4 under /v3 (3.4 serves /v3beta as well).
+        The cluster version is the lowest version of all members, the prefix derived from it is served by all"""
+        if self._v3_prefix is None:
+            self._v3_prefix = self.resolve_v3_prefix()
+        return self._v3_prefix
+
+    def resolve_v3_prefix(self):
+        response = HTTP_POOL.request('get', self.get_client_url() + '/version', timeout=self.API_TIMEOUT)
+        versions = response.json() if response.status_code == 200 else {}
+        # the cluster version is not decided yet right after the start
+        version = re.match(r'(\d+)\.(\d+)', versions.get('etcdcluster') or '') or \
+            re.match(r'(\d+)\.(\d+)', versions.get('etcdserver') or '')
+        if not version:
+            raise EtcdClusterException('Can not determine version of etcd: {0}'.format(versions))
+        version = tuple(map(int, version.groups()))
+        if version < (3, 3):
+            raise EtcdClusterException('etcd {0}.{1} does not serve v3 API via grpc-gateway'.format(*version))
+        return '/v3beta' if version < (3, 4) else '/v3'
+
+    @staticmethod
+    def format_id(member_id):
+        """v3 API returns member ids as decimal numbers, v2 API and the rest of the code use hex strings"""
+        return '{:x}'.format(int(member_id))
+
+    def api_v3(self, endpoint, data=None, prefix=None, timeout=None):
+        url = self.get_client_url() + (prefix or self.get_v3_prefix()) + '/' + endpoint
+        response = HTTP_POOL.request('post', url, data=json.dumps(data or {}), timeout=timeout or self.API_TIMEOUT)
+        logging.debug('Got response from POST %s %s: code=%s content=%s', url, data, response.status_code,
+                      response.content)
+        if response.status_code != 200:
+            if response.status_code == 404:
+                self._v3_prefix = None  # the cluster has been upgraded and doesn't serve the old prefix anymore
+            raise EtcdClusterException('POST {0}: code={1} content={2}'.format(
+                url, response.status_code, response.content))
+        return response.json()
+
+    @staticmethod
+    def encode_v3(value):
+        """keys and values are bytes in v3 API, grpc-gateway expects them base64 encoded"""
+        return base64.b64encode(value.encode('utf-8')).decode('utf-8')
+
+    @classmethod
+    def member_from_v3(cls, member):
+        """Converts member of v3 API into the format of v2 API, which is used everywhere else"""
+        return {'id': cls.format_id(member['ID']), 'name': member.get('name', ''),
+                'peerURLs': member.get('peerURLs', []), 'clientURLs': member.get('clientURLs', [])}
+
+    def get_status(self):
+        """v3 endpoint status: leader, DB size and raft index in one response"""
+        return self.api_v3('maintenance/status')
+
+    def get_snapshot(self):
+        """Streams the backend database of this member, yields chunks of bytes as they are received"""
+        url = self.get_client_url() + self.get_v3_prefix() + '/maintenance/snapshot'
+        response = HTTP_POOL.request('post', url, data='{}', stream=True, timeout=self.API_TIMEOUT)
+        try:
+            if response.status_code != 200:
+                raise EtcdClusterException('POST {0}: code={1}'.format(url, response.status_code))
+            for line in response.iter_lines():  # grpc-gateway sends every message of the stream as a json line
+                if line:
+                    message = json.loads(line.decode('utf-8'))
+                    if 'error' in message:
+                        raise EtcdClusterException('POST {0}: {1}'.format(url, message['error']))
+                    blob = message.get('result', {}).get('blob')
+                    if blob:
+                        yield base64.b64decode(blob)
+        finally:
+            response.close()
+
+    def measure_rtt(self, samples=3, timeout=1):
+        """Round-trip time in seconds to the client port, the best of `samples` TCP handshakes. Refused connection
+        takes one round-trip as well, so it is measured even if etcd is not running there. None if unreachable"""
+        best = None
+        for _ in range(samples):
+            start = time.time()
+            try:
+                socket.create_connection((self.advertise_addr, self.client_port), timeout).close()
+            except socket.error as e:
+                if e.errno != errno.ECONNREFUSED:
+                    continue
+            rtt = time.time() - start
+            best = rtt if best is None else min(best, rtt)
+        return best
+
     def is_leader(self):
+        if self.CLIENT_API == 'v3':
+            status = self.get_status()
+            return status['leader'] == status['header']['member_id']
         return not self.api_get('stats/leader') is None
 
     def get_leader(self):
+        if self.CLIENT_API == 'v3':
+            leader = self.get_status().get('leader')
+            return self.format_id(leader) if leader and leader != '0' else None
         json = self.api_get('stats/self')
         return (json['leaderInfo']['leader'] if json else None)
 
+    def get_followers(self):
+        """Returns follower id -> number of failed heartbeats if this member is the leader, otherwise None.
+        v3 API doesn't expose heartbeats, there only changes of membership are visible"""
+        if self.CLIENT_API == 'v3':
+            if not self.is_leader():
+                return None
+            leader = self.get_leader()
+            return {m['id']: 0 for m in self.get_members() if m['id'] != leader}
+        stats = self.api_get('stats/leader')
+        return {i: f.get('counts', {}).get('fail', 0) for i, f in (stats.get('followers') or {}).items()} \
+            if stats else None
+
     def get_members(self):
+        if self.CLIENT_API == 'v3':
+            return [self.member_from_v3(m) for m in self.api_v3('cluster/member/list').get('members') or []]
         json = self.api_get('members')
         return (json['members'] if json else [])
 
+    def take_lock(self, key, value, ttl):
+        """Creates the key with given ttl unless it exists, returns True on success"""
+        if self.CLIENT_API == 'v3':
+            lease = self.api_v3('lease/grant', {'TTL': ttl})['ID']
+            key = self.encode_v3(key)
+            response = self.api_v3('kv/txn', {
+                'compare': [{'key': key, 'target': 'CREATE', 'create_revision': 0}],
+                'success': [{'request_put': {'key': key, 'value': self.encode_v3(value), 'lease': lease}}]})
+            if not response.get('succeeded'):
+                self.api_v3('kv/lease/revoke', {'ID': lease})
+            return bool(response.get('succeeded'))
+        return self.api_put('keys/' + key, data={'value': value, 'ttl': ttl, 'prevExist': False}) is not None
+
+    def refresh_lock(self, key, value, ttl):
+        """Sets new ttl of the lock held by us, in v3 API the key is moved to a new lease"""
+        if self.CLIENT_API == 'v3':
+            lease = self.api_v3('lease/grant', {'TTL': ttl})['ID']
+            key, value = self.encode_v3(key), self.encode_v3(value)
+            return bool(self.api_v3('kv/txn', {
+                'compare': [{'key': key, 'target': 'VALUE', 'value': value}],
+                'success': [{'request_put': {'key': key, 'value': value, 'lease': lease}}]}).get('succeeded'))
+        return self.api_put('keys/' + key, data={'value': value, 'ttl': ttl, 'prevValue': value}) is not None
+
+    def release_lock(self, key, value):
+        if self.CLIENT_API == 'v3':
+            key = self.encode_v3(key)
+            return bool(self.api_v3('kv/txn', {
+                'compare': [{'key': key, 'target': 'VALUE', 'value': self.encode_v3(value)}],
+                'success': [{'request_delete_range': {'key': key}}]}).get('succeeded'))
+        return self.api_delete('keys/' + key + '?prevValue=' + value)
+
+    def lock_exists(self, key):
+        if self.CLIENT_API == 'v3':
+            return bool(self.api_v3('kv/range', {'key': self.encode_v3(key)}).get('kvs'))
+        return self.api_get('keys/' + key) is not None
+
+    def get_ingress_cidrs(self, sg):
+        """Returns set of /32 CIDRs allowed to access client and peer ports"""
+        return {r['CidrIp'] for p in sg.ip_permissions or [] if p.get('IpProtocol') == 'tcp' and
+                p.get('FromPort') == self.client_port and p.get('ToPort') == self.peer_port
+                for r in p.get('IpRanges', []) if r.get('CidrIp', '').endswith('/32')}
+
     def adjust_security_groups(self, action, *members):
+        """Authorizes (action='authorize_ingress') or revokes (action='revoke_ingress') access of given members
+        from other regions to the security group of our stack. Only missing (or still present) CIDRs are changed
+        with a single call per region. Returns False if any of the calls has failed"""
+
         if not EtcdCluster.is_multiregion():
-            return
+            return True
 
+        ret = True
         for region in EtcdCluster.REGIONS:
-            ec2 = boto3.resource('ec2', region)
-            # stack resource from cloudformation returns the GroupName instat of the GroupID...
-            # cloudformation = boto3.resource('cloudformation', region)
-            # stack_resource = cloudformation.StackResource(me.cloudformation_stack,
-            #                                               'EtcdSecurityGroup')
-            # security_group = ec2.SecurityGroup(stack_resource.physical_resource_id)
-            # .filter(...) works only with default VPC!
-            for sg in ec2.security_groups.all():
-                if sg.tags and tags_to_dict(sg.tags).get(self.CF_TAG, '') == self.cloudformation_stack:
-                    for m in members:
-                        if not m.region or m.region != region:
-                            try:
-                                getattr(sg, action)(
-                                    IpProtocol='tcp',
-                                    FromPort=self.client_port,
-                                    ToPort=self.peer_port,
-                                    CidrIp='{}/32'.format(m.addr)
-                                )
-                            except Exception:
-                                logging.exception('Exception on %s for for %s', action, m.addr)
+            cidrs = {'{}/32'.format(m.addr) for m in members if m.addr and (not m.region or m.region != region)}
+            if not cidrs:
+                continue
+            ec2 = AWS_CLIENTS.resource('ec2', region)
+            for sg in ec2.security_groups.filter(Filters=[{'Name': 'tag:' + self.CF_TAG,
+                                                           'Values': [self.cloudformation_stack]}]):
+                existing = self.get_ingress_cidrs(sg)
+                changes = cidrs & existing if action == 'revoke_ingress' else cidrs - existing
+                if not changes:
+                    continue
+                try:
+                    getattr(sg, action)(IpPermissions=[{
+                        'IpProtocol': 'tcp',
+                        'FromPort': self.client_port,
+                        'ToPort': self.peer_port,
+                        'IpRanges': [{'CidrIp': cidr} for cidr in sorted(changes)]
+                    }])
+                except Exception:
+                    logging.exception('Exception on %s for %s in %s', action, ', '.join(sorted(changes)), region)
+                    ret = False
+        return ret
 
     def add_member(self, member):
         logging.debug('Adding new member %s:%s to cluster', member.instance_id, member.peer_url)
-        response = self.api_post('members', {'peerURLs': [member.peer_url]})
+        if self.CLIENT_API == 'v3':
+            try:
+                response = self.api_v3('cluster/member/add', {'peerURLs': [member.peer_url]})
+                response = self.member_from_v3(response['member'])
+            except EtcdClusterException:
+                logging.exception('Failed to add member')
+                response = None
+        else:
+            response = self.api_post('members', {'peerURLs': [member.peer_url]})
         if response:
             member.set_info_from_etcd(response)
             return True
@@ -239,11 +922,29 @@ class EtcdMember:
 
     def delete_member(self, member):
         logging.debug('Removing member %s from cluster', member.id)
-        result = self.api_delete('members/' + member.id)
+        if self.CLIENT_API == 'v3':
+            try:
+                result = self.api_v3('cluster/member/remove', {'ID': str(int(member.id, 16))}) is not None
+            except EtcdClusterException:
+                logging.exception('Failed to remove member %s', member.id)
+                result = False
+        else:
+            result = self.api_delete('members/' + member.id)
         self.adjust_security_groups('revoke_ingress', member)
         return result
 
-    def etcd_arguments(self, data_dir, initial_cluster, cluster_state, run_old):
+    @staticmethod
+    def get_etcd_version(run_old=False):
+        etcdversion = os.environ.get('ETCDVERSION_PREV' if run_old else 'ETCDVERSION')
+        return etcdversion and tuple(int(x) for x in etcdversion.split('.'))
+
+    @classmethod
+    def serves_v2(cls):
+        """etcd < 3.4 always serves v2 API to clients, newer versions only with --enable-v2"""
+        etcdversion = cls.get_etcd_version()
+        return bool(etcdversion) and (etcdversion < (3, 4) or cls.ENABLE_V2)
+
+    def etcd_arguments(self, data_dir, initial_cluster, cluster_state, run_old, settings=None):
         # common flags that always have to be set
         arguments = [
             '-name',
@@ -266,17 +967,20 @@ class EtcdMember:
             cluster_state
         ]
 
+        # tuning flags, like heartbeat-interval, derived from the environment by EtcdManager
+        for name, value in (settings or {}).items():
+            arguments += ['--' + name, str(value)]
+
         # this section handles etcd version specific flags
-        etcdversion = os.environ.get('ETCDVERSION_PREV' if run_old else 'ETCDVERSION')
+        etcdversion = self.get_etcd_version(run_old)
         if etcdversion:
-            etcdversion = tuple(int(x) for x in etcdversion.split('.'))
             # etcd >= v3.3: serve metrics on an additonal port
             if etcdversion >= (3, 3):
                 arguments += [
                     '-listen-metrics-urls',
                     'http://0.0.0.0:{}'.format(self.metrics_port),
                 ]
-            if etcdversion >= (3, 4):
+            if etcdversion >= (3, 4) and self.ENABLE_V2:
                 arguments += [
                     '--enable-v2',
                 ]
@@ -285,8 +989,61 @@ class EtcdMember:
         return arguments
 
 
+class PeerIndex:
+    """Maps every address of given (EC2) members to these members, what allows to match
+    etcd members by their peerURLs without comparing with every member"""
+
+    def __init__(self, members):
+        self._index = {}
+        for m in members:
+            for addr in (m.private_ip_address, m.public_ip_address, m.private_dns_name, m.public_dns_name):
+                if addr:
+                    bucket = self._index.setdefault(addr, [])
+                    if m not in bucket:
+                        bucket.append(m)
+
+    def find_all(self, peer_urls):
+        ret = []
+        for host, port in EtcdMember.get_peer_hosts(peer_urls):
+            ret.extend(m for m in self._index.get(host, []) if m.peer_port == port and m not in ret)
+        return ret
+
+    def find(self, peer_urls):
+        for host, port in EtcdMember.get_peer_hosts(peer_urls):
+            for m in self._index.get(host, []):
+                if m.peer_port == port:
+                    return m
+
+
+class ClusterState:
+    """The latest etcd membership seen by any thread of the manager, used to remove ourselves on shutdown without
+    loading the cluster again. The main loop publishes members it has fetched while etcd isn't running, HouseKeeper
+    while it is, so both never fetch the membership in the same interval and don't have to read it from here"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.updated = 0
+        self.members = []
+        self.leader_id = None
+
+    def publish(self, members, leader_id=None):
+        """Empty list means that members couldn't be fetched, the leader is kept if it is not known to the caller"""
+        if members:
+            with self._lock:
+                self.leader_id = leader_id or self.leader_id
+                self.members = list(members)
+                self.updated = time.time()
+
+    def get(self, max_age):
+        """Returns (members, leader_id) published not earlier than `max_age` seconds ago or None"""
+        with self._lock:
+            if self.members and time.time() - self.updated <= max_age:
+                return self.members, self.leader_id
+
+
 class EtcdCluster:
     REGIONS = []  # more then one (1) Region if this a Multi-Region-Cluster
+    MAX_PROBES = 32  # upper limit of members probed simultaneously
 
     def __init__(self, manager):
         self.manager = manager
@@ -311,37 +1068,61 @@ class EtcdCluster:
     def merge_member_lists(ec2_members, etcd_members):
         # we can match EC2 instance with single etcd member by comparing 'addr:peer_port'
         peers = {m.peer_addr: m for m in ec2_members}
+        index = PeerIndex(peers.values())
 
         # iterate through list of etcd members obtained from running etcd cluster
         for m in etcd_members:
-            for peer in peers.values():
-                if peer.addr_matches(m['peerURLs']):
-                    peer.set_info_from_etcd(m)
-                    break
+            peer = index.find(m['peerURLs'])
+            if peer:
+                peer.set_info_from_etcd(m)
             else:  # when etcd member hasn't been found just add it into list
                 m = EtcdMember(m)
                 peers[m.peer_addr] = m
         return sorted(peers.values(), key=lambda e: e.instance_id or e.name)
 
+    @classmethod
+    def probe_members(cls, members):
+        """Query all given members concurrently and return the first one which has
+        answered with non-empty list of etcd members, together with this list"""
+
+        if not members:
+            return None, []
+
+        executor = ThreadPoolExecutor(max_workers=min(len(members), cls.MAX_PROBES))
+        try:
+            futures = {executor.submit(m.get_members): m for m in members}
+            for future in as_completed(futures):
+                try:
+                    etcd_members = future.result()
+                    if etcd_members:  # We've found accessible etcd member
+                        return futures[future], etcd_members
+                except Exception:
+                    logging.exception('Load members from etcd')
+        finally:
+            executor.shutdown(wait=False)  # don't wait for slow or dead members
+        return None, []
+
     def load_members(self):
+        with METRICS.time('etcd_manager_load_members_duration_seconds'):
+            self._load_members()
+
+    def _load_members(self):
         self.accessible_member = None
         self.leader_id = None
         ec2_members = self.manager.get_autoscaling_members()
-        etcd_members = []
 
         # Try to connect to members of autoscaling_group group and fetch information about etcd-cluster
-        for member in ec2_members:
-            if member.instance_id != self.manager.instance_id:  # Skip myself
-                try:
-                    etcd_members = member.get_members()
-                    if etcd_members:  # We've found accessible etcd member
-                        self.accessible_member = member
-                        self.leader_id = member.get_leader()  # Let's ask him about leader of etcd-cluster
-                        self.cluster_version = member.get_cluster_version()  # and about cluster-wide etcd version
-                        break
-                except Exception:
-                    logging.exception('Load members from etcd')
+        candidates = [m for m in ec2_members if m.instance_id != self.manager.instance_id]  # Skip myself
+        member, etcd_members = self.probe_members(candidates)
+        if member:
+            self.accessible_member = member
+            try:
+                self.leader_id = member.get_leader()  # Let's ask him about leader of etcd-cluster
+                self.cluster_version = member.get_cluster_version()  # and about cluster-wide etcd version
+            except Exception:
+                logging.exception('Load leader and cluster version from etcd')
 
+        self.manager.cluster_state.publish(etcd_members, self.leader_id)
         # combine both lists together
         self.members = self.merge_member_lists(ec2_members, etcd_members)
 
@@ -364,11 +1145,247 @@ class EtcdCluster:
         return True
 
 
+class AsyncEtcdCluster(EtcdCluster):
+    """Loads EC2 instances and probes the members known from the previous pass at the same time"""
+
+    def __init__(self, manager):
+        super(AsyncEtcdCluster, self).__init__(manager)
+        self.tasks = AsyncTasks(manager.REGION_TIMEOUT + EtcdMember.API_TIMEOUT * 3)
+
+    def _load_members(self):
+        self.tasks.run(self._load_members_async)
+
+    async def _load_members_async(self):
+        self.accessible_member = None
+        self.leader_id = None
+        known = [m for m in self.members if m.client_urls and m.instance_id != self.manager.instance_id]
+
+        call = self.tasks.call
+        discovery, probe = call(self.manager.get_autoscaling_members), call(self.probe_members, known)
+        ec2_members = await discovery
+        member, etcd_members = await probe
+        if not member:  # members known from the previous pass are not accessible, probe all instances
+            candidates = [m for m in ec2_members if m.instance_id != self.manager.instance_id]  # Skip myself
+            member, etcd_members = await call(self.probe_members, candidates)
+
+        if member:
+            self.accessible_member = member
+            leader, version = call(member.get_leader), call(member.get_cluster_version)
+            try:
+                self.leader_id = await leader
+                self.cluster_version = await version
+            except Exception:
+                logging.exception('Load leader and cluster version from etcd')
+
+        self.manager.cluster_state.publish(etcd_members, self.leader_id)
+        self.members = self.merge_member_lists(ec2_members, etcd_members)
+
+
+class LocalBackupStore:
+    """Keeps backups in a local directory, for example on a mounted volume"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def upload(self, name, chunks):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        path = os.path.join(self.path, name)
+        size = 0
+        with open(path + '.tmp', 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.rename(path + '.tmp', path)
+        return size
+
+    def latest(self):
+        names = os.listdir(self.path) if os.path.isdir(self.path) else []
+        return max([n for n in names if n.endswith(Backup.SUFFIX)] or [None])
+
+    def download(self, name, f):
+        with open(os.path.join(self.path, name), 'rb') as src:
+            shutil.copyfileobj(src, f)
+
+
+class S3BackupStore:
+    """Keeps backups under the prefix in S3 bucket, every chunk is uploaded as a part of the multipart upload"""
+
+    def __init__(self, bucket, prefix, region):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+
+    def upload(self, name, chunks):
+        conn = AWS_CLIENTS.client('s3', self.region)
+        key = self.prefix + name
+        upload_id = conn.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        parts = []
+        size = 0
+        try:
+            for number, chunk in enumerate(chunks, 1):
+                response = conn.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                            Body=chunk)
+                parts.append({'ETag': response['ETag'], 'PartNumber': number})
+                size += len(chunk)
+            conn.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                           MultipartUpload={'Parts': parts})
+        except Exception:
+            conn.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return size
+
+    def latest(self):
+        conn = AWS_CLIENTS.client('s3', self.region)
+        names = [o['Key'][len(self.prefix):]
+                 for page in conn.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix)
+                 for o in page.get('Contents', []) if o['Key'].endswith(Backup.SUFFIX)]
+        return max(names or [None])
+
+    def download(self, name, f):
+        AWS_CLIENTS.client('s3', self.region).download_fileobj(self.bucket, self.prefix + name, f)
+
+
+class Backup:
+    """Snapshots of the etcd database in TARGET: `s3://bucket/prefix` or a local directory, in both cases backups
+    of every stack are kept separately. The snapshot is compressed and uploaded in chunks while it is being received
+    from etcd, so neither the database nor its backup have to fit into memory or onto the local disk"""
+
+    TARGET = None
+    INTERVAL = 3600  # how often one of the members takes the backup
+    RETRY_INTERVAL = 300  # when the next backup is attempted after a failure
+    RESTORE = False  # seed data directory of the new cluster from the latest backup
+    CHUNK_SIZE = 8 * 1024 * 1024  # parts of S3 multipart upload can't be smaller than 5MB
+    ETCDCTL_BINARY = '/bin/etcdctl'
+    SUFFIX = '.db.gz'
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.TARGET)
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @staticmethod
+    def covers_data():
+        """Backups are v3 snapshots, they don't contain the v2 keyspace. While etcd serves v2 API
+        clients may keep their data there, therefore such a backup would silently miss it"""
+        return not EtcdMember.serves_v2()
+
+    def get_store(self):
+        url = urlparse(self.TARGET)
+        stack = self.manager.me.cloudformation_stack
+        if url.scheme == 's3':
+            prefix = url.path.strip('/')
+            return S3BackupStore(url.netloc, (prefix + '/' if prefix else '') + stack + '/', self.manager.region)
+        return LocalBackupStore(os.path.join(url.path if url.scheme == 'file' else self.TARGET, stack))
+
+    @classmethod
+    def compress(cls, chunks):
+        """gzip stream of given chunks, split into chunks of at least CHUNK_SIZE (except the last one)"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        buf = bytearray()
+        for chunk in chunks:
+            buf += compressor.compress(chunk)
+            if len(buf) >= cls.CHUNK_SIZE:
+                yield bytes(buf)
+                buf = bytearray()
+        buf += compressor.flush()
+        yield bytes(buf)
+
+    def take(self):
+        """Streams the snapshot of our member into the store, returns True on success"""
+        started = time.time()
+        name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(started)) + '-' + self.manager.instance_id + self.SUFFIX
+        outcome = 'failure'
+        try:
+            size = self.get_store().upload(name, self.compress(self.manager.me.get_snapshot()))
+            outcome = 'success'
+            logging.info('Backup %s (%d bytes) has been taken in %.1f seconds', name, size, time.time() - started)
+            METRICS.set('etcd_manager_backup_size_bytes', size)
+            METRICS.set('etcd_manager_backup_last_success_timestamp_seconds', time.time())
+            return True
+        except Exception:
+            logging.exception('Failed to take backup %s', name)
+            try:  # let the next attempt happen earlier than in INTERVAL
+                self.manager.me.refresh_lock('_backup_lock', self.manager.instance_id,
+                                             min(self.RETRY_INTERVAL, self.INTERVAL))
+            except Exception:
+                logging.debug('Failed to shorten backup lock', exc_info=True)
+            return False
+        finally:
+            METRICS.inc('etcd_manager_backups_total', outcome=outcome)
+            METRICS.set('etcd_manager_backup_duration_seconds', time.time() - started)
+
+    def start(self):
+        self.thread = Thread(target=self.take)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def restore(self, data_dir, initial_cluster):
+        """Creates data directory of the new cluster from the latest backup, returns False if there are no backups.
+        All members of the new cluster have to restore the same snapshot"""
+        store = self.get_store()
+        name = store.latest()
+        if not name:
+            logging.info('There are no backups to restore the new cluster from')
+            return False
+
+        logging.info('Restoring data directory from backup %s', name)
+        me = self.manager.me
+        path = data_dir.rstrip('/') + '.snapshot'
+        try:
+            with open(path + '.gz', 'w+b') as compressed:
+                store.download(name, compressed)
+                compressed.seek(0)
+                decompressor = zlib.decompressobj(31)
+                with open(path, 'wb') as f:
+                    for chunk in iter(functools.partial(compressed.read, self.CHUNK_SIZE), b''):
+                        f.write(decompressor.decompress(chunk))
+                    f.write(decompressor.flush())
+            try:
+                subprocess.check_call([self.ETCDCTL_BINARY, 'snapshot', 'restore', path, '--name', me.instance_id,
+                                       '--data-dir', data_dir, '--initial-cluster', initial_cluster,
+                                       '--initial-cluster-token', me.cloudformation_stack,
+                                       '--initial-advertise-peer-urls', me.peer_url],
+                                      env=dict(os.environ, ETCDCTL_API='3'))
+            except Exception:
+                # etcd would be started on the half-restored directory as an existing member and never restored again
+                shutil.rmtree(data_dir, ignore_errors=True)
+                raise
+        finally:
+            for f in (path, path + '.gz'):
+                if os.path.exists(f):
+                    os.remove(f)
+        return True
+
+
 class EtcdManager:
 
     ETCD_BINARY = '/bin/etcd'
     DATA_DIR = 'data'
     NAPTIME = 30
+    INVENTORY_TTL = 60  # how long EC2 instances of the region are cached
+    REGION_TIMEOUT = 10  # how long to wait for EC2 instances of the region before giving up on it
+    CONFIRMATION_TIMEOUT = 60  # how long to wait until the leader confirms changes of cluster membership
+    CLUSTER_STATE_MAX_AGE = 120  # how old the published membership may be to remove ourselves on shutdown
+    HEARTBEAT_INTERVAL = None  # etcd flags in milliseconds, derived from round-trip time to the peers unless set
+    ELECTION_TIMEOUT = None
+    SNAPSHOT_COUNT = None  # etcd defaults are used unless set
+    QUOTA_BACKEND_BYTES = None
+    REAP_INTERVAL = 1  # how often the manager checks whether etcd has exited
+    WATCHDOG_INTERVAL = 10  # seconds between liveness probes of our etcd, 0 disables the watchdog
+    WATCHDOG_FAILURES = 6  # etcd is hung when it hasn't answered that many probes in a row
+    WATCHDOG_TIMEOUT = 120  # or hasn't answered any probe for that long
+    WATCHDOG_GRACE = 300  # starting etcd may replay WAL and snapshots for a long time before it serves clients
+    WATCHDOG_KILL_TIMEOUT = 30  # SIGKILL follows SIGTERM when etcd hasn't exited within that time
+    CLUSTER_CLASS = EtcdCluster
+    IDENTITY_CACHE = None  # file with identity document and own instance tags, survives restarts of the container
 
     def __init__(self):
         self.region = None
@@ -376,26 +1393,65 @@ class EtcdManager:
         self.me = None
         self.etcd_pid = 0
         self.run_old = False
+        self.rollback = False  # upgrade has failed, run the previous version of etcd
         self._access_granted = False
+        self._inventory = {}  # region -> (expiration time, {instance_id: (addresses, EtcdMember)})
+        self._inventory_lock = Lock()  # is never held while waiting for EC2
+        self._invalidated = 0  # results of EC2 queries started before are stale
+        self._discovery = {}  # region -> (start time, future) of the running EC2 query
+        self.incomplete_regions = set()  # regions whose EC2 instances are missing or stale after the last refresh
+        self._discovery_executor = None
+        self._identity = {}  # content of the IDENTITY_CACHE
+        self.cluster_state = ClusterState()  # shared with HouseKeeper
+        self.backup = Backup(self)
+        self.scheduler = Scheduler(self.NAPTIME)
+
+    def read_identity_cache(self):
+        if self.IDENTITY_CACHE and os.path.exists(self.IDENTITY_CACHE):
+            try:
+                with open(self.IDENTITY_CACHE) as f:
+                    return json.load(f)
+            except Exception:
+                logging.exception('Failed to read %s', self.IDENTITY_CACHE)
+        return {}
+
+    def write_identity_cache(self, instance):
+        if not self.IDENTITY_CACHE:
+            return
+        self._identity = {'document': {'region': self.region, 'instanceId': self.instance_id},
+                          'instance': {f: getattr(instance, f) for f in CachedInstance._fields}}
+        tmp = self.IDENTITY_CACHE + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._identity, f)
+            os.rename(tmp, self.IDENTITY_CACHE)
+        except Exception:
+            logging.exception('Failed to write %s', self.IDENTITY_CACHE)
 
     def load_my_identities(self):
-        url = 'http://169.254.169.254/latest/dynamic/instance-identity/document'
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise EtcdClusterException('GET %s: code=%s content=%s', url, response.status_code, response.content)
-        json = response.json()
+        # instance id and region can't change during the lifetime of the container, neither can its identity cache
+        self._identity = self.read_identity_cache()
+        document = self._identity.get('document') or IMDS.get('dynamic/instance-identity/document').json()
         if not EtcdCluster.is_multiregion():
-            EtcdCluster.REGIONS = [json['region']]
-        self.region = json['region']
-        self.instance_id = json['instanceId']
+            EtcdCluster.REGIONS = [document['region']]
+        self.region = document['region']
+        self.instance_id = document['instanceId']
 
     def find_my_instance(self):
         if not self.instance_id or not self.region:
             self.load_my_identities()
 
-        conn = boto3.resource('ec2', region_name=self.region)
+        # the member is replaced with the up-to-date one from EC2 inventory before etcd is started,
+        # until then only the tags are used and they can't be changed on a running instance
+        instance = self._identity.get('instance')
+        if instance and instance['id'] == self.instance_id:
+            logging.info('Using cached tags of instance %s', self.instance_id)
+            return EtcdMember(CachedInstance(**instance), self.region)
+
+        conn = AWS_CLIENTS.resource('ec2', self.region)
         for i in conn.instances.filter(Filters=[{'Name': 'instance-id', 'Values': [self.instance_id]}]):
             if i.id == self.instance_id and EtcdMember.CF_TAG in tags_to_dict(i.tags):
+                self.write_identity_cache(i)
                 return EtcdMember(i, self.region)
 
     def get_my_instance(self):
@@ -403,23 +1459,98 @@ class EtcdManager:
             self.me = self.find_my_instance()
         return self.me
 
-    def get_autoscaling_members(self):
+    def invalidate_inventory(self):
+        with self._inventory_lock:
+            self._invalidated = time.time()
+            self._inventory = {region: (0, instances) for region, (_, instances) in self._inventory.items()}
+
+    def load_region_inventory(self, region, cloudformation_stack, known_instances):
+        instances = {}
+        conn = AWS_CLIENTS.resource('ec2', region)
+        for i in conn.instances.filter(Filters=[
+                {'Name': 'tag:{}'.format(EtcdMember.CF_TAG),
+                 'Values': [cloudformation_stack]}]):
+            if i.state['Name'] == 'running':
+                addresses = (i.private_ip_address, i.public_ip_address, i.private_dns_name, i.public_dns_name)
+                if i.id in known_instances and known_instances[i.id][0] == addresses:
+                    instances[i.id] = known_instances[i.id]  # unchanged instance, no need to parse tags again
+                elif tags_to_dict(i.tags).get(EtcdMember.CF_TAG, '') == cloudformation_stack:
+                    instances[i.id] = (addresses, EtcdMember(i, region))
+        return instances
+
+    def refresh_inventory(self, cloudformation_stack):
+        """Query all regions with expired inventory concurrently. Other region which hasn't answered within
+        REGION_TIMEOUT or has failed keeps its last known inventory, is reported in `incomplete_regions`
+        and is being awaited again on the next call. Failure of our own region is raised.
+        The inventory is locked only to start queries and to store their results, never while waiting for them"""
+
+        with self._inventory_lock:
+            if not self._discovery_executor:
+                self._discovery_executor = ThreadPoolExecutor(max_workers=len(EtcdCluster.REGIONS) or 1)
+
+            now = time.time()
+            for region in EtcdCluster.REGIONS:
+                expires, instances = self._inventory.get(region, (0, {}))
+                if expires <= now and region not in self._discovery:
+                    self._discovery[region] = (now, self._discovery_executor.submit(
+                        self.load_region_inventory, region, cloudformation_stack, instances))
+            discovery = dict(self._discovery)
+
+        if discovery:
+            wait([future for _, future in discovery.values()], timeout=self.REGION_TIMEOUT)
+
+        error = None
+        with self._inventory_lock:
+            for region, (started, future) in discovery.items():
+                if not future.done():
+                    self.incomplete_regions.add(region)
+                    logging.warning('EC2 instances of %s are not loaded within %s seconds', region,
+                                    self.REGION_TIMEOUT)
+                    if region == self.region:
+                        error = EtcdClusterException('EC2 instances of {0} are not loaded within {1} seconds'.format(
+                            region, self.REGION_TIMEOUT))
+                    continue
+                if self._discovery.get(region, (None, None))[1] is not future:
+                    continue  # the result has been already taken by the concurrent call
+                del self._discovery[region]
+                try:
+                    expires = time.time() + self.INVENTORY_TTL if started >= self._invalidated else 0
+                    inventory = dict(self._inventory)  # readers use it without the lock, it is swapped, not changed
+                    inventory[region] = (expires, future.result())
+                    self._inventory = inventory
+                    self.incomplete_regions.discard(region)
+                except Exception as e:
+                    self.incomplete_regions.add(region)
+                    if region == self.region:
+                        error = e
+                    else:
+                        logging.exception('Failed to load EC2 instances of %s', region)
+        if error:
+            raise error
+
+    def get_member_region(self, etcd_member):
+        """Region of the etcd member (from `/v2/members`), None if it can't be determined"""
+        for region, (_, instances) in list(self._inventory.items()):
+            if etcd_member.get('name') in instances:
+                return region
+        return EtcdMember.get_region_from_urls(etcd_member['peerURLs'])
+
+    def get_autoscaling_members(self, refresh=True):
         me = self.get_my_instance()
         members = []
+        if refresh:
+            self.refresh_inventory(me.cloudformation_stack)
+        with self._inventory_lock:
+            inventory = self._inventory
         for region in EtcdCluster.REGIONS:
-            conn = boto3.resource('ec2', region_name=region)
-            for i in conn.instances.filter(Filters=[
-                    {'Name': 'tag:{}'.format(EtcdMember.CF_TAG),
-                     'Values': [me.cloudformation_stack]}]):
-                if (i.state['Name'] == 'running' and
-                        tags_to_dict(i.tags).get(EtcdMember.CF_TAG, '') == me.cloudformation_stack):
-                    m = EtcdMember(i, region)
-                    if self.region == region or m.public_ip_address:
-                        members.append(m)
+            instances = inventory.get(region, (0, {}))[1]
+            for instance_id in sorted(instances):
+                m = instances[instance_id][1]
+                if self.region == region or m.public_ip_address:
+                    members.append(copy.copy(m))  # callers are updating members with information from etcd
 
         if not self._access_granted:
-            me.adjust_security_groups('authorize_ingress', *members)
-            self._access_granted = True
+            self._access_granted = me.adjust_security_groups('authorize_ingress', *members)
         return members
 
     def clean_data_dir(self):
@@ -437,6 +1568,67 @@ class EtcdManager:
         except Exception:
             logging.exception('Can not remove %s', path)
 
+    def wait_for_membership(self, cluster, condition, description):
+        """Polls the list of members from the leader (or accessible member) with backoff
+        until `condition(members)` is satisfied or CONFIRMATION_TIMEOUT is exceeded"""
+
+        member = ([m for m in cluster.members if m.id == cluster.leader_id and m.client_urls and
+                   m.instance_id != self.me.instance_id] or [cluster.accessible_member])[0]
+        scheduler = Scheduler(5, min_interval=0.5)
+        deadline = time.time() + self.CONFIRMATION_TIMEOUT
+        while True:
+            try:
+                if condition(member.get_members()):
+                    logging.info('Confirmed that I am %s', description)
+                    return
+            except Exception:
+                logging.exception('Failed to get members from %s', member.name or member.instance_id)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise EtcdClusterException('Cluster has not confirmed that I am {0} in {1} seconds'
+                                           .format(description, self.CONFIRMATION_TIMEOUT))
+            scheduler.failure()
+            time.sleep(min(scheduler.next_delay(), remaining))
+
+    def measure_peer_rtt(self, cluster):
+        """Round-trip time in seconds to the slowest reachable peer, None if no peer could be reached"""
+        peers = [m for m in cluster.members if m.advertise_addr and m.instance_id != self.me.instance_id]
+        if not peers:
+            return None
+        executor = ThreadPoolExecutor(max_workers=min(len(peers), EtcdCluster.MAX_PROBES))
+        try:
+            results = [rtt for rtt in executor.map(EtcdMember.measure_rtt, peers) if rtt is not None]
+        finally:
+            executor.shutdown(wait=False)
+        return max(results) if results else None
+
+    def get_etcd_settings(self, cluster):
+        """etcd recommends the heartbeat interval close to the round-trip time between members and the election
+        timeout of at least ten heartbeats. Defaults (100ms and 1s) fit a single region, members in different
+        regions need more. Settings are rounded, so that members which have measured slightly different round-trip
+        times usually come to the same values"""
+        settings = OrderedDict()
+        heartbeat, election = self.HEARTBEAT_INTERVAL, self.ELECTION_TIMEOUT
+        if not heartbeat:
+            rtt = self.measure_peer_rtt(cluster)
+            if rtt is not None:
+                METRICS.set('etcd_manager_peer_rtt_seconds', rtt)
+                heartbeat = min(max(100, int(math.ceil(rtt * 1000 * 1.5 / 50)) * 50), 5000)
+        if heartbeat:
+            settings['heartbeat-interval'] = heartbeat
+            settings['election-timeout'] = election or min(max(1000, heartbeat * 10), 50000)
+        elif election:
+            settings['election-timeout'] = election
+        if self.SNAPSHOT_COUNT:
+            settings['snapshot-count'] = self.SNAPSHOT_COUNT
+        if self.QUOTA_BACKEND_BYTES:
+            settings['quota-backend-bytes'] = self.QUOTA_BACKEND_BYTES
+
+        for name, value in settings.items():
+            METRICS.set('etcd_manager_etcd_setting', value, flag=name)
+        logging.info('etcd settings: %s', ', '.join('{}={}'.format(n, v) for n, v in settings.items()) or 'defaults')
+        return settings
+
     def register_me(self, cluster):
         cluster_state = 'existing'
         include_ec2_instances = remove_member = add_member = False
@@ -464,21 +1656,113 @@ class EtcdManager:
             if remove_member:
                 if not cluster.accessible_member.delete_member(self.me):
                     raise EtcdClusterException('Can not remove my old instance from etcd cluster')
-                time.sleep(self.NAPTIME)
+                old_id = self.me.id
+                self.wait_for_membership(cluster, lambda members: all(m['id'] != old_id for m in members),
+                                         'removed from etcd cluster')
             if add_member:
                 if not cluster.accessible_member.add_member(self.me):
                     raise EtcdClusterException('Can not register myself in etcd cluster')
-                time.sleep(self.NAPTIME)
+                self.wait_for_membership(cluster, lambda members: any(m['id'] == self.me.id for m in members),
+                                         'registered in etcd cluster')
 
-        self.run_old = add_member and cluster_state == 'existing' and not cluster.is_upgraded
+        self.run_old = self.rollback or add_member and cluster_state == 'existing' and not cluster.is_upgraded
 
         peers = ','.join(['{}={}'.format(m.instance_id or m.name, m.peer_url) for m in cluster.members
                          if (include_ec2_instances and m.instance_id) or m.peer_urls])
 
-        return self.me.etcd_arguments(self.DATA_DIR, peers, cluster_state, self.run_old)
+        if cluster_state == 'new' and self.backup.enabled and self.backup.RESTORE:  # disaster recovery
+            self.backup.restore(self.DATA_DIR, peers)
+
+        settings = self.get_etcd_settings(cluster)
+        return self.me.etcd_arguments(self.DATA_DIR, peers, cluster_state, self.run_old, settings)
+
+    def remove_me(self):
+        """Removes our member from the cluster on shutdown. The published membership together with cached EC2
+        instances is usually enough, the cluster is loaded from scratch only if the membership is unknown, too old,
+        doesn't contain us or none of the known members has accepted the removal"""
+        state = self.cluster_state.get(self.CLUSTER_STATE_MAX_AGE)
+        if state:
+            etcd_members, leader_id = state
+            members = EtcdCluster.merge_member_lists(self.get_autoscaling_members(refresh=False), etcd_members)
+            mine = [m for m in members if m.name == self.me.instance_id]
+            if mine:
+                peers = [m for m in members if m.client_urls and m.instance_id and m is not mine[0]]
+                for peer in sorted(peers, key=lambda m: m.id != leader_id):  # the leader goes first
+                    try:
+                        if peer.delete_member(mine[0]):
+                            return
+                    except Exception:
+                        logging.debug('Failed to remove myself via %s', peer.instance_id)
+                logging.warning('Known members have not removed me, loading the cluster')
 
-    def run(self):
         cluster = EtcdCluster(self)
+        cluster.load_members()
+        if cluster.accessible_member:
+            mine = [m for m in cluster.members if m.name == self.me.instance_id]
+            if mine and not cluster.accessible_member.delete_member(mine[0]):
+                logging.error('Can not remove myself from cluster')
+        else:
+            logging.error('Cluster does not have accessible member')
+
+    def etcd_alive(self):
+        """Liveness probe of our etcd via the local client port. Any answer counts, unhealthy etcd (e.g. without
+        the leader when quorum is lost) still answers and wouldn't be helped by a restart"""
+        url = EtcdMember.generate_url('127.0.0.1', self.me.client_port) + '/health'
+        try:
+            HTTP_POOL.request('get', url, timeout=EtcdMember.API_TIMEOUT)
+            return True
+        except Exception as e:
+            logging.debug('etcd has not answered liveness probe: %r', e)
+            METRICS.inc('etcd_manager_liveness_probe_failures_total')
+            return False
+
+    @staticmethod
+    def signal_etcd(pid, name):
+        METRICS.inc('etcd_manager_watchdog_signals_total', signal=name)
+        try:
+            os.kill(pid, getattr(signal, name))
+        except OSError as e:
+            if e.errno != errno.ESRCH:  # has exited meanwhile
+                raise
+
+    def supervise(self, pid):
+        """Waits until etcd exits and returns its status. Meanwhile it is probed, when it has not answered
+        WATCHDOG_FAILURES probes in a row or for WATCHDOG_TIMEOUT seconds after WATCHDOG_GRACE it is considered
+        hung and terminated, SIGKILL follows if SIGTERM wasn't enough within WATCHDOG_KILL_TIMEOUT"""
+        started = time.time()
+        last_answer = started + self.WATCHDOG_GRACE  # failed probes don't count until then
+        next_probe = started + self.WATCHDOG_INTERVAL
+        failures = 0
+        terminated = killed = None
+        while True:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if wpid == pid:
+                return status
+
+            now = time.time()
+            if terminated:
+                if not killed and now - terminated >= self.WATCHDOG_KILL_TIMEOUT:
+                    logging.error('etcd (pid %s) has not exited within %s seconds, killing it',
+                                  pid, self.WATCHDOG_KILL_TIMEOUT)
+                    self.signal_etcd(pid, 'SIGKILL')
+                    killed = now
+            elif self.WATCHDOG_INTERVAL and now >= next_probe:
+                if self.etcd_alive():
+                    failures = 0
+                    last_answer = now
+                elif last_answer <= now:  # grace is over or etcd has already answered
+                    failures += 1
+                now = time.time()
+                next_probe = now + self.WATCHDOG_INTERVAL
+                if failures >= self.WATCHDOG_FAILURES or failures and now - last_answer >= self.WATCHDOG_TIMEOUT:
+                    logging.error('etcd (pid %s) has not answered %s liveness probes in a row, terminating it',
+                                  pid, failures)
+                    self.signal_etcd(pid, 'SIGTERM')
+                    terminated = now
+            time.sleep(self.REAP_INTERVAL)
+
+    def run(self):
+        cluster = self.CLUSTER_CLASS(self)
         while True:
             try:
                 cluster.load_members()
@@ -493,21 +1777,79 @@ class EtcdManager:
                     if self.etcd_pid == 0:
                         os.execv(binary, [binary] + args)
 
+                    started = time.time()
+                    METRICS.inc('etcd_manager_etcd_starts_total')
                     logging.info('Started new %s process with pid: %s and args: %s', binary, self.etcd_pid, args)
-                    pid, status = os.waitpid(self.etcd_pid, 0)
-                    logging.warning('Process %s finished with exit code %s', pid, status >> 8)
+                    status = self.supervise(self.etcd_pid)
+                    logging.warning('Process %s finished with exit code %s', self.etcd_pid, status >> 8)
+                    METRICS.inc('etcd_manager_etcd_exits_total', code=status >> 8)
                     self.etcd_pid = 0
+                    self.invalidate_inventory()
+                    if time.time() - started > self.NAPTIME:
+                        self.scheduler.success()  # etcd was running fine, restart it as fast as possible
+                self.scheduler.failure()  # etcd has terminated or the cluster is not ready to accept us yet
             except SystemExit:
                 break
-            except Exception:
+            except Exception as e:
                 logging.exception('Exception in main loop')
-            logging.warning('Sleeping %s seconds before next try...', self.NAPTIME)
-            time.sleep(self.NAPTIME)
+                AWS_CLIENTS.check_error(e)
+                self.scheduler.failure()
+            logging.warning('Sleeping %.1f seconds before next try...', self.scheduler.wait())
+
+
+class MembershipWatcher(Thread):
+    """etcd v2 doesn't allow to watch on cluster membership, but the leader immediately reflects added, removed
+    and failing followers in its `stats/leader`. Polling this small document is much cheaper than a full
+    housekeeping pass, therefore we do it often and call the `callback` only when something has changed.
+    With v3 client API only added and removed members are noticed, see `EtcdMember.get_followers`"""
+
+    INTERVAL = 2
+
+    def __init__(self, manager, callback):
+        super(MembershipWatcher, self).__init__()
+        self.daemon = True
+        self.manager = manager
+        self.callback = callback
+        self._followers = None  # follower id -> number of failed heartbeats
+        self._failing = set()
+
+    def check(self):
+        followers = self.manager.me.get_followers() if self.manager.etcd_pid != 0 and self.manager.me else None
+        if followers is None:  # we are not the leader
+            self._followers = None
+            return False
+
+        failing = {i for i, fails in followers.items() if self._followers and fails > self._followers.get(i, fails)}
+        changed = self._followers is not None and (set(followers) != set(self._followers) or failing != self._failing)
+        self._followers = followers
+        self._failing = failing
+        return changed
+
+    def run(self):
+        while True:
+            try:
+                if self.check():
+                    logging.info('Membership change detected, waking up HouseKeeper')
+                    self.callback()
+            except Exception:
+                logging.debug('Exception in MembershipWatcher', exc_info=True)
+                self._followers = None
+            time.sleep(self.INTERVAL)
 
 
 class HouseKeeper(Thread):
 
     NAPTIME = 30
+    UPGRADE_LOCK_TTL = 60  # the lock is refreshed while upgrade progresses, so it doesn't outlive a dead member
+    UPGRADE_POLL = 2  # how often progress of the upgrade is checked
+    UPGRADE_TIMEOUT = 300  # how long to wait until the upgraded member has rejoined the cluster
+    UPGRADE_ROLLBACK = False  # restart the previous version of etcd if upgrade has timed out
+    UPGRADE_PHASES = ('waiting', 'restarting', 'rolling_back', 'complete', 'rolled_back', 'failed')
+    COMPACTION_INTERVAL = 3600  # how much history of revisions is kept, 0 disables compaction
+    DEFRAG_RATIO = 0.3  # the member is defragmented when this fraction of its database is free
+    DEFRAG_MIN_BYTES = 64 * 1024 * 1024  # but not for less than that
+    DEFRAG_TIMEOUT = 300  # defragmentation blocks the member, meanwhile the storage lock is held
+    DEFAULT_QUOTA_BACKEND_BYTES = 2 * 1024 * 1024 * 1024
 
     def __init__(self, manager, hosted_zone):
         super(HouseKeeper, self).__init__()
@@ -518,127 +1860,491 @@ class HouseKeeper(Thread):
             self.hosted_zone = hosted_zone.rstrip('.') + '.'
         self.members = {}
         self.unhealthy_members = {}
+        self.hosted_zone_id = None
+        self.route53_records = {}  # (name, type) -> resource records published by us
+        self.update_required = False  # the last reconciliation has failed and must be repeated
+        self.compaction = None  # (time, revision) when the history was compacted last time
+        self.watcher = MembershipWatcher(manager, self.on_membership_change)
+        self.scheduler = Scheduler(self.NAPTIME, max_interval=self.NAPTIME * 4)
+
+    def start(self):
+        self.watcher.start()
+        super(HouseKeeper, self).start()
+
+    def on_membership_change(self):
+        self.manager.invalidate_inventory()
+        self.scheduler.wake_up()  # scheduled polling is a fallback for missed membership changes
 
     def is_leader(self):
         return self.manager.me.is_leader()
 
+    @staticmethod
+    def lock_outcome(lock, acquired):
+        METRICS.inc('etcd_manager_lock_acquisitions_total', lock=lock, outcome='acquired' if acquired else 'busy')
+        return acquired
+
+    def take_lock(self, key, ttl, lock):
+        return self.lock_outcome(lock, self.manager.me.take_lock(key, self.manager.instance_id, ttl))
+
     def acquire_lock(self):
-        data = {'value': self.manager.instance_id, 'ttl': self.NAPTIME, 'prevExist': False}
-        return self.manager.me.api_put('keys/_self_maintenance_lock', data=data) is not None
+        return self.take_lock('_self_maintenance_lock', self.NAPTIME, 'maintenance')
 
     def take_upgrade_lock(self, ttl):
-        data = {'value': self.manager.instance_id, 'ttl': ttl, 'prevExist': False}
-        return self.manager.me.api_put('keys/_upgrade_lock', data=data) is not None
+        return self.take_lock('_upgrade_lock', ttl, 'upgrade')
+
+    def take_backup_lock(self):
+        return self.take_lock('_backup_lock', Backup.INTERVAL, 'backup')
 
-    def release_upgrade_lock(self):
-        return self.manager.me.api_delete('keys/_upgrade_lock', data={'value': self.manager.instance_id})
+    def refresh_upgrade_lock(self, member, ttl):
+        member.refresh_lock('_upgrade_lock', self.manager.instance_id, ttl)
+
+    def release_upgrade_lock(self, member=None):
+        return (member or self.manager.me).release_lock('_upgrade_lock', self.manager.instance_id)
 
     def check_upgrade_lock(self):
-        return self.manager.me.api_get('keys/_upgrade_lock') is not None
+        return self.manager.me.lock_exists('_upgrade_lock')
 
-    def members_changed(self):
+    def members_changed(self, new_members=None):
         old_members = self.members.copy()
-        new_members = self.manager.me.get_members()
+        if new_members is None:
+            new_members = self.manager.me.get_members()
         if all(old_members.pop(m['id'], None) == m for m in new_members) and not old_members:
             return False
         self.members = {m['id']: m for m in new_members}
+        self.manager.invalidate_inventory()
         return True
 
-    def cluster_unhealthy(self):
-        process = subprocess.Popen([self.manager.ETCD_BINARY + 'ctl', 'cluster-health'],
-                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env={'ETCDCTL_API': '2'})
-        ret = any('unhealthy' in line or 'unreachable' in line for line in map(str, process.stdout))
-        process.wait()
+    @staticmethod
+    def check_member_health(member):
+        for url in member['clientURLs']:
+            start = time.time()
+            try:
+                response = HTTP_POOL.request('get', url.rstrip('/') + '/health', timeout=EtcdMember.API_TIMEOUT)
+                latency = time.time() - start
+                healthy = response.status_code == 200 and response.json().get('health') in (True, 'true')
+                return MemberHealth(member['id'], member['name'], url, True, healthy, latency)
+            except Exception as e:
+                logging.debug('Failed to check health of member %s via %s: %r', member['id'], url, e)
+        return MemberHealth(member['id'], member['name'], None, False, False, None)
+
+    def check_cluster_health(self, members=None):
+        """Probes health endpoints of all members concurrently and returns list of `MemberHealth`"""
+        if members is None:
+            members = self.manager.me.get_members()
+        if not members:
+            return []
+
+        executor = ThreadPoolExecutor(max_workers=min(len(members), EtcdCluster.MAX_PROBES))
+        try:
+            futures = [executor.submit(self.check_member_health, m) for m in members]
+            wait(futures, timeout=EtcdMember.API_TIMEOUT * 2)
+        finally:
+            executor.shutdown(wait=False)
+        return [f.result() if f.done() else MemberHealth(m['id'], m['name'], None, False, False, None)
+                for m, f in zip(members, futures)]
+
+    def get_status(self):
+        """Takes `ClusterStatus`: leader state, membership and the upgrade lock are fetched concurrently,
+        members are probed as soon as the membership is known. Followers skip the probes unless upgrading"""
+        me = self.manager.me
+        executor = ThreadPoolExecutor(max_workers=3)
+        try:
+            tasks = (self.is_leader, me.get_members, self.check_upgrade_lock)
+            leader, members, lock = [executor.submit(f) for f in tasks]
+            is_leader, members = leader.result(), members.result()
+            health = self.check_cluster_health(members) if is_leader or self.manager.run_old else []
+            return ClusterStatus(is_leader, members, health, lock.result())
+        finally:
+            executor.shutdown(wait=False)
+
+    def cluster_unhealthy(self, members=None, results=None):
+        if results is None:
+            results = self.check_cluster_health(members)
+        for r in results:
+            if not r.healthy:
+                logging.warning('member %s (%s) is %s', r.id, r.name, 'unhealthy' if r.reachable else 'unreachable')
+        return not results or not all(r.healthy for r in results)
+
+    def remove_unhealthy_members(self, autoscaling_members, index=None):
+        """Removes members without EC2 instances. EC2 instances of incomplete regions aren't known,
+        therefore members which could belong to these regions are left alone"""
+        index = index or PeerIndex(autoscaling_members)
+        incomplete = set(self.manager.incomplete_regions)
+        for etcd_member in self.members.values():
+            if index.find(etcd_member['peerURLs']):
+                continue
+            if incomplete and self.manager.get_member_region(etcd_member) not in set(EtcdCluster.REGIONS) - incomplete:
+                logging.warning('Not removing member %s (%s): EC2 instances of %s are not known',
+                                etcd_member['id'], etcd_member['name'], ', '.join(sorted(incomplete)))
+                continue
+            if self.manager.me.delete_member(EtcdMember(etcd_member)):
+                METRICS.inc('etcd_manager_members_removed_total')
+
+    def get_hosted_zone_id(self, conn):
+        if not self.hosted_zone_id:
+            zones = conn.list_hosted_zones_by_name(DNSName=self.hosted_zone)
+            zone = ([z for z in zones['HostedZones'] if z['Name'] == self.hosted_zone] or [None])[0]
+            if not zone:
+                raise Exception('Failed to find hosted_zone {}'.format(self.hosted_zone))
+            self.hosted_zone_id = zone['Id']
+        return self.hosted_zone_id
+
+    def update_route53_records(self, autoscaling_members, index=None):
+        stack_version = self.manager.me.cloudformation_stack.split('-')[-1]
+
+        index = index or PeerIndex(autoscaling_members)
+        matched = {m for etcd_member in self.members.values() for m in index.find_all(etcd_member['peerURLs'])}
+        members = [m for m in autoscaling_members if m in matched]
+
+        records = OrderedDict()
+        record_name = '_etcd-server._tcp.{}.{}'.format(stack_version, self.hosted_zone)
+        records[(record_name, 'SRV')] = [{'Value': ' '.join(map(str, [1, 1, i.peer_port, i.dns]))} for i in members]
+        record_name = '_etcd-client._tcp.{}.{}'.format(stack_version, self.hosted_zone)
+        records[(record_name, 'SRV')] = [{'Value': ' '.join(map(str, [1, 1, i.client_port, i.dns]))} for i in members]
+        record_name = 'etcd-server.{}.{}'.format(stack_version, self.hosted_zone)
+        records[(record_name, 'A')] = [{'Value': i.addr} for i in members]
+
+        changes = [{'Action': 'UPSERT',
+                    'ResourceRecordSet': {'Name': name, 'Type': rtype, 'TTL': 60, 'ResourceRecords': value}}
+                   for (name, rtype), value in records.items() if self.route53_records.get((name, rtype)) != value]
+        if not changes:
+            logging.debug('Route53 records are up to date')
+            return
+
+        conn = AWS_CLIENTS.client('route53', self.manager.region)
+        try:
+            conn.change_resource_record_sets(HostedZoneId=self.get_hosted_zone_id(conn),
+                                             ChangeBatch={'Changes': changes})
+        except Exception:
+            self.hosted_zone_id = None  # hosted zone could have been recreated
+            raise
+        self.route53_records.update(records)
+
+    def reconcile(self):
+        """Removes members without EC2 instances and updates DNS records, returns False if nothing was done"""
+        autoscaling_members = self.manager.get_autoscaling_members()
+        if not autoscaling_members:
+            return False
+        index = PeerIndex(autoscaling_members)
+        self.remove_unhealthy_members(autoscaling_members, index)
+        self.update_route53_records(autoscaling_members, index)
+        return True
+
+    def reconciliation_required(self, status):
+        changed = self.members_changed(status.members)
+        unhealthy = self.cluster_unhealthy(results=status.health)
+        return (self.update_required or changed or unhealthy) and not status.upgrade_locked
+
+    def get_storage_status(self, members, prefix):
+        """Returns member id -> response of maintenance/status, None for members which haven't answered"""
+        executor = ThreadPoolExecutor(max_workers=min(len(members), EtcdCluster.MAX_PROBES))
+        try:
+            futures = [executor.submit(m.api_v3, 'maintenance/status', None, prefix) for m in members]
+            wait(futures, timeout=EtcdMember.API_TIMEOUT * 2)
+        finally:
+            executor.shutdown(wait=False)
+
+        ret = {}
+        self.clear_storage_metrics()
+        for m, f in zip(members, futures):
+            ret[m.id] = f.result() if f.done() and not f.exception() else None
+            if ret[m.id]:
+                METRICS.set('etcd_manager_db_size_bytes', int(ret[m.id].get('dbSize', 0)), member=m.name)
+                if 'dbSizeInUse' in ret[m.id]:
+                    METRICS.set('etcd_manager_db_size_in_use_bytes', int(ret[m.id]['dbSizeInUse']), member=m.name)
         return ret
 
-    def remove_unhealthy_members(self, autoscaling_members):
-        for etcd_member in self.members.values():
-            for ec2_member in autoscaling_members:
-                if ec2_member.addr_matches(etcd_member['peerURLs']):
-                    break
-            else:
-                self.manager.me.delete_member(EtcdMember(etcd_member))
-
-    def update_record(self, conn, zone_id, rtype, rname, new_value):
-        conn.change_resource_record_sets(
-            HostedZoneId=zone_id,
-            ChangeBatch={
-                'Changes': [
-                    {
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': rname,
-                            'Type': rtype,
-                            'TTL': 60,
-                            'ResourceRecords': new_value,
-                        }
-                    }
-                ]
-            }
-        )
+    @staticmethod
+    def clear_storage_metrics():
+        METRICS.clear('etcd_manager_db_size_bytes')
+        METRICS.clear('etcd_manager_db_size_in_use_bytes')
+
+    def compaction_revision(self, revision, alarms):
+        """Compaction keeps COMPACTION_INTERVAL of history: every interval the history is compacted up to the
+        revision seen at the previous compaction. When space has run out all history is dropped immediately"""
+        if not self.COMPACTION_INTERVAL:
+            return None
+        if self.compaction is None:
+            self.compaction = (time.time(), revision)
+            return revision if alarms else None
+        if alarms or time.time() - self.compaction[0] >= self.COMPACTION_INTERVAL:
+            return self.compaction[1]
+
+    def defragmentation_candidate(self, members, storage, alarms, leader):
+        for m in sorted(members, key=lambda m: m is leader):  # followers first, the leader last
+            status = storage.get(m.id)
+            if status:
+                size = int(status.get('dbSize', 0))
+                free = size - int(status.get('dbSizeInUse', size))
+                if m.id in alarms or free >= max(self.DEFRAG_MIN_BYTES, size * self.DEFRAG_RATIO):
+                    return m
+
+    def compact(self, leader, compact_revision, revision, prefix):
+        logging.info('Compacting history of revisions up to %s', compact_revision)
+        try:
+            leader.api_v3('kv/compaction', {'revision': compact_revision}, prefix)
+            METRICS.inc('etcd_manager_compactions_total')
+        except EtcdClusterException as e:
+            if 'compacted' not in str(e):
+                raise
+            logging.info('Revision %s has been compacted already', compact_revision)
+        self.compaction = (time.time(), revision)
+
+    def defragment(self, member, alarms, leader, prefix):
+        logging.info('Defragmenting member %s (%s)', member.id, member.name)
+        started = time.time()
+        try:
+            member.api_v3('maintenance/defragment', None, prefix, self.DEFRAG_TIMEOUT)
+        except Exception:
+            METRICS.inc('etcd_manager_defragmentations_total', outcome='failure')
+            raise
+        METRICS.inc('etcd_manager_defragmentations_total', outcome='success')
+        logging.info('Member %s has been defragmented in %.1f seconds', member.id, time.time() - started)
+
+        if member.id in alarms:
+            size = int(member.api_v3('maintenance/status', None, prefix).get('dbSize', 0))
+            if size < (EtcdManager.QUOTA_BACKEND_BYTES or self.DEFAULT_QUOTA_BACKEND_BYTES) * 0.9:
+                leader.api_v3('maintenance/alarm', {'action': 'DEACTIVATE', 'alarm': 'NOSPACE',
+                                                    'memberID': str(int(member.id, 16))}, prefix)
+                METRICS.inc('etcd_manager_alarms_disarmed_total')
+                logging.warning('NOSPACE alarm of member %s has been disarmed', member.id)
+
+    def maintain_storage(self, status):
+        """Compacts the history of revisions and defragments one member per pass, only while all members are
+        healthy. NOSPACE alarm is disarmed as soon as the alarmed member has got enough space back. Works via
+        grpc-gateway and only on etcd >= 3.3, returns True if nothing had to be done"""
+        members = EtcdCluster.merge_member_lists(self.manager.get_autoscaling_members(refresh=False), status.members)
+        members = [m for m in members if m.id and m.client_urls and m.instance_id]
+        leader = ([m for m in members if m.instance_id == self.manager.instance_id] or [None])[0]
+        if not leader:
+            return True
+        try:
+            prefix = leader.get_v3_prefix()
+        except EtcdClusterException:
+            return True  # etcd 2.x
 
-    def update_route53_records(self, autoscaling_members):
-        conn = boto3.client('route53', region_name=self.manager.region)
-        zones = conn.list_hosted_zones_by_name(DNSName=self.hosted_zone)
-        zone = ([z for z in zones['HostedZones'] if z['Name'] == self.hosted_zone] or [None])[0]
-        if not zone:
-            raise Exception('Failed to find hosted_zone {}'.format(self.hosted_zone))
-        zone_id = zone['Id']
+        storage = self.get_storage_status(members, prefix)
+        if not storage[leader.id]:
+            return True
+        alarms = {EtcdMember.format_id(a['memberID'])
+                  for a in leader.api_v3('maintenance/alarm', {'action': 'GET'}, prefix).get('alarms') or []
+                  if a.get('alarm') == 'NOSPACE'}
+        if alarms:
+            logging.warning('NOSPACE alarm is raised for members: %s', ', '.join(sorted(alarms)))
+
+        revision = int(storage[leader.id]['header']['revision'])
+        compact_revision = self.compaction_revision(revision, alarms)
+        member = self.defragmentation_candidate(members, storage, alarms, leader) \
+            if status.healthy and not status.upgrade_locked else None
+        # writes are rejected while the alarm is raised, the lock can't be taken then
+        if compact_revision is None and member is None or \
+                not alarms and not self.take_lock('_storage_maintenance_lock', self.DEFRAG_TIMEOUT, 'storage'):
+            return True
+        try:
+            if compact_revision is not None:
+                self.compact(leader, compact_revision, revision, prefix)
+            if member:
+                self.defragment(member, alarms, leader, prefix)
+        finally:
+            if not alarms:
+                self.manager.me.release_lock('_storage_maintenance_lock', self.manager.instance_id)
+        return False
 
-        stack_version = self.manager.me.cloudformation_stack.split('-')[-1]
+    def leader_tick(self, status):
+        idle = True
+        if self.reconciliation_required(status) and self.acquire_lock():
+            self.update_required = True
+            self.update_required = not self.reconcile()
+            idle = False
+        return self.maintain_storage(status) and idle
 
-        members = []
-        for ec2_member in autoscaling_members:
-            for etcd_member in self.members.values():
-                if ec2_member.addr_matches(etcd_member['peerURLs']):
-                    members.append(ec2_member)
-                    break
+    def follower_tick(self, status=None):
+        self.members = {}
+        self.route53_records = {}  # records could be changed by the leader
+        self.update_required = False
+        self.compaction = None
+        self.clear_storage_metrics()  # are exported by the leader only
+        if status and self.manager.run_old and not self.manager.rollback:
+            self.upgrade(status)
+            return False  # still waiting for the upgrade turn or has just been upgraded, don't back off
+        return True
 
-        record_name = '_etcd-server._tcp.{}.{}'.format(stack_version, self.hosted_zone)
-        new_record = [{'Value': ' '.join(map(str, [1, 1, i.peer_port, i.dns]))} for i in members]
-        self.update_record(conn, zone_id, 'SRV', record_name, new_record)
+    def start_backup(self, status):
+        """The backup lock expires after Backup.INTERVAL, whoever takes it next takes the backup. Followers are
+        preferred to keep the load off the leader. While some member hasn't started yet (e.g. the new cluster is
+        being restored from the latest backup) or members are being upgraded backups are not taken"""
+        backup = self.manager.backup
+        if backup.enabled and backup.covers_data() and not backup.running and not status.upgrade_locked \
+                and (not status.is_leader or len(status.members) == 1) \
+                and status.members and all(m['clientURLs'] for m in status.members) and self.take_backup_lock():
+            backup.start()
+
+    def report_upgrade(self, phase):
+        logging.info('upgrade of member %s: %s', self.manager.instance_id, phase)
+        for p in self.UPGRADE_PHASES:
+            METRICS.set('etcd_manager_upgrade_phase', int(p == phase), phase=p)
+
+    def cluster_healthy(self, members):
+        """Quiet version of `not cluster_unhealthy()`, other members are expected to be down during upgrades"""
+        results = self.check_cluster_health(members)
+        return bool(results) and all(r.healthy for r in results)
+
+    def wait_for_upgrade_turn(self, status=None):
+        """Takes the upgrade lock as soon as the cluster is healthy and no other member is being upgraded,
+        gives up after NAPTIME. Upgrade of other member is usually over within seconds. The first attempt
+        is decided from the `status` of the current pass if given"""
+        deadline = time.time() + self.NAPTIME
+        while True:
+            if status:
+                healthy = status.healthy and not status.upgrade_locked
+                status = None
+            else:
+                healthy = self.cluster_healthy(self.manager.me.get_members())
+            if healthy and self.take_upgrade_lock(self.UPGRADE_LOCK_TTL):
+                return True
+            if time.time() + self.UPGRADE_POLL > deadline:
+                return False
+            time.sleep(self.UPGRADE_POLL)
 
-        record_name = '_etcd-client._tcp.{}.{}'.format(stack_version, self.hosted_zone)
-        new_record = [{'Value': ' '.join(map(str, [1, 1, i.client_port, i.dns]))} for i in members]
-        self.update_record(conn, zone_id, 'SRV', record_name, new_record)
+    def member_rejoined(self, peers):
+        """Our restarted etcd is registered in the cluster, serves clients and all members are healthy"""
+        for peer in peers:
+            try:
+                members = peer.get_members()
+            except Exception:
+                continue
+            if members:
+                me = [m for m in members if m['name'] == self.manager.instance_id]
+                return bool(me and me[0]['clientURLs']) and self.cluster_healthy(members)
+        return False
 
-        new_record = [{'Value': i.addr} for i in members]
-        self.update_record(conn, zone_id, 'A', 'etcd-server.{}.{}'.format(stack_version, self.hosted_zone), new_record)
+    def restart_member(self, peers, phase):
+        """Restarts etcd, the main loop decides which binary to start. Returns True when it has rejoined the cluster
+        within UPGRADE_TIMEOUT. Meanwhile our etcd can't be used, so the lock is kept alive through other members"""
+        pid = self.manager.etcd_pid
+        deadline = time.time() + self.UPGRADE_TIMEOUT
+        refreshed = time.time()
+        self.report_upgrade(phase)
+        # etcd may not be running, e.g. the upgraded one has failed to start. kill(0) would signal our process group
+        if pid != 0:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:  # has exited meanwhile
+                    raise
+        while time.time() < deadline:
+            time.sleep(self.UPGRADE_POLL)
+            if time.time() - refreshed > self.UPGRADE_LOCK_TTL / 3.0:
+                for peer in peers:
+                    try:
+                        self.refresh_upgrade_lock(peer, self.UPGRADE_LOCK_TTL)
+                        refreshed = time.time()
+                        break
+                    except Exception:
+                        logging.debug('Failed to refresh upgrade lock via %s', peer.instance_id)
+            if self.manager.etcd_pid not in (0, pid) and self.member_rejoined(peers):
+                return True
+        return False
+
+    def upgrade(self, status=None):
+        """Upgrades this member. Upgrade is over as soon as the member has rejoined the cluster and all members
+        are healthy, the lock is released immediately so that the next member can proceed"""
+        if not self.wait_for_upgrade_turn(status):
+            self.report_upgrade('waiting')
+            return
+
+        peers = [m for m in self.manager.get_autoscaling_members() if m.instance_id != self.manager.instance_id]
+        started = time.time()
+        METRICS.set('etcd_manager_upgrade_in_progress', 1)
+        try:
+            if self.restart_member(peers, 'restarting'):
+                outcome = 'complete'
+            elif self.UPGRADE_ROLLBACK:
+                logging.error('upgrade: member has not rejoined the cluster in %s seconds', self.UPGRADE_TIMEOUT)
+                self.manager.rollback = True
+                outcome = 'rolled_back' if self.restart_member(peers, 'rolling_back') else 'failed'
+            else:
+                outcome = 'failed'
+        finally:
+            METRICS.set('etcd_manager_upgrade_in_progress', 0)
+
+        METRICS.inc('etcd_manager_upgrades_total', outcome=outcome)
+        self.report_upgrade(outcome)
+        if outcome == 'failed':
+            logging.error('upgrade: giving up after %.0f seconds...', time.time() - started)
+            return  # the lock expires on its own, meanwhile the unhealthy cluster is holding off other members
+        logging.info('upgrade: %s in %.1f seconds, removing upgrade lock', outcome, time.time() - started)
+        for member in [self.manager.me] + peers:
+            try:
+                self.release_upgrade_lock(member)
+                break
+            except Exception:
+                logging.debug('Failed to release upgrade lock via %s', member.instance_id)
+
+    def tick(self):
+        """One housekeeping pass, returns True if nothing had to be done"""
+        status = self.get_status() if self.manager.etcd_pid != 0 else None
+        if status:
+            self.manager.cluster_state.publish(status.members, self.manager.me.id if status.is_leader else None)
+            self.start_backup(status)
+        if status and status.is_leader:
+            return self.leader_tick(status)
+        return self.follower_tick(status)
 
     def run(self):
-        update_required = False
         while True:
+            started = time.time()
             try:
-                if self.manager.etcd_pid != 0 and self.is_leader():
-                    if (update_required or self.members_changed() or self.cluster_unhealthy()) \
-                            and not self.check_upgrade_lock() and self.acquire_lock():
-                        update_required = True
-                        autoscaling_members = self.manager.get_autoscaling_members()
-                        if autoscaling_members:
-                            self.remove_unhealthy_members(autoscaling_members)
-                            self.update_route53_records(autoscaling_members)
-                            update_required = False
+                idle = self.tick()
+                if self.update_required:
+                    self.scheduler.failure()
                 else:
-                    self.members = {}
-                    update_required = False
-                    if self.manager.etcd_pid != 0 and self.manager.run_old \
-                            and not self.cluster_unhealthy() and self.take_upgrade_lock(600):
-                        logging.info('Performing upgrade of member %s', self.manager.me.name)
-                        os.kill(self.manager.etcd_pid, signal.SIGTERM)
-                        for _ in range(0, 59):
-                            time.sleep(10)
-                            if self.cluster_unhealthy():
-                                logging.info('upgrade: cluster is unhealthy...')
-                            else:
-                                logging.info('upgrade complete, removing upgrade lock')
-                                self.release_upgrade_lock()
-                                break
-                        else:
-                            logging.error('upgrade: giving up...')
-            except Exception:
+                    self.scheduler.success(idle)
+            except Exception as e:
                 logging.exception('Exception in HouseKeeper main loop')
-            logging.debug('Sleeping %s seconds...', self.NAPTIME)
-            time.sleep(self.NAPTIME)
+                AWS_CLIENTS.check_error(e)
+                self.scheduler.failure()
+            METRICS.observe('etcd_manager_housekeeper_tick_duration_seconds', time.time() - started)
+            self.scheduler.wait()
+
+
+class AsyncHouseKeeper(HouseKeeper):
+    """Runs independent steps of the pass concurrently: requests of the status snapshot, EC2 discovery with
+    taking the maintenance lock, removal of stale members with the update of DNS records"""
+
+    def __init__(self, manager, hosted_zone):
+        super(AsyncHouseKeeper, self).__init__(manager, hosted_zone)
+        self.tasks = AsyncTasks(self.NAPTIME)
+
+    def get_status(self):
+        return self.tasks.run(self.get_status_async)
+
+    async def get_status_async(self):
+        call = self.tasks.call
+        leader, members, lock = call(self.is_leader), call(self.manager.me.get_members), call(self.check_upgrade_lock)
+        is_leader, members = await leader, await members
+        health = await call(self.check_cluster_health, members) if is_leader or self.manager.run_old else []
+        return ClusterStatus(is_leader, members, health, await lock)
+
+    def leader_tick(self, status):
+        idle = self.tasks.run(self.leader_tick_async, status)
+        return self.maintain_storage(status) and idle
+
+    async def leader_tick_async(self, status):
+        if not self.reconciliation_required(status):  # invalidates the inventory, must happen before discovery
+            return True
+        call = self.tasks.call
+        discovery = call(self.manager.get_autoscaling_members)
+        if not await call(self.acquire_lock):
+            return True
+        self.update_required = True
+        autoscaling_members = await discovery
+        if autoscaling_members:
+            index = PeerIndex(autoscaling_members)
+            await self.tasks.gather(call(self.remove_unhealthy_members, autoscaling_members, index),
+                                    call(self.update_route53_records, autoscaling_members, index))
+            self.update_required = False
+        return False
 
 
 __ignore_sigterm = False
@@ -657,25 +2363,51 @@ def main():
     hosted_zone = os.environ.get('HOSTED_ZONE', None)
     if os.environ.get('ACTIVE_REGIONS', '') != '':
         EtcdCluster.REGIONS = os.environ.get('ACTIVE_REGIONS').split(',')
+    if os.environ.get('INVENTORY_TTL', '') != '':
+        EtcdManager.INVENTORY_TTL = int(os.environ['INVENTORY_TTL'])
+    if os.environ.get('UPGRADE_TIMEOUT', '') != '':
+        HouseKeeper.UPGRADE_TIMEOUT = int(os.environ['UPGRADE_TIMEOUT'])
+    HouseKeeper.UPGRADE_ROLLBACK = os.environ.get('UPGRADE_ROLLBACK', '').lower() in ('1', 'true', 'on')
+    if os.environ.get('ETCD_CLIENT_API', '') in ('v2', 'v3'):
+        EtcdMember.CLIENT_API = os.environ['ETCD_CLIENT_API']
+    EtcdMember.ENABLE_V2 = os.environ.get('ETCD_ENABLE_V2', '').lower() not in ('0', 'false', 'off')
+    for name in ('COMPACTION_INTERVAL', 'DEFRAG_MIN_BYTES', 'DEFRAG_TIMEOUT'):
+        if os.environ.get(name, '') != '':
+            setattr(HouseKeeper, name, int(os.environ[name]))
+    if os.environ.get('DEFRAG_RATIO', '') != '':
+        HouseKeeper.DEFRAG_RATIO = float(os.environ['DEFRAG_RATIO'])
+    for name in ('HEARTBEAT_INTERVAL', 'ELECTION_TIMEOUT', 'SNAPSHOT_COUNT', 'QUOTA_BACKEND_BYTES', 'WATCHDOG_INTERVAL',
+                 'WATCHDOG_FAILURES', 'WATCHDOG_TIMEOUT', 'WATCHDOG_GRACE', 'WATCHDOG_KILL_TIMEOUT'):
+        if os.environ.get(name, '') != '':
+            setattr(EtcdManager, name, int(os.environ[name]))
+    Backup.TARGET = os.environ.get('BACKUP_TARGET') or None
+    if os.environ.get('BACKUP_INTERVAL', '') != '':
+        Backup.INTERVAL = int(os.environ['BACKUP_INTERVAL'])
+    Backup.RESTORE = os.environ.get('BACKUP_RESTORE', '').lower() in ('1', 'true', 'on')
+    if Backup.TARGET and not Backup.covers_data():
+        logging.warning('Backups are not taken: v3 snapshots would not contain the data of v2 API clients, '
+                        'set ETCD_ENABLE_V2=off to take them')
+    EtcdManager.IDENTITY_CACHE = os.environ.get('IDENTITY_CACHE',
+                                                os.path.join(os.path.expanduser('~'), '.etcd-manager-identity.json'))
+    if os.environ.get('MANAGER_METRICS_PORT', '') != '':
+        start_metrics_server(int(os.environ['MANAGER_METRICS_PORT']))
+    house_keeper_class = HouseKeeper
+    if os.environ.get('CONTROL_PLANE', '') == 'asyncio':
+        EtcdManager.CLUSTER_CLASS = AsyncEtcdCluster
+        house_keeper_class = AsyncHouseKeeper
 
     manager = EtcdManager()
     try:
-        house_keeper = HouseKeeper(manager, hosted_zone)
+        house_keeper = house_keeper_class(manager, hosted_zone)
         house_keeper.start()
         manager.run()
     finally:
         logging.info('Trying to remove myself from cluster...')
         try:
-            cluster = EtcdCluster(manager)
-            cluster.load_members()
-            if cluster.accessible_member:
-                if [m for m in cluster.members if m.name == manager.me.instance_id]\
-                        and not cluster.accessible_member.delete_member(manager.me):
-                    logging.error('Can not remove myself from cluster')
-            else:
-                logging.error('Cluster does not have accessible member')
+            manager.remove_me()
         except Exception:
             logging.exception('Failed to remove myself from cluster')
+        HTTP_POOL.close()
 
 
 if __name__ == '__main__':
@@ -32,8 +32,7 @@ CLASSIFIERS = [
     'License :: OSI Approved :: Apache Software License',
     'Operating System :: POSIX :: Linux',
     'Programming Language :: Python',
-    'Programming Language :: Python :: 2.7',
-    'Programming Language :: Python :: 3.4',
+    'Programming Language :: Python :: 3 :: Only',
     'Programming Language :: Python :: 3.5',
     'Programming Language :: Python :: 3.6',
     'Programming Language :: Python :: Implementation :: CPython',
@@ -115,6 +114,7 @@ def setup_package():
         keywords=KEYWORDS,
         long_description=read('README.md'),
         classifiers=CLASSIFIERS,
+        python_requires='>=3.5',  # async def of the asyncio control plane
         test_suite='tests',
         packages=[],
         install_requires=get_install_requirements('requirements.txt'),
@@ -1,16 +1,17 @@
 import os
 import unittest
 
-from etcd import EtcdCluster, EtcdManager, EtcdMember
+from etcd import AWS_CLIENTS, AsyncEtcdCluster, ClusterState, EtcdCluster, EtcdManager, EtcdMember, PeerIndex
 from mock import Mock, patch
-from test_etcd_manager import requests_get, instances
+from test_etcd_manager import requests_get, instances, public_instances
 
 
 class TestEtcdCluster(unittest.TestCase):
 
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     @patch('boto3.resource')
     def setUp(self, res):
+        AWS_CLIENTS.invalidate()
         res.return_value.instances.filter.return_value = instances()
         self.manager = EtcdManager()
         self.manager.instance_id = 'i-deadbeef3'
@@ -25,9 +26,20 @@ class TestEtcdCluster(unittest.TestCase):
     def test_load_members(self, res):
         res.return_value.instances.filter.return_value = instances()
         self.assertEqual(len(self.cluster.members), 4)
-        with patch('requests.get', Mock(side_effect=Exception)):
+        with patch('requests.Session.get', Mock(side_effect=Exception)):
             self.cluster.load_members()
 
+    def test_probe_members(self):
+        self.assertEqual(EtcdCluster.probe_members([]), (None, []))
+        dead = Mock()
+        dead.get_members.side_effect = Exception
+        empty = Mock()
+        empty.get_members.return_value = []
+        alive = Mock()
+        alive.get_members.return_value = [{'id': 'ifoobari1'}]
+        self.assertEqual(EtcdCluster.probe_members([dead, empty, alive]), (alive, [{'id': 'ifoobari1'}]))
+        self.assertEqual(EtcdCluster.probe_members([dead, empty]), (None, []))
+
     def test_is_healthy(self):
         private_ip_address = '127.0.0.22'
         private_dns_name = 'ip-{}.eu-west-1.compute.internal'.format(private_ip_address.replace('.', '-'))
@@ -49,3 +61,74 @@ class TestEtcdCluster(unittest.TestCase):
         self.assertTrue(self.cluster.is_healthy(me))
         self.cluster.members.pop()
         self.assertTrue(self.cluster.is_healthy(me))
+
+
+class TestAsyncEtcdCluster(unittest.TestCase):
+
+    def setUp(self):
+        AWS_CLIENTS.invalidate()
+        self.manager = EtcdManager()
+        self.manager.instance_id = 'i-deadbeef3'
+        self.manager.region = 'eu-west-1'
+        EtcdCluster.REGIONS = ['eu-west-1']
+        self.cluster = AsyncEtcdCluster(self.manager)
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('boto3.resource')
+    def test_load_members(self, res):
+        res.return_value.instances.filter.return_value = instances()
+        self.cluster.load_members()
+        self.assertEqual(len(self.cluster.members), 4)
+        self.assertEqual(self.cluster.leader_id, 'ifoobari1')
+        self.assertEqual(self.cluster.cluster_version, '2.3.0')
+
+        with patch.object(EtcdCluster, 'probe_members', Mock(side_effect=EtcdCluster.probe_members)) as probe:
+            self.cluster.load_members()  # members known from the previous pass are probed first
+            self.assertEqual(probe.call_count, 1)
+            self.assertTrue(all(m.client_urls for m in probe.call_args[0][0]))
+        self.assertEqual(self.cluster.accessible_member.name, 'i-deadbeef1')
+
+        with patch.object(EtcdMember, 'get_leader', Mock(side_effect=Exception)):
+            self.cluster.load_members()
+        self.assertIsNone(self.cluster.leader_id)
+
+    @patch('requests.Session.get', Mock(side_effect=Exception))
+    @patch('boto3.resource')
+    def test_load_members_inaccessible(self, res):
+        res.return_value.instances.filter.return_value = instances()
+        self.cluster.load_members()
+        self.assertIsNone(self.cluster.accessible_member)
+        self.assertEqual(len(self.cluster.members), 3)
+
+
+class TestClusterState(unittest.TestCase):
+
+    def test_publish(self):
+        state = ClusterState()
+        self.assertIsNone(state.get(60))
+        members = requests_get('http://127.0.0.1:2379/v2/members').json()['members']
+        state.publish([])
+        self.assertIsNone(state.get(60))
+        state.publish(members, 'ifoobari1')
+        state.publish(members[:2])  # the leader is kept
+        self.assertEqual(state.get(60), (members[:2], 'ifoobari1'))
+        state.updated -= 61
+        self.assertIsNone(state.get(60))
+
+
+class TestPeerIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.members = [EtcdMember(i) for i in public_instances()]
+        self.index = PeerIndex(self.members)
+
+    def test_find(self):
+        self.assertIs(self.index.find(['http://ip-127-0-0-2.eu-central-1.compute.internal:2380']), self.members[4])
+        self.assertIs(self.index.find(['http://ec2-52-0-0-43.eu-west-1.compute.amazonaws.com:2380']), self.members[2])
+        self.assertIs(self.index.find(['http://127.0.0.1:2380']), self.members[0])
+        self.assertIsNone(self.index.find(['http://127.0.0.1:2379', 'foo']))
+
+    def test_find_all(self):
+        self.assertEqual(self.index.find_all(['http://127.0.0.1:2380', 'http://54.200.0.41:2380']),
+                         [self.members[0], self.members[3]])
+        self.assertEqual(self.index.find_all([]), [])
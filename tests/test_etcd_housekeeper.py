@@ -1,8 +1,11 @@
+import asyncio
+import time
 import unittest
 
-from etcd import EtcdManager, HouseKeeper
+from etcd import AWS_CLIENTS, METRICS, AsyncHouseKeeper, AsyncTasks, Backup, ClusterStatus, EtcdClusterException, \
+    EtcdManager, EtcdMember, HouseKeeper, MemberHealth, MembershipWatcher, Scheduler
 from mock import Mock, patch
-from test_etcd_manager import instances, requests_get, requests_delete, MockResponse
+from test_etcd_manager import instances, requests_get, requests_delete, requests_put_token, MockResponse
 
 
 def requests_put(url, **kwargs):
@@ -11,23 +14,13 @@ def requests_put(url, **kwargs):
     return response
 
 
-class Popen:
-
-    def __init__(self, args, **kwargs):
-        if args[1] != 'cluster-health':
-            raise Exception()
-        self.stdout = ['cluster is healthy', 'member 15a694aa6a6003f4 is healthy',
-                       'member effbc38ed2b11107 is unhealthy']
-
-    def wait(self):
-        pass
-
-
 class TestHouseKeeper(unittest.TestCase):
 
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
     @patch('boto3.resource')
     def setUp(self, res):
+        AWS_CLIENTS.invalidate()
         res.return_value.instances.filter.return_value = instances()
         self.manager = EtcdManager()
         self.manager.get_my_instance()
@@ -36,22 +29,22 @@ class TestHouseKeeper(unittest.TestCase):
         self.keeper = HouseKeeper(self.manager, 'test.')
         self.members_changed = self.keeper.members_changed()
 
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     def test_members_changed(self):
         self.assertTrue(self.members_changed)
         self.keeper.members['blabla'] = True
         self.assertTrue(self.keeper.members_changed())
         self.assertFalse(self.keeper.members_changed())
 
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     def test_is_leader(self):
         self.assertTrue(self.keeper.is_leader())
 
-    @patch('requests.put', requests_put)
+    @patch('requests.Session.put', Mock(side_effect=requests_put))
     def test_acquire_lock(self):
         self.assertTrue(self.keeper.acquire_lock())
 
-    @patch('requests.delete', requests_delete)
+    @patch('requests.Session.delete', Mock(side_effect=requests_delete))
     @patch('boto3.resource')
     def test_remove_unhealthy_members(self, res):
         res.return_value.instances.filter.return_value = instances()
@@ -65,20 +58,64 @@ class TestHouseKeeper(unittest.TestCase):
         res.return_value.instances.filter.return_value = instances()
         autoscaling_members = self.manager.get_autoscaling_members()
         self.assertIsNone(self.keeper.update_route53_records(autoscaling_members))
+        self.assertEqual(len(cli.return_value.change_resource_record_sets.call_args[1]['ChangeBatch']['Changes']), 3)
+        self.assertIsNone(self.keeper.update_route53_records(autoscaling_members))
+        self.assertEqual(cli.return_value.change_resource_record_sets.call_count, 1)
+
+        self.keeper.members.popitem()
+        self.assertIsNone(self.keeper.update_route53_records(autoscaling_members))
+        self.assertEqual(cli.return_value.list_hosted_zones_by_name.call_count, 1)
+
+        self.keeper.members.popitem()
+        cli.return_value.change_resource_record_sets.side_effect = Exception
+        self.assertRaises(Exception, self.keeper.update_route53_records, autoscaling_members)
+        self.assertIsNone(self.keeper.hosted_zone_id)
         self.keeper.hosted_zone = 'bla'
         self.assertRaises(Exception, self.keeper.update_route53_records, autoscaling_members)
 
-    @patch('subprocess.Popen', Popen)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     def test_cluster_unhealthy(self):
         self.assertTrue(self.keeper.cluster_unhealthy())
+        members = [m for m in self.keeper.members.values() if m['clientURLs']]
+        with patch.object(EtcdMember, 'get_members', Mock(return_value=members)):
+            self.assertFalse(self.keeper.cluster_unhealthy())
+        with patch.object(EtcdMember, 'get_members', Mock(return_value=[])):
+            self.assertTrue(self.keeper.cluster_unhealthy())
+
+    def test_check_cluster_health(self):
+        def get(url, **kwargs):
+            if url.startswith('http://127.0.0.1:'):
+                return requests_get(url)
+            elif url.startswith('http://127.0.0.2:'):
+                return MockResponse()
+            raise Exception
+
+        members = sorted(self.keeper.members.values(), key=lambda m: m['id'])
+        with patch('requests.Session.get', Mock(side_effect=get)):
+            results = self.keeper.check_cluster_health(members)
+        self.assertEqual([(r.reachable, r.healthy) for r in results],
+                         [(True, True), (True, False), (False, False), (False, False)])
+        self.assertIsNotNone(results[0].latency)
+
+    @patch.object(MembershipWatcher, 'start', Mock())
+    @patch('threading.Thread.start', Mock())
+    def test_start(self):
+        self.keeper.start()
+        self.keeper.watcher.start.assert_called_once_with()
+
+    def test_on_membership_change(self):
+        self.keeper.manager._inventory = {'eu-west-1': (1e12, {})}
+        self.keeper.on_membership_change()
+        self.assertEqual(self.keeper.manager._inventory['eu-west-1'][0], 0)
+        self.assertTrue(self.keeper.scheduler._event.is_set())
 
     @patch('logging.exception', Mock(side_effect=Exception))
     @patch('os.kill', Mock())
     @patch('time.sleep', Mock(side_effect=Exception))
-    @patch('requests.get', requests_get)
-    @patch('requests.put', requests_put)
-    @patch('requests.delete', requests_delete)
-    @patch('subprocess.Popen', Popen)
+    @patch.object(Scheduler, 'wait', Mock(side_effect=Exception))
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('requests.Session.put', Mock(side_effect=requests_put))
+    @patch('requests.Session.delete', Mock(side_effect=requests_delete))
     @patch('boto3.resource')
     @patch('boto3.client')
     def test_run(self, cli, res):
@@ -89,10 +126,301 @@ class TestHouseKeeper(unittest.TestCase):
         self.assertRaises(Exception, self.keeper.run)
         self.keeper.is_leader = Mock(side_effect=Exception)
         self.assertRaises(Exception, self.keeper.run)
-        with patch('time.sleep', Mock()):
-            self.keeper.is_leader = Mock(return_value=False)
-            self.keeper.manager.run_old = True
-            self.keeper.cluster_unhealthy = Mock(side_effect=[False, True, False])
-            self.assertRaises(Exception, self.keeper.run)
-            self.keeper.cluster_unhealthy = Mock(side_effect=[False] + [True]*100)
+        self.keeper.is_leader = Mock(return_value=False)
+        self.keeper.manager.run_old = True
+        with patch.object(HouseKeeper, 'upgrade', Mock()) as upgrade, patch.object(Scheduler, 'success') as success:
             self.assertRaises(Exception, self.keeper.run)
+            self.assertFalse(upgrade.call_args[0][0].is_leader)
+            self.assertEqual(len(upgrade.call_args[0][0].health), 4)
+            success.assert_called_once_with(False)  # waiting for the upgrade turn doesn't slow down the loop
+            self.keeper.manager.rollback = True
+            self.assertTrue(self.keeper.tick())
+            self.assertEqual(upgrade.call_count, 1)
+
+    @patch('requests.Session.put', Mock(side_effect=requests_put))
+    @patch.object(Backup, 'TARGET', '/backups')
+    @patch.object(Backup, 'start')
+    @patch.object(EtcdMember, 'ENABLE_V2', False)
+    @patch.dict('os.environ', {'ETCDVERSION': '3.4.14'})
+    def test_start_backup(self, start):
+        members = list(self.keeper.members.values())
+        started = [m for m in members if m['clientURLs']]
+        self.keeper.start_backup(ClusterStatus(False, members, [], False))  # i-deadbeef4 hasn't started yet
+        self.keeper.start_backup(ClusterStatus(True, started, [], False))  # leader leaves backups to followers
+        self.keeper.start_backup(ClusterStatus(False, started, [], True))
+        start.assert_not_called()
+        self.keeper.start_backup(ClusterStatus(False, started, [], False))
+        self.keeper.start_backup(ClusterStatus(True, started[:1], [], False))
+        self.assertEqual(start.call_count, 2)
+        with patch.dict('os.environ', {'ETCDVERSION': '3.3.25'}):  # always serves v2 API
+            self.keeper.start_backup(ClusterStatus(False, started, [], False))
+        with patch.object(EtcdMember, 'ENABLE_V2', True):
+            self.keeper.start_backup(ClusterStatus(False, started, [], False))
+        self.assertEqual(start.call_count, 2)
+
+    @patch('requests.Session.put', Mock(side_effect=requests_put))
+    @patch('requests.Session.delete', Mock(side_effect=requests_delete))
+    @patch.object(HouseKeeper, 'DEFRAG_MIN_BYTES', 100)
+    @patch.object(EtcdMember, 'get_v3_prefix', Mock(return_value='/v3'))
+    @patch('boto3.resource')
+    def test_maintain_storage(self, res):
+        res.return_value.instances.filter.return_value = instances()
+        self.manager.get_autoscaling_members()
+        in_use = {'1': '100', '3': '100'}
+        alarms = []
+        compaction = [{}]
+
+        def api_v3(member, endpoint, data=None, prefix=None, timeout=None):
+            if endpoint == 'maintenance/status':
+                return {'header': {'revision': '42'}, 'dbSize': '1000', 'dbSizeInUse': in_use.get(member.id, '1000')}
+            if endpoint == 'maintenance/alarm' and data == {'action': 'GET'}:
+                return {'alarms': alarms}
+            if endpoint == 'kv/compaction':
+                return compaction.pop(0)
+            return {}
+
+        members = [dict(m, id=m['name'][-1]) for m in self.keeper.members.values()]  # ids as hex numbers
+        health = [MemberHealth(m['id'], m['name'], None, True, True, 0) for m in members]
+        with patch.object(EtcdMember, 'api_v3', autospec=True, side_effect=api_v3) as api:
+            # the leader doesn't compact until it has seen revisions for COMPACTION_INTERVAL,
+            # follower i-deadbeef1 is defragmented before the leader
+            self.assertFalse(self.keeper.maintain_storage(ClusterStatus(True, members, health, False)))
+            calls = [(c[0][0].id, c[0][1]) for c in api.call_args_list if c[0][1] != 'maintenance/status']
+            self.assertEqual(calls, [('3', 'maintenance/alarm'), ('1', 'maintenance/defragment')])
+            self.assertEqual(self.keeper.compaction[1], 42)
+
+            series = 'etcd_manager_db_size_bytes{{member="{0}"}}'.format(members[0]['name'])
+            self.assertTrue(series in METRICS.render())
+            self.keeper.get_storage_status([EtcdMember(m) for m in members[1:]], '/v3')  # member has been replaced
+            self.assertFalse(series in METRICS.render())
+            self.assertTrue('etcd_manager_db_size_in_use_bytes{member=' in METRICS.render())
+            self.keeper.follower_tick()
+            self.assertFalse('etcd_manager_db_size_in_use_bytes{member=' in METRICS.render())
+
+            in_use['1'] = '1000'
+            api.reset_mock()  # only the leader is left but the cluster is unhealthy
+            unhealthy = health[:1] + [health[1]._replace(healthy=False)]
+            self.assertTrue(self.keeper.maintain_storage(ClusterStatus(True, members, unhealthy, False)))
+            self.assertEqual(len(api.call_args_list), 4)
+
+            self.keeper.compaction = (time.time() - HouseKeeper.COMPACTION_INTERVAL, 41)
+            compaction.insert(0, EtcdClusterException('mvcc: required revision has been compacted'))
+            self.assertFalse(self.keeper.maintain_storage(ClusterStatus(True, members, health, False)))
+            self.assertEqual(api.call_args_list[-1][0][1], 'maintenance/defragment')  # the leader at last
+            self.assertEqual(self.keeper.compaction[1], 42)
+
+            in_use['3'] = '1000'
+            alarms.append({'memberID': '2', 'alarm': 'NOSPACE'})
+            api.reset_mock()  # space has run out, everything is compacted immediately
+            self.assertFalse(self.keeper.maintain_storage(ClusterStatus(True, members, health, False)))
+            calls = [(c[0][0].id, c[0][1], c[0][2]) for c in api.call_args_list if c[0][1] != 'maintenance/status']
+            self.assertEqual(calls[1:], [('3', 'kv/compaction', {'revision': 42}),
+                                         ('2', 'maintenance/defragment', None),
+                                         ('3', 'maintenance/alarm',
+                                          {'action': 'DEACTIVATE', 'alarm': 'NOSPACE', 'memberID': '2'})])
+
+        with patch.object(EtcdMember, 'get_v3_prefix', Mock(side_effect=EtcdClusterException)):
+            self.assertTrue(self.keeper.maintain_storage(ClusterStatus(True, members, health, False)))
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    def test_get_status(self):
+        self.keeper.is_leader = Mock(return_value=True)
+        status = self.keeper.get_status()
+        self.assertTrue(status.is_leader)
+        self.assertEqual(len(status.members), 4)
+        self.assertFalse(status.healthy)  # i-deadbeef4 is not serving clients
+        self.assertFalse(status.upgrade_locked)
+        self.keeper.is_leader.return_value = False
+        self.assertEqual(self.keeper.get_status().health, [])  # followers don't need probes unless upgrading
+
+    @patch('os.kill')
+    @patch('time.sleep', Mock())
+    @patch.object(HouseKeeper, 'release_upgrade_lock')
+    @patch.object(HouseKeeper, 'member_rejoined')
+    @patch.object(HouseKeeper, 'wait_for_upgrade_turn')
+    def test_upgrade(self, turn, rejoined, release, kill):
+        self.manager.etcd_pid = 1
+        peer = Mock(instance_id='i-deadbeef1')
+        self.manager.get_autoscaling_members = Mock(return_value=[self.manager.me, peer])
+        turn.return_value = False
+        self.keeper.upgrade()
+        kill.assert_not_called()
+
+        def restart(pid, sig):
+            self.manager.etcd_pid = pid + 1
+        kill.side_effect = restart
+        turn.return_value = True
+        rejoined.side_effect = [False, True]
+        release.side_effect = [Exception, True]
+        self.keeper.upgrade()
+        self.assertEqual(self.manager.etcd_pid, 2)
+        release.assert_called_with(peer)
+        self.assertIn('etcd_manager_upgrade_phase{phase="complete"} 1.0', METRICS.render())
+
+        release.reset_mock(side_effect=True)
+        rejoined.side_effect = None
+        rejoined.return_value = False
+        with patch.object(HouseKeeper, 'UPGRADE_TIMEOUT', 0):
+            self.keeper.upgrade()
+            release.assert_not_called()
+            self.assertFalse(self.manager.rollback)
+            with patch.object(HouseKeeper, 'UPGRADE_ROLLBACK', True):
+                self.keeper.upgrade()
+                self.assertTrue(self.manager.rollback)
+                with patch.object(HouseKeeper, 'restart_member', Mock(side_effect=[False, True])):
+                    self.keeper.upgrade()
+                release.assert_called_once_with(self.manager.me)
+        self.assertIn('etcd_manager_upgrade_phase{phase="rolled_back"} 1.0', METRICS.render())
+
+    @patch('time.sleep', Mock())
+    @patch.object(HouseKeeper, 'take_upgrade_lock', Mock(return_value=True))
+    def test_wait_for_upgrade_turn(self):
+        with patch.object(EtcdMember, 'get_members', Mock(return_value=[])):
+            with patch.object(HouseKeeper, 'NAPTIME', 0):
+                self.assertFalse(self.keeper.wait_for_upgrade_turn())
+            with patch.object(HouseKeeper, 'cluster_healthy', Mock(side_effect=[False, True])):
+                self.assertTrue(self.keeper.wait_for_upgrade_turn())
+        status = ClusterStatus(False, [], [MemberHealth('a', 'i-a', None, True, True, 0)], True)
+        with patch.object(HouseKeeper, 'take_upgrade_lock', Mock(return_value=True)) as take:
+            with patch.object(HouseKeeper, 'NAPTIME', 0):
+                self.assertFalse(self.keeper.wait_for_upgrade_turn(status))  # locked by other member
+            take.assert_not_called()
+            self.assertTrue(self.keeper.wait_for_upgrade_turn(status._replace(upgrade_locked=False)))
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    def test_member_rejoined(self):
+        dead, peer = Mock(), Mock()
+        dead.get_members.side_effect = Exception
+        peer.get_members.return_value = members = [m for m in self.keeper.members.values() if m['clientURLs']]
+        self.assertTrue(self.keeper.member_rejoined([dead, peer]))
+        members[-1]['clientURLs'] = []  # i-deadbeef3 is not serving clients yet
+        self.assertFalse(self.keeper.member_rejoined([peer]))
+        self.assertFalse(self.keeper.member_rejoined([dead]))
+
+    @patch('os.kill')
+    @patch('time.sleep', Mock())
+    @patch.object(HouseKeeper, 'UPGRADE_LOCK_TTL', 0)
+    def test_restart_member(self, kill):
+        self.manager.etcd_pid = 1
+        dead, peer = Mock(), Mock()
+        dead.refresh_lock.side_effect = Exception
+        with patch.object(HouseKeeper, 'UPGRADE_TIMEOUT', 0):
+            self.assertFalse(self.keeper.restart_member([dead, peer], 'restarting'))
+
+        def restart(pid, sig):
+            self.manager.etcd_pid = pid + 1
+        kill.side_effect = restart
+        with patch.object(HouseKeeper, 'member_rejoined', Mock(side_effect=[False, True])):
+            self.assertTrue(self.keeper.restart_member([dead, peer], 'restarting'))
+        peer.refresh_lock.assert_called_with('_upgrade_lock', 'i-deadbeef3', 0)
+
+        kill.reset_mock()
+        self.manager.etcd_pid = 0  # rolling back while the upgraded etcd isn't running, main loop starts the old one
+
+        with patch.object(HouseKeeper, 'member_rejoined', Mock(return_value=True)):
+            with patch.object(HouseKeeper, 'UPGRADE_TIMEOUT', 0):
+                self.assertFalse(self.keeper.restart_member([peer], 'rolling_back'))
+
+            def start(seconds):
+                self.manager.etcd_pid = 3
+            with patch('time.sleep', Mock(side_effect=start)):
+                self.assertTrue(self.keeper.restart_member([peer], 'rolling_back'))
+        kill.assert_not_called()
+
+
+class TestAsyncHouseKeeper(unittest.TestCase):
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
+    @patch('boto3.resource')
+    def setUp(self, res):
+        AWS_CLIENTS.invalidate()
+        res.return_value.instances.filter.return_value = instances()
+        self.manager = EtcdManager()
+        self.manager.get_my_instance()
+        self.manager.instance_id = 'i-deadbeef3'
+        self.manager.region = 'eu-west-1'
+        self.manager.etcd_pid = 1
+        self.keeper = AsyncHouseKeeper(self.manager, 'test.')
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('requests.Session.put', Mock(side_effect=requests_put))
+    @patch('requests.Session.delete', Mock(side_effect=requests_delete))
+    @patch('boto3.resource')
+    @patch('boto3.client')
+    def test_tick(self, cli, res):
+        cli.return_value.list_hosted_zones_by_name.return_value = {'HostedZones': [{'Id': '', 'Name': 'test.'}]}
+        res.return_value.instances.filter.return_value = instances()
+        self.assertFalse(self.keeper.tick())
+        self.assertFalse(self.keeper.update_required)
+        self.assertEqual(len(self.keeper.members), 4)
+        self.assertEqual(cli.return_value.change_resource_record_sets.call_count, 1)
+
+        with patch.object(HouseKeeper, 'cluster_unhealthy', Mock(return_value=False)):
+            self.assertTrue(self.keeper.tick())  # nothing has changed
+            with patch.object(HouseKeeper, 'check_upgrade_lock', Mock(return_value=True)):
+                self.keeper.members.popitem()
+                self.assertTrue(self.keeper.tick())
+
+        with patch.object(HouseKeeper, 'update_route53_records', Mock(side_effect=Exception)):
+            self.assertRaises(Exception, self.keeper.tick)
+        self.assertTrue(self.keeper.update_required)
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    def test_tick_timeout(self):
+        self.keeper.tasks.timeout = 0
+        self.assertRaises(asyncio.TimeoutError, self.keeper.tick)
+
+
+class TestAsyncTasks(unittest.TestCase):
+
+    def test_run(self):
+        tasks = AsyncTasks(10)
+
+        slow = []
+
+        async def failing():
+            slow.append(tasks.call(time.sleep, 0.1))
+            await asyncio.gather(tasks.call(Mock(side_effect=Exception)), slow[0])
+
+        async def succeeding():
+            return await asyncio.gather(tasks.call(Mock(return_value=1)), tasks.call(Mock(return_value=2)))
+
+        self.assertRaises(Exception, tasks.run, failing)
+        self.assertTrue(slow[0].cancelled())
+        self.assertEqual(tasks.run(succeeding), [1, 2])
+
+
+class TestMembershipWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Mock()
+        self.manager.etcd_pid = 1
+        self.callback = Mock()
+        self.watcher = MembershipWatcher(self.manager, self.callback)
+
+    def test_check(self):
+        get_followers = self.manager.me.get_followers
+        get_followers.return_value = {'a': 0, 'b': 0}
+        self.assertFalse(self.watcher.check())  # first observation
+        self.assertFalse(self.watcher.check())
+        get_followers.return_value = {'a': 0, 'b': 0, 'c': 0}
+        self.assertTrue(self.watcher.check())  # new follower
+        get_followers.return_value = {'a': 0, 'b': 3, 'c': 0}
+        self.assertTrue(self.watcher.check())  # b stopped answering heartbeats
+        get_followers.return_value = {'a': 0, 'b': 5, 'c': 0}
+        self.assertFalse(self.watcher.check())  # b is still failing
+        get_followers.return_value = {'a': 0, 'b': 5, 'c': 0}
+        self.assertTrue(self.watcher.check())  # b is back
+        get_followers.return_value = {'a': 0, 'b': 5}
+        self.assertTrue(self.watcher.check())  # c was removed
+        get_followers.return_value = None
+        self.assertFalse(self.watcher.check())  # not a leader anymore
+        self.manager.etcd_pid = 0
+        self.assertFalse(self.watcher.check())
+
+    @patch('time.sleep', Mock(side_effect=[None, None, Exception]))
+    def test_run(self):
+        self.watcher.check = Mock(side_effect=[True, Exception, False])
+        self.assertRaises(Exception, self.watcher.run)
+        self.callback.assert_called_once_with()
@@ -1,8 +1,24 @@
+import errno
 import json
 import os
+import shutil
+import signal
+import subprocess
+import tempfile
 import unittest
+import zlib
 
-from etcd import EtcdCluster, EtcdClusterException, EtcdManager, EtcdMember, HouseKeeper, main, sigterm_handler
+import botocore.session
+import requests
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+from etcd import AWS_CLIENTS, METRICS, AwsClients, Backup, EtcdCluster, EtcdClusterException, EtcdManager, EtcdMember, \
+    HouseKeeper, HttpSessionPool, InstanceMetadata, Metrics, S3BackupStore, Scheduler, main, sigterm_handler, \
+    start_metrics_server
 from mock import Mock, patch
 
 
@@ -24,6 +40,8 @@ def requests_get(url, **kwargs):
         response.content = '{"etcdserver":"2.3.7","etcdcluster":"2.3.0"}'
     elif url == 'http://127.0.0.3:2379/v2/keys/_upgrade_lock':
         response.status_code = 404
+    elif url.endswith('/health'):
+        response.content = '{"health":"true"}'
     else:
         response.content = \
             """{"region":"eu-west-1", "instanceId": "i-deadbeef3", "leaderInfo":{"leader":"ifoobari1"},"members":[
@@ -79,6 +97,12 @@ def requests_get_bad_etcd(url, **kwargs):
     return response
 
 
+def requests_put_token(url, **kwargs):
+    response = MockResponse()
+    response.text = 'token'
+    return response
+
+
 def requests_delete(url, **kwargs):
     response = MockResponse()
     response.status_code = (500 if url.endswith('/v2/members/ifoobari7') else 204)
@@ -134,8 +158,10 @@ class SleepException(Exception):
 class TestEtcdManager(unittest.TestCase):
 
     @patch('boto3.resource')
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
     def setUp(self, res):
+        AWS_CLIENTS.invalidate()
         self.manager = EtcdManager()
         res.return_value.instances.filter.return_value = instances()
         self.manager.find_my_instance()
@@ -147,6 +173,26 @@ class TestEtcdManager(unittest.TestCase):
         self.assertEqual(self.manager.instance_id, 'i-deadbeef3')
         self.assertEqual(self.manager.region, 'eu-west-1')
 
+    @patch('boto3.resource')
+    def test_inventory_cache(self, res):
+        AWS_CLIENTS.invalidate()
+        res.return_value.instances.filter.return_value = ec2 = instances()
+        self.manager.get_my_instance()
+        members = self.manager.get_autoscaling_members()
+        self.assertEqual(len(self.manager.get_autoscaling_members()), 3)
+        self.assertEqual(res.return_value.instances.filter.call_count, 2)
+        known = self.manager._inventory['eu-west-1'][1]
+
+        self.manager.invalidate_inventory()
+        ec2[0].private_ip_address = '127.0.0.10'
+        members[1].id = 'ifoobari2'  # changes in returned members must not affect the cache
+        self.assertEqual(len(self.manager.get_autoscaling_members()), 3)
+        self.assertEqual(res.return_value.instances.filter.call_count, 3)
+        inventory = self.manager._inventory['eu-west-1'][1]
+        self.assertIsNot(inventory['i-deadbeef1'], known['i-deadbeef1'])
+        self.assertIs(inventory['i-deadbeef2'], known['i-deadbeef2'])
+        self.assertIsNone(inventory['i-deadbeef2'][1].id)
+
     def test_clean_data_dir(self):
         self.manager.clean_data_dir()
         os.mkdir(self.manager.DATA_DIR)
@@ -158,12 +204,62 @@ class TestEtcdManager(unittest.TestCase):
             self.manager.clean_data_dir()
         self.manager.clean_data_dir()
 
-    @patch('requests.get', requests_get_bad_status)
+    @patch('time.sleep', Mock())
+    @patch('requests.Session.get', Mock(side_effect=requests_get_bad_status))
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
     def test_load_my_identities(self):
         self.assertRaises(EtcdClusterException, self.manager.load_my_identities)
 
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
+    @patch('boto3.resource')
+    def test_identity_cache(self, res):
+        AWS_CLIENTS.invalidate()
+        res.return_value.instances.filter.return_value = instances()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with patch.object(EtcdManager, 'IDENTITY_CACHE', os.path.join(path, 'identity.json')):
+            manager = EtcdManager()
+            with patch('requests.Session.get', Mock(side_effect=requests_get)):
+                manager.get_my_instance()
+            self.assertEqual(res.return_value.instances.filter.call_count, 1)
+
+            manager = EtcdManager()
+            with patch('requests.Session.get', Mock(side_effect=Exception)):
+                me = manager.get_my_instance()  # neither metadata service nor EC2 are queried
+            self.assertEqual(res.return_value.instances.filter.call_count, 1)
+            self.assertEqual((manager.region, manager.instance_id), ('eu-west-1', 'i-deadbeef3'))
+            self.assertEqual((me.private_ip_address, me.cloudformation_stack), ('127.0.0.3', 'etc-cluster'))
+
+            with open(EtcdManager.IDENTITY_CACHE, 'w') as f:
+                f.write('{')
+            manager = EtcdManager()
+            with patch('requests.Session.get', Mock(side_effect=requests_get)):
+                self.assertEqual(manager.get_my_instance().instance_id, 'i-deadbeef3')
+            self.assertEqual(res.return_value.instances.filter.call_count, 2)
+
+        with patch('os.rename', Mock(side_effect=OSError)):
+            manager.write_identity_cache(instances()[2])  # IDENTITY_CACHE is not set
+            with patch.object(EtcdManager, 'IDENTITY_CACHE', os.path.join(path, 'identity.json')):
+                manager.write_identity_cache(instances()[2])
+
+    @patch('time.sleep', Mock())
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('boto3.resource')
+    def test_wait_for_membership(self, res):
+        res.return_value.instances.filter.return_value = instances()
+        cluster = EtcdCluster(self.manager)
+        cluster.load_members()
+        self.manager.me = cluster.members[2]
+        with patch.object(EtcdMember, 'get_members', Mock(side_effect=[Exception, [{'id': 'ifoobari3'}], []])) as get:
+            self.manager.wait_for_membership(cluster, lambda members: not members, 'removed')
+            self.assertEqual(get.call_count, 3)
+
+        self.manager.CONFIRMATION_TIMEOUT = 0
+        self.assertRaises(EtcdClusterException, self.manager.wait_for_membership, cluster, lambda m: False, 'added')
+
     @patch('time.sleep', Mock())
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch.object(EtcdManager, 'wait_for_membership', Mock())
     @patch('boto3.resource')
     def test_register_me(self, res):
         res.return_value.instances.filter.return_value = instances()
@@ -173,28 +269,89 @@ class TestEtcdManager(unittest.TestCase):
         self.manager.register_me(cluster)
 
         self.manager.me.id = None
-        cluster.accessible_member.add_member = Mock(return_value=False)
-        self.assertRaises(EtcdClusterException, self.manager.register_me, cluster)
+        with patch.object(EtcdMember, 'add_member', Mock(return_value=False)):
+            self.assertRaises(EtcdClusterException, self.manager.register_me, cluster)
 
-        self.manager.me.client_urls = ['a']
-        cluster.accessible_member.delete_member = Mock(return_value=False)
-        self.assertRaises(EtcdClusterException, self.manager.register_me, cluster)
+            self.manager.me.client_urls = ['a']
+            with patch.object(EtcdMember, 'delete_member', Mock(return_value=False)):
+                self.assertRaises(EtcdClusterException, self.manager.register_me, cluster)
 
-        cluster.accessible_member.delete_member = cluster.accessible_member.add_member = Mock(return_value=True)
-        self.manager.register_me(cluster)
+        with patch.object(EtcdMember, 'add_member', Mock(return_value=True)), \
+                patch.object(EtcdMember, 'delete_member', Mock(return_value=True)):
+            self.manager.register_me(cluster)
 
-        cluster.leader_id = None
-        self.assertRaises(EtcdClusterException, self.manager.register_me, cluster)
+            cluster.leader_id = None
+            self.assertRaises(EtcdClusterException, self.manager.register_me, cluster)
 
         cluster.accessible_member = None
         self.manager.register_me(cluster)
+        with patch.object(Backup, 'TARGET', '/backups'), patch.object(Backup, 'RESTORE', True), \
+                patch.object(Backup, 'restore') as restore:
+            self.manager.register_me(cluster)
+            self.assertEqual(restore.call_count, 1)
+            self.assertEqual(restore.call_args[0][0], 'data')
+            self.assertIn('i-deadbeef3=http://ip-127-0-0-3.eu-west-1.compute.internal:2380', restore.call_args[0][1])
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('boto3.resource')
+    def test_measure_peer_rtt(self, res):
+        res.return_value.instances.filter.return_value = instances()
+        cluster = EtcdCluster(self.manager)
+        self.assertIsNone(self.manager.measure_peer_rtt(cluster))
+        cluster.load_members()
+        with patch.object(EtcdMember, 'measure_rtt', Mock(side_effect=[0.01, None])) as measure_rtt:
+            self.assertEqual(self.manager.measure_peer_rtt(cluster), 0.01)
+            self.assertEqual(measure_rtt.call_count, 2)  # neither we nor i-deadbeef4 without instance are measured
+        with patch.object(EtcdMember, 'measure_rtt', Mock(return_value=None)):
+            self.assertIsNone(self.manager.measure_peer_rtt(cluster))
+
+    def test_get_etcd_settings(self):
+        cluster = EtcdCluster(self.manager)
+        with patch.object(EtcdManager, 'measure_peer_rtt', Mock(return_value=None)):
+            self.assertEqual(self.manager.get_etcd_settings(cluster), {})
+            with patch.object(EtcdManager, 'ELECTION_TIMEOUT', 2000), patch.object(EtcdManager, 'SNAPSHOT_COUNT', 10):
+                self.assertEqual(self.manager.get_etcd_settings(cluster),
+                                 {'election-timeout': 2000, 'snapshot-count': 10})
+        with patch.object(EtcdManager, 'measure_peer_rtt', Mock(return_value=0.0004)):
+            self.assertEqual(self.manager.get_etcd_settings(cluster),
+                             {'heartbeat-interval': 100, 'election-timeout': 1000})
+        with patch.object(EtcdManager, 'measure_peer_rtt', Mock(return_value=0.081)):
+            self.assertEqual(self.manager.get_etcd_settings(cluster),
+                             {'heartbeat-interval': 150, 'election-timeout': 1500})
+        with patch.object(EtcdManager, 'measure_peer_rtt', Mock(return_value=10)):
+            self.assertEqual(self.manager.get_etcd_settings(cluster),
+                             {'heartbeat-interval': 5000, 'election-timeout': 50000})
+        with patch.object(EtcdManager, 'HEARTBEAT_INTERVAL', 300), \
+                patch.object(EtcdManager, 'QUOTA_BACKEND_BYTES', 8589934592), \
+                patch.object(EtcdManager, 'measure_peer_rtt', Mock()) as measure_peer_rtt:
+            settings = {'heartbeat-interval': 300, 'election-timeout': 3000, 'quota-backend-bytes': 8589934592}
+            self.assertEqual(self.manager.get_etcd_settings(cluster), settings)
+            measure_peer_rtt.assert_not_called()
+
+    @patch('boto3.resource')
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    def test_remove_me(self, res):
+        res.return_value.instances.filter.return_value = instances()
+        self.manager.get_autoscaling_members()
+        members = requests_get('http://127.0.0.1:2379/v2/members').json()['members']
+        self.manager.cluster_state.publish(members, 'ifoobari2')
+        with patch('requests.Session.delete', Mock(side_effect=requests_delete)) as delete:
+            self.manager.remove_me()
+            delete.assert_called_once_with('http://127.0.0.2:2379/v2/members/ifoobari3', data=None)
+        with patch('requests.Session.delete', Mock(side_effect=Exception)) as delete:
+            self.assertRaises(Exception, self.manager.remove_me)
+            self.assertEqual(delete.call_count, 3)  # both known peers have failed, the cluster is loaded again
+        self.manager.cluster_state.publish(members[:2])  # published before we were registered
+        with patch.object(EtcdCluster, 'load_members', Mock()) as load_members:
+            self.manager.remove_me()
+            load_members.assert_called_once_with()
 
     @patch('boto3.resource')
     @patch('os.path.exists', Mock(return_value=True))
     @patch('os.execv', Mock(side_effect=Exception))
     @patch('os.fork', Mock(return_value=0))
-    @patch('time.sleep', Mock(side_effect=SleepException))
-    @patch('requests.get', requests_get)
+    @patch.object(Scheduler, 'wait', Mock(side_effect=SleepException))
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     def test_run(self, res):
         res.return_value.instances.filter.return_value = instances()
         self.assertRaises(SleepException, self.manager.run)
@@ -205,24 +362,340 @@ class TestEtcdManager(unittest.TestCase):
                 with patch.object(EtcdCluster, 'load_members', Mock(side_effect=SystemExit)):
                     self.manager.run()
 
+    @patch('time.sleep', Mock())
+    @patch('os.kill')
+    @patch.object(EtcdManager, 'WATCHDOG_INTERVAL', 1e-6)
+    @patch.object(EtcdManager, 'WATCHDOG_FAILURES', 2)
+    @patch.object(EtcdManager, 'WATCHDOG_KILL_TIMEOUT', 0)
+    @patch.object(EtcdManager, 'WATCHDOG_GRACE', 0)
+    def test_supervise(self, kill):
+        def waitpid(pid, options):
+            self.assertEqual(options, os.WNOHANG)
+            return (pid, 9) if kill.call_count == 2 else (0, 0)
+
+        with patch('os.waitpid', Mock(side_effect=waitpid)), \
+                patch.object(EtcdManager, 'etcd_alive', Mock(return_value=False)) as alive:
+            self.assertEqual(self.manager.supervise(1), 9)
+            self.assertEqual([c[0] for c in kill.call_args_list], [(1, signal.SIGTERM), (1, signal.SIGKILL)])
+            self.assertEqual(alive.call_count, 2)
+
+            kill.reset_mock()
+            kill.side_effect = [None, OSError(errno.ESRCH, 'No such process')]
+            with patch.object(EtcdManager, 'WATCHDOG_FAILURES', 100), \
+                    patch.object(EtcdManager, 'WATCHDOG_TIMEOUT', 0):  # no answer within the time budget
+                self.assertEqual(self.manager.supervise(1), 9)
+            self.assertEqual(alive.call_count, 3)
+
+        kill.reset_mock()
+        with patch('os.waitpid', Mock(side_effect=[(0, 0)] * 5 + [(1, 256)])), \
+                patch.object(EtcdManager, 'etcd_alive', Mock(return_value=False)):
+            with patch.object(EtcdManager, 'WATCHDOG_GRACE', 3600):  # etcd is still starting
+                self.assertEqual(self.manager.supervise(1), 256)
+            kill.assert_not_called()
+
+    def test_etcd_alive(self):
+        self.manager.me = EtcdMember(MockInstance('i-deadbeef3', '127.0.0.3'))
+        with patch('requests.Session.get', Mock(return_value=MockResponse())) as get:
+            get.return_value.status_code = 503  # unhealthy but alive
+            self.assertTrue(self.manager.etcd_alive())
+            get.assert_called_once_with('http://127.0.0.1:2379/health', timeout=EtcdMember.API_TIMEOUT)
+            get.side_effect = Exception
+            self.assertFalse(self.manager.etcd_alive())
+
+
+class TestBackup(unittest.TestCase):
+
+    @patch('boto3.resource')
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
+    def setUp(self, res):
+        AWS_CLIENTS.invalidate()
+        res.return_value.instances.filter.return_value = instances()
+        self.manager = EtcdManager()
+        self.manager.get_my_instance()
+        self.backup = Backup(self.manager)
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    @patch.object(Backup, 'CHUNK_SIZE', 1024)
+    def test_compress(self):
+        data = [os.urandom(100000) for _ in range(3)]
+        chunks = list(Backup.compress(data))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(c) >= 1024 for c in chunks[:-1]))
+        self.assertEqual(zlib.decompress(b''.join(chunks), 31), b''.join(data))
+
+    def test_get_store(self):
+        with patch.object(Backup, 'TARGET', 's3://bucket/etcd/'):
+            store = self.backup.get_store()
+        self.assertIsInstance(store, S3BackupStore)
+        self.assertEqual((store.bucket, store.prefix, store.region), ('bucket', 'etcd/etc-cluster/', 'eu-west-1'))
+        with patch.object(Backup, 'TARGET', 's3://bucket'):
+            self.assertEqual(self.backup.get_store().prefix, 'etc-cluster/')
+        with patch.object(Backup, 'TARGET', 'file:///backups'):
+            self.assertEqual(self.backup.get_store().path, '/backups/etc-cluster')
+
+    @patch('time.time', Mock(side_effect=lambda: 1500000000))
+    def test_take(self):
+        with patch.object(Backup, 'TARGET', self.path), \
+                patch.object(EtcdMember, 'get_snapshot', Mock(return_value=iter([b'foo', b'bar']))):
+            self.assertTrue(self.backup.take())
+        name = os.path.join(self.path, 'etc-cluster', '20170714T024000Z-i-deadbeef3.db.gz')
+        with open(name, 'rb') as f:
+            self.assertEqual(zlib.decompress(f.read(), 31), b'foobar')
+
+        with patch('requests.Session.put', Mock(side_effect=Exception)) as put, \
+                patch.object(EtcdMember, 'get_snapshot', Mock(side_effect=Exception)):
+            self.assertFalse(self.backup.take())
+            self.assertEqual(put.call_args[1]['data']['ttl'], Backup.RETRY_INTERVAL)
+
+    def test_restore(self):
+        data_dir = os.path.join(self.path, 'data')
+
+        def check_call(args, env):
+            with open(args[3], 'rb') as f:
+                self.assertEqual(f.read(), b'foobar')
+            self.assertEqual(env['ETCDCTL_API'], '3')
+
+        with patch.object(Backup, 'TARGET', self.path), patch('subprocess.check_call', Mock(side_effect=check_call)):
+            self.assertFalse(self.backup.restore(data_dir, 'i-deadbeef3=http://127.0.0.3:2380'))
+            with patch.object(EtcdMember, 'get_snapshot', Mock(return_value=iter([b'foo', b'bar']))):
+                self.backup.take()
+            self.assertTrue(self.backup.restore(data_dir, 'i-deadbeef3=http://127.0.0.3:2380'))
+        self.assertEqual(os.listdir(self.path), ['etc-cluster'])  # temporary files are removed
+
+        def failing_check_call(args, env):
+            os.makedirs(os.path.join(data_dir, 'member'))
+            raise subprocess.CalledProcessError(1, args)
+
+        with patch.object(Backup, 'TARGET', self.path), \
+                patch('subprocess.check_call', Mock(side_effect=failing_check_call)):
+            self.assertRaises(subprocess.CalledProcessError, self.backup.restore, data_dir, '')
+        self.assertEqual(os.listdir(self.path), ['etc-cluster'])  # partially restored data directory is removed
+
+    @patch('boto3.client')
+    def test_s3(self, cli):
+        conn = cli.return_value
+        conn.create_multipart_upload.return_value = {'UploadId': 'u1'}
+        conn.upload_part.return_value = {'ETag': 'e'}
+        store = S3BackupStore('bucket', 'etcd/', 'eu-west-1')
+        self.assertEqual(store.upload('b.db.gz', [b'foo', b'ba']), 5)
+        conn.complete_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='etcd/b.db.gz', UploadId='u1',
+            MultipartUpload={'Parts': [{'ETag': 'e', 'PartNumber': 1}, {'ETag': 'e', 'PartNumber': 2}]})
+        conn.upload_part.side_effect = Exception
+        self.assertRaises(Exception, store.upload, 'c.db.gz', [b'foo'])
+        conn.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='etcd/c.db.gz', UploadId='u1')
+
+        conn.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'etcd/a.db.gz'}, {'Key': 'etcd/c.db.gz.tmp'}]},
+            {'Contents': [{'Key': 'etcd/b.db.gz'}]}]
+        self.assertEqual(store.latest(), 'b.db.gz')
+        store.download('b.db.gz', None)
+        conn.download_fileobj.assert_called_once_with('bucket', 'etcd/b.db.gz', None)
+
+
+class TestInstanceMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.imds = InstanceMetadata()
+
+    @patch('time.sleep', Mock())
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
+    def test_get(self):
+        with patch('requests.Session.get', Mock(side_effect=requests_get)) as get:
+            self.assertEqual(self.imds.get('dynamic/instance-identity/document').json()['region'], 'eu-west-1')
+            self.imds.get('meta-data/instance-id')
+        self.assertEqual(requests.Session.put.call_count, 1)  # token is reused
+        self.assertEqual(get.call_args[1]['headers'], {'X-aws-ec2-metadata-token': 'token'})
+        self.assertEqual(get.call_args[1]['timeout'], InstanceMetadata.TIMEOUT)
+
+        unauthorized = MockResponse()
+        unauthorized.status_code = 401
+        with patch('requests.Session.get', Mock(side_effect=[unauthorized, MockResponse()])):
+            self.imds.get('meta-data/instance-id')
+        self.assertEqual(requests.Session.put.call_count, 2)
+
+        with patch('requests.Session.get', Mock(side_effect=requests.ConnectionError)):
+            self.assertRaises(EtcdClusterException, self.imds.get, 'meta-data/instance-id')
+
+    @patch('requests.Session.put', Mock(side_effect=requests.ConnectTimeout))
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    def test_imdsv1(self):
+        self.imds.get('meta-data/instance-id')
+        self.imds.get('meta-data/instance-id')
+        self.assertEqual(requests.Session.put.call_count, 1)
+        self.assertEqual(requests.Session.get.call_args[1]['headers'], {})
+        metrics = METRICS.render()
+        self.assertIn('etcd_manager_imds_requests_total{api="/latest/meta-data/instance-id"', metrics)
+        self.assertNotIn('etcd_manager_http_requests_total{api="/latest/', metrics)
+
+
+class TestAwsClients(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = AwsClients()
+
+    @patch('boto3.resource')
+    @patch('boto3.client')
+    def test_cache(self, cli, res):
+        cli.side_effect = res.side_effect = lambda *args, **kwargs: Mock()
+        ec2 = self.clients.resource('ec2', 'eu-west-1')
+        self.assertIs(self.clients.resource('ec2', 'eu-west-1'), ec2)
+        self.assertIsNot(self.clients.resource('ec2', 'eu-central-1'), ec2)
+        route53 = self.clients.client('route53', 'eu-west-1')
+        self.assertIs(self.clients.client('route53', 'eu-west-1'), route53)
+        self.assertEqual(res.call_count, 2)
+
+        self.clients.check_error(Exception())
+        self.assertIs(self.clients.client('route53', 'eu-west-1'), route53)
+        e = Exception()
+        e.response = {'Error': {'Code': 'ExpiredToken'}}
+        self.clients.check_error(e)
+        self.assertIsNot(self.clients.client('route53', 'eu-west-1'), route53)
+        self.assertIsNot(self.clients.resource('ec2', 'eu-west-1'), ec2)
+
+    def test_instrument(self):
+        def create_client(endpoint_url):  # real botocore client without retries
+            return self.clients.instrument(botocore.session.get_session().create_client(
+                'ec2', region_name='eu-west-1', endpoint_url=endpoint_url, aws_access_key_id='foo',
+                aws_secret_access_key='bar', config=Config(retries={'max_attempts': 0}, connect_timeout=1)))
+        labels = '{operation="DescribeInstances",service="ec2"}'
+
+        def sample(name):
+            line = [x for x in METRICS.render().splitlines() if x.startswith(name + labels)]
+            return float(line[0].split()[-1]) if line else 0
+
+        def errors():
+            return sample('etcd_manager_aws_call_errors_total')
+
+        def calls():
+            return sample('etcd_manager_aws_call_duration_seconds_count')
+
+        errors_before, calls_before = errors(), calls()
+        self.assertRaises(EndpointConnectionError, create_client('http://127.0.0.1:1').describe_instances)
+        self.assertEqual((errors(), calls()), (errors_before + 1, calls_before + 1))
+
+        responses = [(503, b'<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>throttled</Message>'
+                           b'</Error></Errors><RequestID>1</RequestID></Response>'),
+                     (200, b'<DescribeInstancesResponse><reservationSet/></DescribeInstancesResponse>')]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                code, body = responses.pop(0)
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        client = create_client('http://127.0.0.1:{0}'.format(server.server_address[1]))
+
+        self.assertRaises(ClientError, client.describe_instances)  # parsed error response
+        self.assertEqual((errors(), calls()), (errors_before + 2, calls_before + 2))
+        client.describe_instances()
+        self.assertEqual((errors(), calls()), (errors_before + 2, calls_before + 3))
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(30, max_interval=60, jitter=0)
+
+    def test_next_delay(self):
+        self.assertEqual(self.scheduler.next_delay(), 30)
+        for delay in (1, 2, 4, 8, 16, 30, 30):
+            self.scheduler.failure()
+            self.assertEqual(self.scheduler.next_delay(), delay)
+        self.scheduler.success()
+        self.assertEqual(self.scheduler.next_delay(), 30)
+        for _ in range(Scheduler.IDLE_ITERATIONS * 3):
+            self.scheduler.success(idle=True)
+        self.assertEqual(self.scheduler.next_delay(), 60)
+        self.scheduler.success()
+        self.assertEqual(self.scheduler.next_delay(), 30)
+        self.assertLess(Scheduler(30).next_delay(), 30)
+
+    def test_wait(self):
+        self.scheduler.wake_up()
+        self.assertEqual(self.scheduler.wait(), 30)  # returns immediately
+        self.assertFalse(self.scheduler._event.is_set())
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.describe('c', 'counter', 'counter help')
+        self.metrics.describe('g', 'gauge', 'gauge help')
+        self.metrics.describe('h', 'histogram', 'histogram help')
+
+    def test_render(self):
+        self.metrics.inc('c', method='get', api='/v2/"keys"')
+        self.metrics.inc('c', 2, method='get', api='/v2/"keys"')
+        self.metrics.set('g', 5)
+        self.metrics.observe('h', 0.3, op='x')
+        with self.metrics.time('h', op='x'):
+            pass
+        text = self.metrics.render()
+        self.assertIn('# TYPE c counter\n', text)
+        self.assertIn('c{api="/v2/\\"keys\\"",method="get"} 3.0\n', text)
+        self.assertIn('g 5.0\n', text)
+        self.assertIn('h_bucket{op="x",le="0.005"} 1.0\n', text)
+        self.assertIn('h_bucket{op="x",le="0.5"} 2.0\n', text)
+        self.assertIn('h_bucket{op="x",le="+Inf"} 2.0\n', text)
+        self.assertIn('h_count{op="x"} 2.0\n', text)
+        self.metrics.clear('g')
+        self.assertNotIn('g 5.0\n', self.metrics.render())
+
+    def test_get_api(self):
+        self.assertEqual(HttpSessionPool.get_api('http://127.0.0.1:2379/v2/members/abc'), '/v2/members')
+        self.assertEqual(HttpSessionPool.get_api('http://127.0.0.1:2379/health'), '/health')
+        self.assertEqual(HttpSessionPool.get_api('http://127.0.0.1:2379'), '/')
+
+    def test_start_metrics_server(self):
+        server = start_metrics_server(0)
+        try:
+            url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+            response = requests.get(url + 'metrics')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('etcd_manager_http_requests_total', response.text)
+            self.assertEqual(requests.get(url).status_code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
 
 class TestMain(unittest.TestCase):
 
+    def setUp(self):
+        AWS_CLIENTS.invalidate()
+
     def test_sigterm_handler(self):
         self.assertRaises(SystemExit, sigterm_handler, None, None)
 
-    @patch('requests.get', requests_get)
-    @patch('requests.delete', requests_delete)
+    @patch.dict(os.environ, {'IDENTITY_CACHE': ''})
+    @patch.object(InstanceMetadata, 'RETRIES', 1)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
+    @patch('requests.Session.put', Mock(side_effect=requests_put_token))
+    @patch('requests.Session.delete', Mock(side_effect=requests_delete))
     @patch.object(HouseKeeper, 'start', Mock())
     @patch.object(EtcdMember, 'delete_member', Mock(return_value=False))
     @patch('os.fork', Mock(return_value=1))
     @patch('os.waitpid', Mock(return_value=(1, 0)))
-    @patch('time.sleep', Mock(side_effect=SleepException))
+    @patch.object(Scheduler, 'wait', Mock(side_effect=SleepException))
     @patch('boto3.resource')
     def test_main(self, res):
         res.return_value.instances.filter.return_value = instances()
         self.assertRaises(SleepException, main)
-        with patch('requests.get', requests_get_bad_status):
+        with patch('requests.Session.get', Mock(side_effect=requests_get_bad_status)):
             self.assertRaises(SleepException, main)
-        with patch('requests.get', requests_get_bad_etcd):
+        with patch('requests.Session.get', Mock(side_effect=requests_get_bad_etcd)):
             self.assertRaises(SleepException, main)
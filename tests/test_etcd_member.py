@@ -1,7 +1,10 @@
+import base64
+import errno
 import json
+import socket
 import unittest
 
-from etcd import EtcdMember
+from etcd import AWS_CLIENTS, METRICS, EtcdCluster, EtcdClusterException, EtcdMember, HttpSessionPool
 from mock import patch, Mock
 from test_etcd_manager import requests_delete, requests_get, MockInstance, MockResponse
 
@@ -18,9 +21,28 @@ def requests_post(url, **kwargs):
     return response
 
 
+def snapshot_message(blob):
+    return json.dumps({'result': {'blob': base64.b64encode(blob).decode('utf-8')}}).encode('utf-8')
+
+
+class SnapshotResponse(MockResponse):
+
+    def __init__(self, lines):
+        super(SnapshotResponse, self).__init__()
+        self.lines = lines
+        self.closed = False
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+    def close(self):
+        self.closed = True
+
+
 class TestEtcdMember(unittest.TestCase):
 
     def setUp(self):
+        AWS_CLIENTS.invalidate()
         self.ec2 = MockInstance('i-foobar', '127.0.0.1')
         self.ec2_member = EtcdMember(self.ec2)
         self.etcd = {
@@ -36,6 +58,11 @@ class TestEtcdMember(unittest.TestCase):
         self.assertEqual(self.ec2_member.get_addr_from_urls(['http://1.2']), '1.2')
         self.assertIsNone(self.ec2_member.get_addr_from_urls(['http//1.2']))
 
+    def test_addr_matches(self):
+        self.assertTrue(self.ec2_member.addr_matches(['http://1.2:3', 'http://127.0.0.1:2380']))
+        self.assertFalse(self.ec2_member.addr_matches(['http://127.0.0.1:2379', 'http://127.0.0.1:foo']))
+        self.assertIs(EtcdMember.parse_url('http://127.0.0.1:2380'), EtcdMember.parse_url('http://127.0.0.1:2380'))
+
     def test_set_info_from_ec2_instance(self):
         self.etcd_member.set_info_from_ec2_instance(self.ec2)
         self.etcd_member.name = ''
@@ -52,7 +79,7 @@ class TestEtcdMember(unittest.TestCase):
         self.etcd['peerURLs'] = []
         self.ec2_member.set_info_from_etcd(self.etcd)
 
-    @patch('requests.post', requests_post)
+    @patch('requests.Session.post', Mock(side_effect=requests_post))
     def test_add_member(self):
         member = EtcdMember({
             'id': '',
@@ -64,12 +91,12 @@ class TestEtcdMember(unittest.TestCase):
         member.peer_urls[0] = member.peer_urls[0].replace('2', '4')
         self.assertFalse(self.ec2_member.add_member(member))
 
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     def test_is_leader(self):
         self.assertTrue(self.ec2_member.is_leader())
 
     @patch('boto3.resource')
-    @patch('requests.delete', requests_delete)
+    @patch('requests.Session.delete', Mock(side_effect=requests_delete))
     @patch('etcd.EtcdCluster.is_multiregion', Mock(return_value=True))
     def test_delete_member(self, res):
         sg = Mock()
@@ -77,8 +104,10 @@ class TestEtcdMember(unittest.TestCase):
             {'Key': 'aws:cloudformation:stack-name', 'Value': 'etc-cluster'},
             {'Key': 'aws:autoscaling:groupName', 'Value': 'etc-cluster-postgres'}
         ]
+        sg.ip_permissions = [{'IpProtocol': 'tcp', 'FromPort': 2379, 'ToPort': 2380,
+                              'IpRanges': [{'CidrIp': '127.0.0.2/32'}, {'CidrIp': '172.16.0.0/12'}]}]
         sg.revoke_ingress.side_effect = Exception
-        res.return_value.security_groups.all.return_value = [sg]
+        res.return_value.security_groups.filter.return_value = [sg]
         member = EtcdMember({
             'id': 'ifoobari7',
             'name': 'i-sadfjhg',
@@ -88,12 +117,184 @@ class TestEtcdMember(unittest.TestCase):
         member.peer_urls[0] = member.peer_urls[0].replace('2', '1')
         self.assertFalse(self.ec2_member.delete_member(member))
 
-    @patch('requests.get', requests_get)
+    @patch('boto3.resource')
+    @patch('etcd.EtcdCluster.is_multiregion', Mock(return_value=True))
+    def test_adjust_security_groups(self, res):
+        sg = Mock()
+        sg.ip_permissions = [{'IpProtocol': 'tcp', 'FromPort': 2379, 'ToPort': 2380,
+                              'IpRanges': [{'CidrIp': '127.0.0.2/32'}, {'CidrIp': '172.16.0.0/12'}]}]
+        res.return_value.security_groups.filter.return_value = [sg]
+        members = [EtcdMember(MockInstance('i-foobar' + ip, '127.0.0.' + ip), 'us-east-1') for ip in '123']
+        with patch.object(EtcdCluster, 'REGIONS', ['eu-west-1', 'us-east-1']):
+            self.assertTrue(self.ec2_member.adjust_security_groups('authorize_ingress', *members))
+            sg.authorize_ingress.assert_called_once_with(IpPermissions=[{
+                'IpProtocol': 'tcp', 'FromPort': 2379, 'ToPort': 2380,
+                'IpRanges': [{'CidrIp': '127.0.0.1/32'}, {'CidrIp': '127.0.0.3/32'}]}])
+            self.assertTrue(self.ec2_member.adjust_security_groups('revoke_ingress', *members))
+            self.assertEqual(sg.revoke_ingress.call_args[1]['IpPermissions'][0]['IpRanges'],
+                             [{'CidrIp': '127.0.0.2/32'}])
+            sg.ip_permissions = []
+            sg.revoke_ingress.reset_mock()
+            self.assertTrue(self.ec2_member.adjust_security_groups('revoke_ingress', *members))
+            sg.revoke_ingress.assert_not_called()
+
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     def test_get_leader(self):
         self.ec2_member.private_ip_address = '127.0.0.7'
+        self.ec2_member.update_addresses()
         self.assertEqual(self.ec2_member.get_leader(), 'ifoobari1')
 
-    @patch('requests.get', requests_get)
+    @patch('requests.Session.get', Mock(side_effect=requests_get))
     def test_get_members(self):
         self.ec2_member.private_ip_address = '127.0.0.7'
+        self.ec2_member.update_addresses()
         self.assertEqual(self.ec2_member.get_members(), [])
+
+    def test_get_snapshot(self):
+        def get(url, **kwargs):
+            response = MockResponse()
+            response.content = '{"etcdserver":"3.4.14","etcdcluster":"3.4.0"}'
+            return response
+
+        response = SnapshotResponse([snapshot_message(b'foo'), b'', snapshot_message(b'bar')])
+        with patch('requests.Session.get', Mock(side_effect=get)), \
+                patch('requests.Session.post', Mock(return_value=response)) as post:
+            self.assertEqual(list(self.ec2_member.get_snapshot()), [b'foo', b'bar'])
+            self.assertEqual(post.call_args[0][0], 'http://127.0.0.1:2379/v3/maintenance/snapshot')
+            self.assertTrue(response.closed)
+
+            response.lines = [snapshot_message(b'foo'), b'{"error":{"message":"stopped"}}']
+            self.assertRaises(EtcdClusterException, list, self.ec2_member.get_snapshot())
+            response.status_code = 500
+            self.assertRaises(EtcdClusterException, list, self.ec2_member.get_snapshot())
+
+        with patch('requests.Session.get', Mock(side_effect=requests_get)):  # etcd 2.3
+            self.assertRaises(EtcdClusterException, list, EtcdMember(self.ec2).get_snapshot())
+
+    def test_api_v3(self):
+        def get(url, **kwargs):
+            response = MockResponse()
+            response.content = '{"etcdserver":"3.4.14","etcdcluster":"3.3.0"}'
+            return response
+
+        response = MockResponse()
+        response.content = '{"header":{"member_id":"10276657743932975437","revision":"42"},"dbSize":"24576"}'
+        with patch('requests.Session.get', Mock(side_effect=get)), \
+                patch('requests.Session.post', Mock(return_value=response)) as post:
+            self.assertEqual(self.ec2_member.api_v3('maintenance/status')['dbSize'], '24576')
+            self.assertEqual(post.call_args[0][0], 'http://127.0.0.1:2379/v3beta/maintenance/status')
+            self.ec2_member.api_v3('kv/compaction', {'revision': 42}, '/v3')
+            self.assertEqual(post.call_args[0][0], 'http://127.0.0.1:2379/v3/kv/compaction')
+            response.status_code = 400
+            self.assertRaises(EtcdClusterException, self.ec2_member.api_v3, 'kv/compaction', {'revision': 42}, '/v3')
+        self.assertEqual(EtcdMember.format_id('10276657743932975437'), '8e9e05c52164694d')
+
+    @patch.object(EtcdMember, 'CLIENT_API', 'v3')
+    def test_v3_client_api(self):
+        posts = []
+        succeeded = [True]
+
+        def post(url, **kwargs):
+            data = json.loads(kwargs['data'])
+            posts.append((url.split('/v3/')[-1], data))
+            response = MockResponse()
+            if url.endswith('/maintenance/status'):
+                content = {'header': {'member_id': '2'}, 'leader': '10276657743932975437'}
+            elif url.endswith('/cluster/member/list'):
+                content = {'members': [{'ID': '10276657743932975437', 'name': 'i-foobar', 'clientURLs': [''],
+                                        'peerURLs': ['http://127.0.0.1:2380']}, {'ID': '2', 'peerURLs': ['']}]}
+            elif url.endswith('/cluster/member/add'):
+                content = {'member': {'ID': '3', 'peerURLs': data['peerURLs']}}
+            elif url.endswith('/lease/grant'):
+                content = {'ID': '7587862449436000003', 'TTL': data['TTL']}
+            elif url.endswith('/kv/txn'):
+                content = {'succeeded': succeeded[0]}
+            elif url.endswith('/kv/range'):
+                content = {'kvs': [{'key': data['key'], 'value': EtcdMember.encode_v3('i-foobar')}]}
+            else:
+                content = {}
+            response.content = json.dumps(content)
+            return response
+
+        self.ec2_member._v3_prefix = '/v3'
+        with patch('requests.Session.post', Mock(side_effect=post)):
+            self.assertEqual([m['id'] for m in self.ec2_member.get_members()], ['8e9e05c52164694d', '2'])
+            self.assertEqual(self.ec2_member.get_members()[1]['clientURLs'], [])
+            self.assertEqual(self.ec2_member.get_leader(), '8e9e05c52164694d')
+            self.assertFalse(self.ec2_member.is_leader())
+            self.assertIsNone(self.ec2_member.get_followers())
+
+            self.assertTrue(self.ec2_member.add_member(self.etcd_member))
+            self.assertEqual(self.etcd_member.id, '3')
+            self.etcd_member.id = 'ff'
+            self.assertTrue(self.ec2_member.delete_member(self.etcd_member))
+            self.assertEqual(posts[-1], ('cluster/member/remove', {'ID': '255'}))
+
+            self.assertTrue(self.ec2_member.take_lock('_upgrade_lock', 'i-foobar', 30))
+            self.assertEqual(posts[-2], ('lease/grant', {'TTL': 30}))
+            self.assertEqual(posts[-1][1]['success'][0]['request_put']['lease'], '7587862449436000003')
+            self.assertTrue(self.ec2_member.refresh_lock('_upgrade_lock', 'i-foobar', 10))
+            self.assertTrue(self.ec2_member.lock_exists('_upgrade_lock'))
+            self.assertTrue(self.ec2_member.release_lock('_upgrade_lock', 'i-foobar'))
+            self.assertEqual(posts[-1][1]['success'], [{'request_delete_range': {'key': 'X3VwZ3JhZGVfbG9jaw=='}}])
+            succeeded[0] = False
+            self.assertFalse(self.ec2_member.take_lock('_upgrade_lock', 'i-foobar', 30))
+            self.assertEqual(posts[-1], ('kv/lease/revoke', {'ID': '7587862449436000003'}))
+
+        with patch('requests.Session.post', Mock(return_value=MockResponse())) as post:
+            post.return_value.status_code = 404
+            self.assertFalse(self.ec2_member.add_member(self.etcd_member))
+            self.assertIsNone(self.ec2_member._v3_prefix)  # will be resolved again on the next call
+
+        with patch.dict('os.environ', {'ETCDVERSION': '3.4.14'}):
+            self.assertIn('--enable-v2', self.ec2_member.etcd_arguments('data', '', 'new', False))
+            with patch.object(EtcdMember, 'ENABLE_V2', False):
+                self.assertNotIn('--enable-v2', self.ec2_member.etcd_arguments('data', '', 'new', False))
+
+    def test_measure_rtt(self):
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        with patch('socket.create_connection', Mock(side_effect=[Mock(), refused, socket.timeout()])) as connect:
+            self.assertIsNotNone(self.ec2_member.measure_rtt())
+            connect.assert_called_with(('127.0.0.1', 2379), 1)
+        with patch('socket.create_connection', Mock(side_effect=socket.timeout())):
+            self.assertIsNone(self.ec2_member.measure_rtt())
+
+    def test_etcd_arguments(self):
+        args = self.ec2_member.etcd_arguments('data', 'i-foobar=http://127.0.0.1:2380', 'new', False,
+                                              {'heartbeat-interval': 150, 'election-timeout': 1500})
+        self.assertEqual(args[-4:], ['--heartbeat-interval', '150', '--election-timeout', '1500'])
+
+
+class TestHttpSessionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = HttpSessionPool(max_endpoints=2)
+        METRICS.clear('etcd_manager_http_sessions_total')  # could be left by other pools
+        METRICS.clear('etcd_manager_http_endpoint_errors_total')
+
+    @staticmethod
+    def sample(name, endpoint=None):
+        prefix = name + ('{{endpoint="{0}"}}'.format(endpoint) if endpoint else '') + ' '
+        line = [x for x in METRICS.render().splitlines() if x.startswith(prefix)]
+        return float(line[0].split()[-1]) if line else 0
+
+    def test_get_session(self):
+        session = self.pool.get_session('http://127.0.0.1:2379/v2/members')
+        self.assertIs(self.pool.get_session('http://127.0.0.1:2379/version'), session)
+        self.pool.get_session('http://127.0.0.2:2379/v2/members')
+        self.pool.get_session('http://127.0.0.3:2379/v2/members')  # evicts the least recently used session
+        self.assertIsNot(self.pool.get_session('http://127.0.0.1:2379/v2/members'), session)
+        self.assertEqual(self.sample('etcd_manager_http_sessions_total', 'http://127.0.0.1:2379'), 1)
+        self.assertEqual(self.sample('etcd_manager_http_sessions_total', 'http://127.0.0.2:2379'), 0)  # evicted
+        self.assertEqual(self.sample('etcd_manager_http_sessions_active'), 2)
+        self.pool.close()
+        self.assertEqual(self.sample('etcd_manager_http_sessions_active'), 0)
+        self.assertNotIn('etcd_manager_http_sessions_total{', METRICS.render())
+
+    @patch('requests.Session.get', Mock(side_effect=[MockResponse(), Exception]))
+    def test_request(self):
+        self.assertEqual(self.pool.request('get', 'http://127.0.0.1:2379/version').status_code, 200)
+        self.assertRaises(Exception, self.pool.request, 'get', 'http://127.0.0.1:2379/version')
+        self.assertEqual(self.sample('etcd_manager_http_endpoint_errors_total', 'http://127.0.0.1:2379'), 1)
+        self.pool.close()
+        self.assertEqual(self.sample('etcd_manager_http_endpoint_errors_total', 'http://127.0.0.1:2379'), 0)
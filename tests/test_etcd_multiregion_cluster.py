@@ -1,15 +1,18 @@
+import time
 import unittest
 
-from etcd import EtcdCluster, EtcdManager, EtcdMember
+from etcd import AWS_CLIENTS, EtcdCluster, EtcdClusterException, EtcdManager, EtcdMember, HouseKeeper
 from mock import Mock, patch
+from threading import Event, Thread
 from test_etcd_manager import requests_get_multiregion, public_instances
 
 
 class TestEtcdMultiRegionCluster(unittest.TestCase):
 
-    @patch('requests.get', requests_get_multiregion)
+    @patch('requests.Session.get', Mock(side_effect=requests_get_multiregion))
     @patch('boto3.resource')
     def setUp(self, res):
+        AWS_CLIENTS.invalidate()
         res.return_value.instances.filter.return_value = public_instances()
         self.manager = EtcdManager()
         self.manager.instance_id = 'i-deadbeef3'
@@ -23,7 +26,7 @@ class TestEtcdMultiRegionCluster(unittest.TestCase):
     def test_load_members(self, res):
         res.return_value.instances.filter.return_value = public_instances()
         self.assertEqual(len(self.cluster.members), 7)
-        with patch('requests.get', Mock(side_effect=Exception)):
+        with patch('requests.Session.get', Mock(side_effect=Exception)):
             self.cluster.load_members()
 
     def test_is_healthy(self):
@@ -45,3 +48,83 @@ class TestEtcdMultiRegionCluster(unittest.TestCase):
         self.assertTrue(self.cluster.is_healthy(me))
         self.cluster.members.pop()
         self.assertTrue(self.cluster.is_healthy(me))
+
+    def test_refresh_inventory(self):
+        event = Event()
+
+        def load_region_inventory(region, cloudformation_stack, known_instances):
+            if region == 'eu-central-1':
+                event.wait()
+            elif region == 'us-east-1':
+                raise Exception
+            return {'i-' + region: (None, Mock(public_ip_address='1.2.3.4'))}
+
+        EtcdCluster.REGIONS.append('us-east-1')
+        self.manager.REGION_TIMEOUT = 0.01
+        self.manager.me = Mock()
+        self.manager._inventory = {}
+        with patch.object(self.manager, 'load_region_inventory', Mock(side_effect=load_region_inventory)) as load:
+            self.assertEqual(len(self.manager.get_autoscaling_members()), 1)
+            self.assertEqual(self.manager.incomplete_regions, {'eu-central-1', 'us-east-1'})
+            event.set()
+            self.assertEqual(len(self.manager.get_autoscaling_members()), 2)
+            self.assertEqual(self.manager.incomplete_regions, {'us-east-1'})
+            self.assertEqual(load.call_count, 4)
+
+            self.manager.region = 'us-east-1'
+            self.manager.invalidate_inventory()
+            self.assertRaises(Exception, self.manager.get_autoscaling_members)
+
+            event.clear()
+            self.manager.region = 'eu-central-1'  # own region which doesn't answer is an error too
+            self.manager.invalidate_inventory()
+            self.assertRaises(EtcdClusterException, self.manager.get_autoscaling_members)
+            event.set()
+
+        loading, event = Event(), Event()
+
+        def slow_region(region, cloudformation_stack, known_instances):
+            loading.set()
+            event.wait()
+            return {}
+
+        self.manager.REGION_TIMEOUT = 10
+        self.manager.invalidate_inventory()
+        with patch.object(self.manager, 'load_region_inventory', Mock(side_effect=slow_region)):
+            thread = Thread(target=self.manager.get_autoscaling_members)
+            thread.start()
+            self.assertTrue(loading.wait(5))
+            started = time.time()
+            self.manager.invalidate_inventory()  # isn't blocked by the slow region
+            self.assertLess(time.time() - started, 1)
+            event.set()
+            thread.join()
+        self.assertEqual(self.manager._inventory['eu-central-1'][0], 0)  # was queried before the invalidation
+
+    @patch('boto3.resource')
+    def test_remove_unhealthy_members(self, res):
+        res.return_value.instances.filter.return_value = public_instances()
+        self.manager.get_my_instance = Mock(return_value=self.cluster.members[2])
+        self.manager.me = self.cluster.members[2]
+        keeper = HouseKeeper(self.manager, 'test.')
+        with patch('requests.Session.get', Mock(side_effect=requests_get_multiregion)):
+            keeper.members_changed()
+        self.assertEqual(EtcdMember.get_region_from_urls(['http://ip-10-0-0-1.ec2.internal:2380']), 'us-east-1')
+        self.assertIsNone(EtcdMember.get_region_from_urls(['http://10.0.0.1:2380']))
+
+        def resource(service, region_name=None):
+            ec2 = Mock()
+            if region_name == 'eu-central-1':
+                ec2.instances.filter.side_effect = Exception('throttled')
+            else:
+                ec2.instances.filter.return_value = [m for m in public_instances() if m.id.startswith('i-deadbeef')]
+            return ec2
+        res.side_effect = resource
+        AWS_CLIENTS.invalidate()
+        self.manager.invalidate_inventory()
+        members = self.manager.get_autoscaling_members()
+        self.assertEqual(self.manager.incomplete_regions, {'eu-central-1'})
+        with patch.object(EtcdMember, 'delete_member', Mock(return_value=True)) as delete_member:
+            keeper.remove_unhealthy_members([m for m in members if m.region == 'eu-west-1'])
+        # members in eu-central-1 are left alone, i-deadbeef4 in eu-west-1 without instance is removed
+        self.assertEqual([c[0][0].id for c in delete_member.call_args_list], ['ifoobari4'])